@@ -0,0 +1,235 @@
+"""
+CPU inference backends for FinderAI processors
+Dynamic int8 quantisation, cached TorchScript and torch.compile variants
+of a loaded model, plus a drift check against the fp32 embeddings
+
+torch is imported inside the functions that need it so the processors
+can import this module (and its BACKENDS list) before paying for torch.
+"""
+
+import sys
+import os
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+
+BACKENDS = ("fp32", "int8", "torchscript", "int8-torchscript", "compile")
+
+BACKEND_ENV = "FINDERAI_BACKEND"
+THREADS_ENV = "FINDERAI_TORCH_THREADS"
+INTEROP_THREADS_ENV = "FINDERAI_TORCH_INTEROP_THREADS"
+MODEL_CACHE_ENV = "FINDERAI_MODEL_CACHE"
+DEFAULT_MODEL_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_cache")
+
+
+def default_backend():
+    return os.environ.get(BACKEND_ENV, "fp32")
+
+
+def configure_threads(num_threads=None, interop_threads=None):
+    """
+    Bound torch's intra-op and inter-op thread pools.
+
+    Falls back to $FINDERAI_TORCH_THREADS / $FINDERAI_TORCH_INTEROP_THREADS.
+    Inter-op threads can only be set before torch runs any parallel work,
+    so a late call only logs a warning.
+    """
+    import torch
+
+    num_threads = num_threads or os.environ.get(THREADS_ENV)
+    interop_threads = interop_threads or os.environ.get(INTEROP_THREADS_ENV)
+    if num_threads:
+        torch.set_num_threads(int(num_threads))
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(int(interop_threads))
+        except RuntimeError as e:
+            print(f"[BACKEND] Could not set inter-op threads: {e}", file=sys.stderr)
+
+
+def weights_fingerprint(source, path=None):
+    """
+    Short id of a model's weights for traced-module cache file names.
+
+    Args:
+        source: Where the weights come from ("hub", "snapshot:...", a
+            torchvision weights enum name...)
+        path: Checkpoint file, if any; its size and mtime are included so
+            an updated checkpoint at the same path gets a new id
+    """
+    if path and os.path.exists(path):
+        stat = os.stat(path)
+        source = f"{source}|{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()[:12]
+
+
+def state_dict_fingerprint(model):
+    """Short id hashing every tensor of an fp32 model (slower; for callers without a source)"""
+    digest = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        digest.update(name.encode("utf-8"))
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()[:12]
+
+
+def _cache_path(name, backend, cache_dir, fingerprint):
+    import torch
+
+    cache_dir = cache_dir or os.environ.get(MODEL_CACHE_ENV, DEFAULT_MODEL_CACHE)
+    version = torch.__version__.replace("+", "_")
+    return os.path.join(cache_dir, f"{name}-{backend}-torch{version}-{fingerprint}.pt")
+
+
+def _quantize(model):
+    import torch
+
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _script(model, example_input, path):
+    import torch
+
+    if os.path.exists(path):
+        print(f"[BACKEND] Loading TorchScript module from {path}", file=sys.stderr)
+        return torch.jit.load(path, map_location="cpu")
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model, example_input))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    traced.save(tmp)
+    os.replace(tmp, path)
+    print(f"[BACKEND] Saved TorchScript module to {path}", file=sys.stderr)
+    return traced
+
+
+def prepare_model(model, backend, name, example_input=None, cache_dir=None, weights_id=None):
+    """
+    Return ``model`` converted for the selected inference backend.
+
+    Args:
+        model: fp32 module in eval mode (left unmodified)
+        backend: One of BACKENDS
+        name: Model identifier used for the on-disk cache file name
+        example_input: Input batch used to trace TorchScript modules
+        cache_dir: Directory for traced modules (default $FINDERAI_MODEL_CACHE
+            or ./model_cache)
+        weights_id: weights_fingerprint() of the loaded checkpoint, part of
+            the traced module's file name so other weights are never
+            loaded from the cache; hashed from the state dict when omitted
+
+    Returns:
+        Callable module producing the same output shape as ``model``
+    """
+    import torch
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {', '.join(BACKENDS)}")
+    if backend == "fp32":
+        return model
+    if backend.endswith("torchscript") and weights_id is None:
+        weights_id = state_dict_fingerprint(model)
+
+    if backend.startswith("int8"):
+        if not any(isinstance(m, torch.nn.Linear) for m in model.modules()):
+            print(f"[BACKEND] {name} has no Linear layers; int8 dynamic quantisation "
+                  "leaves it unchanged", file=sys.stderr)
+        model = _quantize(model)
+
+    if backend.endswith("torchscript"):
+        if example_input is None:
+            example_input = torch.zeros(1, 3, 224, 224)
+        model = _script(model, example_input, _cache_path(name, backend, cache_dir, weights_id))
+    elif backend == "compile":
+        # Inductor keeps its own on-disk kernel cache between processes
+        model = torch.compile(model)
+
+    return model
+
+
+def measure_drift(reference, candidate, batch, repeats=3):
+    """
+    Compare candidate embeddings against the fp32 reference.
+
+    Args:
+        reference: fp32 module
+        candidate: Module returned by prepare_model()
+        batch: Input tensor of shape (N, 3, H, W)
+        repeats: Timed forward passes per model (after one warm-up)
+
+    Returns:
+        Dict with per-image cosine similarity stats, max absolute error
+        and mean latency of both models
+    """
+    import torch
+
+    def run(model):
+        with torch.no_grad():
+            output = model(batch)
+            started = time.perf_counter()
+            for _ in range(repeats):
+                model(batch)
+            elapsed = (time.perf_counter() - started) / repeats
+        return output.reshape(len(batch), -1).numpy(), elapsed
+
+    expected, reference_time = run(reference)
+    actual, candidate_time = run(candidate)
+
+    norms = np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1)
+    cosine = (expected * actual).sum(axis=1) / np.maximum(norms, 1e-12)
+    return {
+        "images": len(batch),
+        "cosine_min": float(cosine.min()),
+        "cosine_mean": float(cosine.mean()),
+        "cosine_drift_max": float(1.0 - cosine.min()),
+        "max_abs_error": float(np.abs(expected - actual).max()),
+        "fp32_ms_per_batch": round(reference_time * 1000, 3),
+        "backend_ms_per_batch": round(candidate_time * 1000, 3),
+        "speedup": round(reference_time / candidate_time, 3) if candidate_time > 0 else None
+    }
+
+
+def main():
+    import torch
+
+    parser = argparse.ArgumentParser(
+        description="Measure embedding drift and speed of an inference backend against fp32")
+    parser.add_argument("--model", choices=("vit", "resnet"), default="vit")
+    parser.add_argument("--backend", choices=BACKENDS[1:], required=True)
+    parser.add_argument("--images", nargs="*", default=[],
+                        help="Images to compare on (default: random inputs)")
+    parser.add_argument("--batch-size", type=int, default=8,
+                        help="Random inputs to generate when no images are given")
+    parser.add_argument("--min-cosine", type=float, default=0.99,
+                        help="Exit non-zero if any image's cosine similarity falls below this")
+    parser.add_argument("--threads", type=int, help="torch intra-op threads")
+    parser.add_argument("--cache-dir", help="Directory for traced modules")
+    args = parser.parse_args()
+
+    configure_threads(args.threads)
+    if args.model == "vit":
+        from ai_processor_enhanced import ViTProcessor
+        # Drift compares plain model outputs: one (3, 224, 224) tensor per image
+        processor, name = ViTProcessor(backend="fp32", tta=""), "vit_base_patch16_224"
+    else:
+        from ai_processor_resnet import ResNetProcessor
+        processor, name = ResNetProcessor(backend="fp32"), "resnet50"
+
+    if args.images:
+        batch = torch.stack([processor.preprocess(path) for path in args.images])
+    else:
+        batch = torch.randn(args.batch_size, 3, 224, 224, generator=torch.Generator().manual_seed(0))
+
+    candidate = prepare_model(processor.model, args.backend, name, batch[:1], args.cache_dir,
+                              processor.weights_id)
+    report = {"model": name, "backend": args.backend, "threads": torch.get_num_threads(),
+              **measure_drift(processor.model, candidate, batch)}
+    report["accepted"] = report["cosine_min"] >= args.min_cosine
+    print(json.dumps(report))
+    if not report["accepted"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
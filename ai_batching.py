@@ -0,0 +1,151 @@
+"""
+Dynamic micro-batching for FinderAI embedding inference
+Collects concurrent requests into one batched forward pass
+"""
+
+import sys
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """
+    Groups concurrent submissions into batches for a single call of
+    ``run_batch``.
+
+    A batch is dispatched as soon as it holds ``max_batch_size`` items or
+    ``max_wait_ms`` has passed since its first item arrived, whichever
+    comes first. ``run_batch`` receives a list of items and must return a
+    sequence of results in the same order.
+
+    Args:
+        run_batch: Callable taking a list of items, returning a list of results
+        max_batch_size: Largest batch handed to run_batch
+        max_wait_ms: Longest time the oldest queued item waits for company
+    """
+
+    def __init__(self, run_batch, max_batch_size=16, max_wait_ms=20.0):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        self._queue = queue.Queue()
+        self._closed = False
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+
+        self._thread = threading.Thread(target=self._loop, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def _reset_stats(self):
+        self.batches = 0
+        self.items = 0
+        self.failed_batches = 0
+        self.max_observed_batch = 0
+        self.batch_size_histogram = {}
+        self.total_queue_wait = 0.0
+        self.max_queue_wait = 0.0
+        self.total_run_time = 0.0
+
+    def submit(self, item):
+        """Queue an item and return a Future for its result"""
+        if self._closed:
+            raise RuntimeError("MicroBatcher is closed")
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def __call__(self, item, timeout=None):
+        """Submit an item and block until its result is ready"""
+        return self.submit(item).result(timeout=timeout)
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first[2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                entry = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if entry is None:
+                # Re-queue the sentinel so the loop exits after this batch
+                self._queue.put(None)
+                break
+            batch.append(entry)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+
+            started = time.perf_counter()
+            items = [entry[0] for entry in batch]
+            try:
+                results = self.run_batch(items)
+                if len(results) != len(items):
+                    raise RuntimeError(
+                        f"run_batch returned {len(results)} results for {len(items)} items")
+            except Exception as e:
+                print(f"[BATCH] Batch of {len(items)} failed: {e}", file=sys.stderr)
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                with self._stats_lock:
+                    self.failed_batches += 1
+                continue
+
+            finished = time.perf_counter()
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+            with self._stats_lock:
+                size = len(batch)
+                self.batches += 1
+                self.items += size
+                self.max_observed_batch = max(self.max_observed_batch, size)
+                self.batch_size_histogram[size] = self.batch_size_histogram.get(size, 0) + 1
+                for _, _, enqueued in batch:
+                    wait = started - enqueued
+                    self.total_queue_wait += wait
+                    self.max_queue_wait = max(self.max_queue_wait, wait)
+                self.total_run_time += finished - started
+
+    def stats(self):
+        """Counters for tuning batch size against queue latency"""
+        with self._stats_lock:
+            batches = self.batches or 1
+            items = self.items or 1
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000.0,
+                "batches": self.batches,
+                "items": self.items,
+                "failed_batches": self.failed_batches,
+                "queued": self._queue.qsize(),
+                "mean_batch_size": round(self.items / batches, 3),
+                "max_observed_batch": self.max_observed_batch,
+                "batch_size_histogram": {str(k): v for k, v in sorted(self.batch_size_histogram.items())},
+                "mean_queue_wait_ms": round(self.total_queue_wait / items * 1000.0, 3),
+                "max_queue_wait_ms": round(self.max_queue_wait * 1000.0, 3),
+                "mean_batch_run_ms": round(self.total_run_time / batches * 1000.0, 3)
+            }
+
+    def close(self, wait=True):
+        """Stop accepting work; queued items are still processed"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        if wait:
+            self._thread.join()
@@ -0,0 +1,323 @@
+"""
+Benchmark suite for FinderAI embedding and matching hot paths
+Measures cold start, per-image latency, batch throughput and top-k
+search time on synthetic images and corpora, and emits one JSON report
+"""
+
+import sys
+import os
+import io
+import json
+import time
+import platform
+import resource
+import tempfile
+import argparse
+import contextlib
+import subprocess
+import numpy as np
+from PIL import Image, ImageDraw
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# One-shot scripts the Node routes spawn, per model
+CLI_SCRIPTS = {
+    "vit": "ai_processor_enhanced.py",
+    "resnet": "ai_processor_resnet.py",
+    "classical": "ai_processor_enhanced_backup.py",
+}
+
+
+def synthetic_image(rng, width, height):
+    """Photo-like test image: smooth gradient background, shapes and sensor noise"""
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    colors = rng.uniform(0, 255, (2, 3)).astype(np.float32)
+    t = ((x / width + y / height) / 2.0)[..., None]
+    background = colors[0] * (1 - t) + colors[1] * t
+    image = Image.fromarray(background.astype(np.uint8))
+    draw = ImageDraw.Draw(image)
+    for _ in range(int(rng.integers(3, 8))):
+        x0, y0 = rng.uniform(0, width * 0.8), rng.uniform(0, height * 0.8)
+        x1, y1 = x0 + rng.uniform(width * 0.1, width * 0.5), y0 + rng.uniform(height * 0.1, height * 0.5)
+        fill = tuple(int(c) for c in rng.integers(0, 256, 3))
+        if rng.random() < 0.5:
+            draw.rectangle([x0, y0, x1, y1], fill=fill)
+        else:
+            draw.ellipse([x0, y0, x1, y1], fill=fill)
+    noisy = np.asarray(image).astype(np.int16) + rng.normal(0, 6, (height, width, 3)).astype(np.int16)
+    return Image.fromarray(np.clip(noisy, 0, 255).astype(np.uint8))
+
+
+def write_images(directory, count, size, seed=0):
+    """Write ``count`` synthetic JPEGs of size (width, height); returns their paths"""
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"synthetic-{i:03d}.jpg")
+        synthetic_image(rng, *size).save(path, "JPEG", quality=90)
+        paths.append(path)
+    return paths
+
+
+def summarize(samples):
+    """Latency percentiles in milliseconds for a list of durations in seconds"""
+    ms = np.asarray(samples, dtype=np.float64) * 1000.0
+    return {
+        "n": int(len(ms)),
+        "mean_ms": round(float(ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p90_ms": round(float(np.percentile(ms, 90)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "min_ms": round(float(ms.min()), 3),
+        "max_ms": round(float(ms.max()), 3)
+    }
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far (ru_maxrss is KB on Linux, bytes on macOS)"""
+    return _rss_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def _rss_mb(maxrss):
+    return round(maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _time(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+
+# ---------- sections ----------
+
+def bench_cold_start(model, image, repeats, env=None):
+    """Wall time and peak RSS of the one-shot CLI the routes spawn, per run"""
+    samples, peaks = [], []
+    for _ in range(repeats):
+        with tempfile.TemporaryFile() as stderr:
+            started = time.perf_counter()
+            process = subprocess.Popen([sys.executable, os.path.join(HERE, CLI_SCRIPTS[model]), image],
+                                       stdout=subprocess.DEVNULL, stderr=stderr, env=env)
+            # wait4 gives this child's own rusage, not the running max over all children
+            _, status, usage = os.wait4(process.pid, 0)
+            elapsed = time.perf_counter() - started
+            process.returncode = os.waitstatus_to_exitcode(status)
+            if process.returncode != 0:
+                stderr.seek(0)
+                tail = stderr.read().decode("utf-8", "replace").strip().splitlines()[-1:] or ["failed"]
+                return {"error": tail[0]}
+        samples.append(elapsed)
+        peaks.append(usage.ru_maxrss)
+    return {"wall": summarize(samples), "peak_rss_mb": _rss_mb(max(peaks))}
+
+
+def bench_model(model, paths, repeats, batch_sizes, backend=None):
+    """Load time, warm per-image latency and batched throughput in this process"""
+    from ai_embedders import get_embedder
+
+    options = {"backend": backend} if backend and model != "classical" else {}
+    embedder = get_embedder(model, **options)
+    quiet = contextlib.redirect_stderr(io.StringIO())
+    with quiet:
+        load_s, _ = _time(lambda: embedder.processor)
+    report = {"model": model, "load_s": round(load_s, 3)}
+    if model != "classical":
+        report["backend"] = embedder.processor.backend
+    if getattr(embedder.processor, "startup_timings", None):
+        report["startup"] = embedder.processor.startup_timings
+
+    if model == "classical":
+        # The classical path is the function the routes fall back to
+        extract = lambda path: embedder.processor.extract_advanced_features(path)
+    else:
+        extract = embedder.extract_embedding
+
+    with quiet:
+        extract(paths[0])  # warm-up: lazy imports, allocator, kernels
+        latency, preprocess = [], []
+        for _ in range(repeats):
+            for path in paths:
+                latency.append(_time(extract, path)[0])
+                preprocess.append(_time(embedder.preprocess, path)[0])
+    report["latency"] = summarize(latency)
+    report["preprocess"] = summarize(preprocess)
+
+    inputs = [embedder.preprocess(path) for path in paths]
+    report["batch"] = {}
+    for size in batch_sizes:
+        batch = [inputs[i % len(inputs)] for i in range(size)]
+        embedder.embed_batch(batch)
+        runs = [_time(embedder.embed_batch, batch)[0] for _ in range(repeats)]
+        report["batch"][str(size)] = {
+            **summarize(runs),
+            "images_per_s": round(size / float(np.median(runs)), 2)
+        }
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+def bench_search(corpus_sizes, dims, queries, k, seed=0):
+    """Top-k query time against corpus size for the index, IVF and mmap store"""
+    from ai_index import VectorIndex
+    from ai_store import EmbeddingStore
+
+    rng = np.random.default_rng(seed)
+    report = {"dims": dims, "k": k, "sizes": {}}
+    for size in corpus_sizes:
+        # Clustered vectors so IVF recall is meaningful
+        centers = rng.standard_normal((max(1, size // 100), dims)).astype(np.float32)
+        vectors = centers[rng.integers(0, len(centers), size)] + \
+            0.5 * rng.standard_normal((size, dims)).astype(np.float32)
+        query_rows = rng.integers(0, size, queries)
+
+        index = VectorIndex(dims, capacity=size)
+        build_s, _ = _time(index.add_many, [str(i) for i in range(size)], vectors)
+        exact = [_time(index.search, vectors[row], k) for row in query_rows]
+        entry = {"build_s": round(build_s, 3), "brute_force": summarize([t for t, _ in exact])}
+
+        if size >= 1000:
+            ivf_s, _ = _time(index.build_ivf)
+            nprobe = max(1, int(np.sqrt(size) * 0.1))
+            approx = [_time(index.search, vectors[row], k, None, None, nprobe) for row in query_rows]
+            recall = np.mean([len({i for i, _, _ in a} & {i for i, _, _ in e}) / k
+                              for (_, a), (_, e) in zip(approx, exact)])
+            entry["ivf"] = {"build_s": round(ivf_s, 3), "nprobe": nprobe,
+                            f"recall_at_{k}": round(float(recall), 4),
+                            **summarize([t for t, _ in approx])}
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = EmbeddingStore(directory, dims)
+            store.put_many([str(i) for i in range(size)], vectors)
+            entry["store"] = summarize([_time(store.search, vectors[row], k)[0] for row in query_rows])
+            store.close()
+        report["sizes"][str(size)] = entry
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+# ---------- driver ----------
+
+def host_info():
+    info = {"python": platform.python_version(), "platform": platform.platform(),
+            "machine": platform.machine(), "cpu_count": os.cpu_count(), "numpy": np.__version__}
+    try:
+        import torch
+        info["torch"] = torch.__version__
+        info["torch_threads"] = torch.get_num_threads()
+    except ImportError:
+        pass
+    return info
+
+
+def run_section(section, args):
+    """Run one section in a fresh interpreter so its timings and peak RSS are its own"""
+    command = [sys.executable, os.path.abspath(__file__), "--section", section,
+               "--images", str(args.images), "--image-size", args.image_size,
+               "--repeats", str(args.repeats), "--batch-sizes", args.batch_sizes,
+               "--corpus-sizes", args.corpus_sizes, "--dims", str(args.dims),
+               "--queries", str(args.queries), "--k", str(args.k), "--image-dir", args.image_dir]
+    if args.backend:
+        command += ["--backend", args.backend]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        tail = result.stderr.strip().splitlines()[-1:] or ["failed"]
+        return {"error": tail[0]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def compare(report, baseline, tolerance):
+    """Latency metrics that got slower than baseline by more than ``tolerance``"""
+    regressions = []
+
+    def walk(current, previous, path):
+        if isinstance(current, dict) and isinstance(previous, dict):
+            for key, value in current.items():
+                if key in previous:
+                    walk(value, previous[key], path + [key])
+        elif path and path[-1] in ("p50_ms", "p90_ms") and isinstance(previous, (int, float)) and previous > 0:
+            if current > previous * (1 + tolerance):
+                regressions.append({"metric": ".".join(path), "baseline": previous, "current": current,
+                                    "ratio": round(current / previous, 3)})
+
+    walk(report["results"], baseline.get("results", {}), [])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the embedding and matching hot paths")
+    parser.add_argument("--models", default="vit,resnet,classical", help="Comma-separated embedders")
+    parser.add_argument("--backend", help="Inference backend for torch models (see ai_backends)")
+    parser.add_argument("--images", type=int, default=8, help="Synthetic images per model")
+    parser.add_argument("--image-size", default="1600x1200", help="Synthetic image WIDTHxHEIGHT")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed passes over the images")
+    parser.add_argument("--batch-sizes", default="1,4,8,16")
+    parser.add_argument("--cold-starts", type=int, default=2, help="One-shot CLI runs per model (0 skips)")
+    parser.add_argument("--corpus-sizes", default="1000,10000,100000")
+    parser.add_argument("--dims", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--skip-search", action="store_true")
+    parser.add_argument("--output", metavar="FILE", help="Also write the report here")
+    parser.add_argument("--compare", metavar="FILE", help="Baseline report; exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="With --compare, allowed slowdown of p50/p90 (0.15 = 15%%)")
+    parser.add_argument("--section", help=argparse.SUPPRESS)
+    parser.add_argument("--image-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    batch_sizes = [int(size) for size in args.batch_sizes.split(",") if size]
+    corpus_sizes = [int(size) for size in args.corpus_sizes.split(",") if size]
+
+    if args.section:
+        paths = sorted(os.path.join(args.image_dir, name) for name in os.listdir(args.image_dir))
+        if args.section == "search":
+            report = bench_search(corpus_sizes, args.dims, args.queries, args.k)
+        else:
+            report = bench_model(args.section, paths, args.repeats, batch_sizes, args.backend)
+        print(json.dumps(report))
+        return
+
+    width, height = (int(v) for v in args.image_size.lower().split("x"))
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="finderai-bench-") as directory:
+        args.image_dir = directory
+        paths = write_images(directory, args.images, (width, height))
+        env = dict(os.environ)
+        # Cold starts measure the compute path, not cache hits
+        env.pop("FINDERAI_EMBEDDING_CACHE", None)
+        if args.backend:
+            env["FINDERAI_BACKEND"] = args.backend
+
+        for model in [m for m in args.models.split(",") if m]:
+            print(f"[BENCH] {model}", file=sys.stderr)
+            results[model] = run_section(model, args)
+            if args.cold_starts:
+                results[model]["cold_start"] = bench_cold_start(model, paths[0], args.cold_starts, env)
+        if not args.skip_search:
+            print("[BENCH] search", file=sys.stderr)
+            results["search"] = run_section("search", args)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "host": host_info(),
+        "config": {"images": args.images, "image_size": args.image_size, "repeats": args.repeats,
+                   "batch_sizes": batch_sizes, "corpus_sizes": corpus_sizes, "backend": args.backend},
+        "results": results
+    }
+    failed = False
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            report["regressions"] = compare(report, json.load(f), args.tolerance)
+        failed = bool(report["regressions"])
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""
+Bulk embedding pipeline for FinderAI
+Re-embeds a directory, glob or manifest of images, overlapping image
+decoding with model inference and streaming one JSON line per image
+"""
+
+import sys
+import os
+import glob
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ManifestError(str):
+    """
+    Placeholder path for a manifest line that could not be parsed.
+
+    It reads as "<manifest>:<line number>"; run_bulk reports it as a
+    failed image carrying ``error`` instead of aborting the run.
+    """
+
+    def __new__(cls, location, error):
+        entry = super().__new__(cls, location)
+        entry.error = error
+        return entry
+
+
+def collect_images(source=None, manifest=None):
+    """
+    Resolve the list of images to embed.
+
+    Args:
+        source: A directory (walked recursively) or a glob pattern
+        manifest: A text file with one image path per line, or JSON lines
+            carrying an "image" (or "path") field
+
+    Returns:
+        Sorted list of image paths (manifest order is preserved); malformed
+        manifest lines are kept in place as ManifestError entries
+    """
+    paths = []
+
+    if manifest:
+        base = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, "r", encoding="utf-8") as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                if line.startswith("{"):
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError as e:
+                        paths.append(ManifestError(f"{manifest}:{number}", f"Invalid manifest line: {e}"))
+                        continue
+                    line = entry.get("image") or entry.get("path")
+                    if not line:
+                        continue
+                    if not isinstance(line, str):
+                        paths.append(ManifestError(f"{manifest}:{number}",
+                                                   f"Invalid manifest line: image must be a path, got {line!r}"))
+                        continue
+                paths.append(line if os.path.isabs(line) else os.path.join(base, line))
+
+    if source:
+        if os.path.isdir(source):
+            found = []
+            for root, dirs, files in os.walk(source):
+                dirs[:] = [d for d in dirs if not d.startswith(".")]
+                for name in files:
+                    # Uploads are stored by multer without an extension,
+                    # so every visible file is treated as a candidate image
+                    if not name.startswith("."):
+                        found.append(os.path.join(root, name))
+            paths.extend(sorted(found))
+        else:
+            paths.extend(sorted(p for p in glob.glob(source, recursive=True) if os.path.isfile(p)))
+
+    return paths
+
+
+def load_checkpoint(checkpoint):
+    """Return the set of image paths already recorded as done"""
+    if not checkpoint or not os.path.exists(checkpoint):
+        return set()
+    with open(checkpoint, "r", encoding="utf-8") as f:
+        return {line.rstrip("\n") for line in f if line.strip()}
+
+
+def run_bulk(processor, build_result, paths, out=None, batch_size=16, workers=4,
+             checkpoint=None, prefetch=None):
+    """
+    Embed ``paths`` in batches and stream results to ``out``.
+
+    Images are decoded and transformed on a thread pool while the
+    previous batch runs through the model. Each image produces one JSON
+    line as soon as its batch finishes. Successful paths are appended to
+    ``checkpoint`` after their lines are flushed, so a restarted run with
+    the same checkpoint skips them and retries only the failures.
+    Unparseable manifest entries (ManifestError) fail the same way.
+
+    When the processor has an embedding cache (``cache`` and
+    ``cache_namespace`` attributes, as ViTProcessor and the embedders do),
+    each image is looked up on the decode threads before preprocessing:
+    hits are written straight out and never batched, and computed vectors
+    are stored for the next run.
+
+    Args:
+        processor: Object with preprocess(path) and embed_batch(tensors)
+        build_result: Callable turning one embedding into the output dict
+        paths: Images to embed
+        out: Text stream for JSON lines (defaults to stdout)
+        batch_size: Images per forward pass
+        workers: Decode/preprocess threads
+        checkpoint: Optional path of the resume file
+        prefetch: Preprocessed images kept in flight (defaults to 2 batches)
+
+    Returns:
+        Summary dict with counts and throughput
+    """
+    out = out or sys.stdout
+    done = load_checkpoint(checkpoint)
+    pending = [p for p in paths if p not in done]
+    skipped = len(paths) - len(pending)
+    if skipped:
+        print(f"[BULK] Resuming: {skipped} images already done", file=sys.stderr)
+
+    prefetch = prefetch or batch_size * 2
+    cache = getattr(processor, "cache", None)
+    namespace = processor.cache_namespace if cache is not None else None
+    checkpoint_file = open(checkpoint, "a", encoding="utf-8") if checkpoint else None
+    started = time.perf_counter()
+    succeeded = 0
+    failed = 0
+    cache_hits = 0
+
+    def load(path):
+        """(cache key, cached vector, preprocessed input); one of the last two is None"""
+        if isinstance(path, ManifestError):
+            raise ValueError(path.error)
+        key = None
+        if cache is not None:
+            key, cached = cache.lookup(path, namespace)
+            if cached is not None:
+                return key, cached, None
+        return key, None, processor.preprocess(path)
+
+    def emit(path, result, completed):
+        out.write(json.dumps({"image": path, **result}) + "\n")
+        # Failures are not checkpointed so a resumed run retries them
+        if result.get("success"):
+            completed.append(path)
+
+    def flush(completed):
+        out.flush()
+        if checkpoint_file:
+            checkpoint_file.write("".join(p + "\n" for p in completed))
+            checkpoint_file.flush()
+        completed.clear()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bulk-decode") as pool:
+            queued = deque()
+            remaining = iter(pending)
+
+            def refill():
+                while len(queued) < prefetch:
+                    path = next(remaining, None)
+                    if path is None:
+                        return
+                    queued.append((path, pool.submit(load, path)))
+
+            refill()
+            while queued:
+                batch_paths = []
+                keys = []
+                tensors = []
+                completed = []
+                while queued and len(tensors) < batch_size:
+                    path, future = queued.popleft()
+                    try:
+                        key, cached, tensor = future.result()
+                    except Exception as e:
+                        failed += 1
+                        emit(path, {"success": False, "error": str(e)}, completed)
+                        continue
+                    if cached is not None:
+                        cache_hits += 1
+                        succeeded += 1
+                        emit(path, build_result(cached), completed)
+                        continue
+                    batch_paths.append(path)
+                    keys.append(key)
+                    tensors.append(tensor)
+                # Keep the decoders busy while this batch is in the model
+                refill()
+
+                if tensors:
+                    try:
+                        embeddings = processor.embed_batch(tensors)
+                    except Exception as e:
+                        failed += len(tensors)
+                        for path in batch_paths:
+                            emit(path, {"success": False, "error": str(e)}, completed)
+                    else:
+                        succeeded += len(tensors)
+                        for path, key, embedding in zip(batch_paths, keys, embeddings):
+                            emit(path, build_result(embedding), completed)
+                            if key is not None:
+                                cache.put(key, embedding)
+                flush(completed)
+
+                processed = succeeded + failed
+                elapsed = time.perf_counter() - started
+                print(f"[BULK] {processed}/{len(pending)} images "
+                      f"({processed / elapsed:.1f} img/s)", file=sys.stderr)
+    finally:
+        if checkpoint_file:
+            checkpoint_file.close()
+
+    elapsed = time.perf_counter() - started
+    summary = {
+        "success": failed == 0,
+        "total": len(paths),
+        "skipped": skipped,
+        "succeeded": succeeded,
+        "failed": failed,
+        "seconds": round(elapsed, 3),
+        "images_per_second": round((succeeded + failed) / elapsed, 3) if elapsed > 0 else 0.0
+    }
+    if cache is not None:
+        summary["cache_hits"] = cache_hits
+    return summary
@@ -0,0 +1,216 @@
+"""
+Content-addressed embedding cache for FinderAI
+Persists vectors in SQLite keyed by image content hash, model and
+preprocessing config, with size-bounded LRU eviction
+"""
+
+import sys
+import os
+import atexit
+import time
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+
+CACHE_ENV = "FINDERAI_EMBEDDING_CACHE"
+CACHE_MAX_MB_ENV = "FINDERAI_EMBEDDING_CACHE_MAX_MB"
+DEFAULT_MAX_MB = 512
+
+
+class EmbeddingCache:
+    """
+    On-disk cache mapping (image content, model, preprocessing) to a vector.
+
+    The key hashes the encoded file bytes, so a hit skips both image
+    decoding and inference; byte-identical re-uploads always hit. Entries
+    are evicted least-recently-used first once the stored vectors exceed
+    ``max_bytes``. Hit/miss counters are persisted so they cover every
+    process sharing the cache file.
+
+    A lookup is a single read: hit/miss counts and access times are kept
+    in memory and written in one transaction at the next put(), stats()
+    or close(), or once ``flush_interval`` seconds have passed. An entry's
+    access time is only refreshed when it is older than ``flush_interval``,
+    which is all LRU order needs. The stored byte total is a counter row
+    kept up to date by put() and eviction rather than a table scan.
+
+    Args:
+        path: SQLite database file
+        max_bytes: Upper bound on the total size of stored vectors
+        flush_interval: Seconds between counter/access-time writes
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_MB * 1024 * 1024, flush_interval=30.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._pending = {"hits": 0, "misses": 0}
+        self._touched = {}
+        self._flushed = time.time()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " key TEXT PRIMARY KEY, dtype TEXT NOT NULL, dims INTEGER NOT NULL,"
+                " vector BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_lru ON embeddings (last_access)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            for name in ("hits", "misses", "evictions"):
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO counters (name, value) VALUES (?, 0)", (name,))
+            # Caches created before the running total existed are summed once
+            self._conn.execute(
+                "INSERT OR IGNORE INTO counters (name, value)"
+                " SELECT 'bytes', COALESCE(SUM(size), 0) FROM embeddings")
+
+    @staticmethod
+    def make_key(image_bytes, namespace):
+        """Hash image content together with the model/preprocessing namespace"""
+        digest = hashlib.sha256()
+        digest.update(namespace.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(image_bytes)
+        return digest.hexdigest()
+
+    def _bump(self, name, amount=1):
+        self._conn.execute("UPDATE counters SET value = value + ? WHERE name = ?", (amount, name))
+
+    def _counter(self, name):
+        return self._conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()[0]
+
+    def _flush(self):
+        """Write pending counters and access times (lock and transaction held)"""
+        for name, amount in self._pending.items():
+            if amount:
+                self._bump(name, amount)
+                self._pending[name] = 0
+        if self._touched:
+            self._conn.executemany("UPDATE embeddings SET last_access = ? WHERE key = ?",
+                                   [(accessed, key) for key, accessed in self._touched.items()])
+            self._touched.clear()
+        self._flushed = time.time()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT dtype, dims, vector, last_access FROM embeddings WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            if row is None:
+                self._pending["misses"] += 1
+            else:
+                self._pending["hits"] += 1
+                if now - row[3] > self.flush_interval:
+                    self._touched[key] = now
+            if now - self._flushed > self.flush_interval:
+                with self._conn:
+                    self._flush()
+        if row is None:
+            return None
+        dtype, dims, blob, _ = row
+        return np.frombuffer(blob, dtype=dtype).reshape(dims).copy()
+
+    def put(self, key, vector):
+        vector = np.ascontiguousarray(vector)
+        blob = vector.tobytes()
+        with self._lock, self._conn:
+            self._flush()
+            self._touched.pop(key, None)
+            previous = self._conn.execute("SELECT size FROM embeddings WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embeddings (key, dtype, dims, vector, size, last_access)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, vector.dtype.str, vector.size, blob, len(blob), time.time()))
+            self._bump("bytes", len(blob) - (previous[0] if previous else 0))
+            self._evict()
+
+    def _evict(self):
+        total = self._counter("bytes")
+        freed = evicted = 0
+        while total - freed > self.max_bytes:
+            oldest = self._conn.execute(
+                "SELECT key, size FROM embeddings ORDER BY last_access ASC LIMIT 64").fetchall()
+            if not oldest:
+                break
+            for key, size in oldest:
+                if total - freed <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                self._touched.pop(key, None)
+                freed += size
+                evicted += 1
+        if evicted:
+            self._bump("bytes", -freed)
+            self._bump("evictions", evicted)
+
+    def lookup(self, image, namespace):
+        """
+        Read an image's bytes and look up its vector.
+
+        Args:
+            image: Image path, or the encoded image bytes themselves
+            namespace: Model/preprocessing namespace
+
+        Returns:
+            (key, vector) where vector is None on a miss; pass the key to
+            put() once the vector has been computed
+        """
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            key = self.make_key(image, namespace)
+        else:
+            with open(image, "rb") as f:
+                key = self.make_key(f.read(), namespace)
+        return key, self.get(key)
+
+    def stats(self):
+        with self._lock:
+            with self._conn:
+                self._flush()
+            counters = dict(self._conn.execute("SELECT name, value FROM counters").fetchall())
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        lookups = counters["hits"] + counters["misses"]
+        return {
+            "hits": counters["hits"],
+            "misses": counters["misses"],
+            "hit_rate": round(counters["hits"] / lookups, 4) if lookups else 0.0,
+            "evictions": counters["evictions"],
+            "entries": entries,
+            "bytes": counters["bytes"],
+            "max_bytes": self.max_bytes
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is None:
+                return
+            with self._conn:
+                self._flush()
+            self._conn.close()
+            self._conn = None
+
+
+def open_cache(path=None):
+    """
+    Open the cache at ``path`` or $FINDERAI_EMBEDDING_CACHE.
+
+    Returns None when neither is set, so caching stays opt-in.
+    """
+    path = path or os.environ.get(CACHE_ENV)
+    if not path:
+        return None
+    max_mb = float(os.environ.get(CACHE_MAX_MB_ENV, DEFAULT_MAX_MB))
+    try:
+        cache = EmbeddingCache(path, max_bytes=int(max_mb * 1024 * 1024))
+    except sqlite3.Error as e:
+        print(f"[CACHE] Disabled, cannot open {path}: {e}", file=sys.stderr)
+        return None
+    # One-shot processes exit without closing; keep their counts
+    atexit.register(cache.close)
+    return cache
@@ -0,0 +1,128 @@
+"""
+Compact binary embedding encoding for FinderAI
+Frames float32/float16 vectors with a small header so they can be passed
+between processes without formatting floats as JSON text
+"""
+
+import sys
+import struct
+import base64
+import numpy as np
+
+MAGIC = b"FAIE"
+VERSION = 1
+ALIGNMENT = 8
+
+# Fixed part of the header: magic, version, dtype code, header length,
+# vector count, dimensions, model name length (all little-endian)
+_HEADER = struct.Struct("<4sBBHIIH")
+
+DTYPES = {
+    1: np.dtype("<f4"),
+    2: np.dtype("<f2"),
+}
+DTYPE_CODES = {dtype: code for code, dtype in DTYPES.items()}
+
+# Output formats accepted by the processor CLIs; "b64-*" wraps the framed
+# bytes in base64 so they travel as a single ASCII line
+FORMATS = ("json", "f32", "f16", "b64-f32", "b64-f16")
+
+
+def _dtype_for(fmt):
+    return np.dtype("<f2") if fmt.endswith("f16") else np.dtype("<f4")
+
+
+def encode_embeddings(vectors, model="", dtype="float32"):
+    """
+    Frame one vector or a (count, dims) matrix as bytes.
+
+    Layout: an 18-byte fixed header, the UTF-8 model name, zero padding up
+    to an 8-byte boundary, then count * dims little-endian values.
+
+    Args:
+        vectors: 1-D vector or 2-D matrix of embeddings
+        model: Model identifier stored in the header
+        dtype: "float32" or "float16"
+
+    Returns:
+        bytes
+    """
+    dtype = np.dtype(dtype).newbyteorder("<")
+    if dtype not in DTYPE_CODES:
+        raise ValueError(f"Unsupported dtype: {dtype}")
+
+    matrix = np.asarray(vectors)
+    if matrix.ndim == 1:
+        matrix = matrix[np.newaxis, :]
+    if matrix.ndim != 2:
+        raise ValueError("Expected a vector or a 2-D matrix")
+    count, dims = matrix.shape
+
+    name = model.encode("utf-8")
+    fixed = _HEADER.size + len(name)
+    header_len = (fixed + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+    header = _HEADER.pack(MAGIC, VERSION, DTYPE_CODES[dtype], header_len, count, dims, len(name))
+    payload = np.ascontiguousarray(matrix, dtype=dtype).tobytes()
+    return header + name + b"\0" * (header_len - fixed) + payload
+
+
+def decode_embeddings(buffer):
+    """
+    Parse framed bytes produced by encode_embeddings().
+
+    The returned array is a zero-copy np.frombuffer view over ``buffer``
+    (read-only when ``buffer`` is bytes).
+
+    Returns:
+        (matrix of shape (count, dims), header dict)
+    """
+    if isinstance(buffer, str):
+        buffer = base64.b64decode(buffer)
+    magic, version, code, header_len, count, dims, name_len = _HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a FinderAI embedding buffer")
+    if version != VERSION:
+        raise ValueError(f"Unsupported embedding buffer version: {version}")
+    if code not in DTYPES:
+        raise ValueError(f"Unsupported dtype code: {code}")
+
+    dtype = DTYPES[code]
+    model = bytes(buffer[_HEADER.size:_HEADER.size + name_len]).decode("utf-8")
+    matrix = np.frombuffer(buffer, dtype=dtype, count=count * dims, offset=header_len)
+    header = {"model": model, "dtype": dtype.name, "count": count, "dimensions": dims}
+    return matrix.reshape(count, dims), header
+
+
+def pack_result(embedding, model, fmt):
+    """
+    Build a JSON-safe result with the vector base64-packed instead of
+    listed as floats. Used by line-oriented protocols.
+    """
+    if not fmt.startswith("b64-"):
+        raise ValueError(f"Format {fmt} cannot be embedded in JSON")
+    dtype = _dtype_for(fmt)
+    blob = encode_embeddings(embedding, model, dtype)
+    return {
+        "success": True,
+        "format": fmt,
+        "dtype": dtype.name,
+        "dimensions": int(np.asarray(embedding).shape[-1]),
+        "model": model,
+        "data": base64.b64encode(blob).decode("ascii")
+    }
+
+
+def write_embedding(embedding, model, fmt, stream=None):
+    """
+    Write one embedding to stdout in a non-JSON format.
+
+    "f32"/"f16" write the raw framed bytes; "b64-f32"/"b64-f16" write the
+    framed bytes as one base64 line.
+    """
+    stream = stream or sys.stdout.buffer
+    blob = encode_embeddings(embedding, model, _dtype_for(fmt))
+    if fmt.startswith("b64-"):
+        stream.write(base64.b64encode(blob) + b"\n")
+    else:
+        stream.write(blob)
+    stream.flush()
@@ -0,0 +1,392 @@
+"""
+Pluggable embedder registry for FinderAI
+One interface over the ViT, ResNet and classical computer-vision
+backends, selected by name and tagged with model id and version
+"""
+
+import sys
+import json
+import argparse
+import threading
+import numpy as np
+from PIL import Image
+
+from ai_cache import open_cache
+from ai_metrics import stage
+
+EMBEDDERS = {}
+
+# Failures caused by the image itself (missing, unreadable, not an image,
+# truncated, oversized) rather than by a loaded model; every embedder
+# would fail on it the same way
+INPUT_ERRORS = (OSError, Image.DecompressionBombError)
+
+
+def register_embedder(name):
+    """Class decorator adding an Embedder subclass to the registry"""
+    def decorate(cls):
+        cls.name = name
+        EMBEDDERS[name] = cls
+        return cls
+    return decorate
+
+
+def available_embedders():
+    return sorted(EMBEDDERS)
+
+
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+def get_embedder(name, **options):
+    """
+    Return the shared embedder registered under ``name``.
+
+    Instances are cached per (name, options) so a process loads each
+    model once; the model itself is only loaded on first use.
+    """
+    if name not in EMBEDDERS:
+        raise KeyError(f"Unknown embedder '{name}', expected one of {', '.join(available_embedders())}")
+    key = (name, tuple(sorted(options.items())))
+    with _instances_lock:
+        if key not in _instances:
+            _instances[key] = EMBEDDERS[name](**options)
+        return _instances[key]
+
+
+class Embedder:
+    """
+    Common embedding interface.
+
+    Subclasses load their model lazily in ``_load()`` and implement
+    ``preprocess(path)`` and ``embed_batch(inputs)``, which is all that
+    ai_batching.MicroBatcher, ai_bulk.run_bulk and ai_worker need.
+    ``model_id`` and ``version`` identify the vector space: vectors are
+    only comparable when both match.
+    """
+
+    name = None
+    model_id = None
+    version = "1"
+    dims = None
+
+    def __init__(self, cache=None, fast_preprocess=None):
+        self._cache = cache
+        self.fast_preprocess = fast_preprocess
+        self._processor = None
+        self._load_lock = threading.Lock()
+
+    @property
+    def processor(self):
+        if self._processor is None:
+            with self._load_lock:
+                if self._processor is None:
+                    self._processor = self._load()
+        return self._processor
+
+    def _load(self):
+        raise NotImplementedError
+
+    @property
+    def cache(self):
+        return getattr(self.processor, "cache", None)
+
+    @property
+    def cache_namespace(self):
+        return getattr(self.processor, "cache_namespace", None)
+
+    def preprocess(self, image_path, trace=None):
+        raise NotImplementedError
+
+    def embed_batch(self, inputs):
+        raise NotImplementedError
+
+    def extract_embedding(self, image_path, trace=None):
+        inputs = [self.preprocess(image_path, trace)]
+        with stage(trace, "forward"):
+            return self.embed_batch(inputs)[0]
+
+    def tag(self):
+        tag = {
+            "embedder": self.name,
+            "model_id": self.model_id,
+            "model_version": self.version,
+            "dimensions": self.dims
+        }
+        projection = getattr(self.processor, "projection", None)
+        if projection is not None:
+            # Compact vectors only compare with others from the same projection
+            tag["dimensions"] = projection.dims
+            tag["projection"] = projection.fingerprint
+        return tag
+
+    def build_result(self, embedding):
+        """Output dict for one vector, tagged with the model identity"""
+        embedding = np.asarray(embedding)
+        return {"success": True, "embeddings": embedding.tolist(), **self.tag()}
+
+
+@register_embedder("vit")
+class ViTEmbedder(Embedder):
+    model_id = "vit_base_patch16_224"
+    dims = 768
+
+    def __init__(self, cache=None, backend=None, fast_preprocess=None, projection=None, tta=None):
+        super().__init__(cache, fast_preprocess)
+        self.backend = backend
+        self.projection = projection
+        self.tta = tta
+
+    def _load(self):
+        from ai_processor_enhanced import ViTProcessor
+        return ViTProcessor(cache=self._cache, backend=self.backend, fast_preprocess=self.fast_preprocess,
+                            projection=self.projection, tta=self.tta)
+
+    def tag(self):
+        tag = {**super().tag(), "backend": self.processor.backend}
+        if self.processor.tta:
+            # Pooled multi-view vectors; compare them with vectors pooled the same way
+            tag["tta"] = "+".join(self.processor.tta)
+        return tag
+
+    def preprocess(self, image_path, trace=None):
+        return self.processor.preprocess(image_path, trace)
+
+    def embed_batch(self, inputs):
+        return self.processor.embed_batch(inputs)
+
+    def extract_embedding(self, image_path, trace=None):
+        return self.processor.extract_embedding(image_path, trace)
+
+
+@register_embedder("resnet")
+class ResNetEmbedder(Embedder):
+    model_id = "resnet50.IMAGENET1K_V2"
+    dims = 2048
+
+    def __init__(self, cache=None, backend=None, fast_preprocess=None, projection=None):
+        super().__init__(cache, fast_preprocess)
+        self.backend = backend
+        self.projection = projection
+
+    def _load(self):
+        from ai_processor_resnet import ResNetProcessor
+        return ResNetProcessor(cache=self._cache, backend=self.backend,
+                               fast_preprocess=self.fast_preprocess, projection=self.projection)
+
+    def tag(self):
+        return {**super().tag(), "backend": self.processor.backend}
+
+    def preprocess(self, image_path, trace=None):
+        return self.processor.preprocess(image_path, trace)
+
+    def embed_batch(self, inputs):
+        return self.processor.embed_batch(inputs)
+
+    def extract_embedding(self, image_path, trace=None):
+        return self.processor.extract_embedding(image_path, trace)
+
+
+@register_embedder("classical")
+class ClassicalEmbedder(Embedder):
+    """OpenCV features; no torch, cheapest to load and run"""
+
+    model_id = "enhanced-cv-768"
+    dims = 768
+
+    def _load(self):
+        import ai_processor_enhanced_backup
+        return ai_processor_enhanced_backup
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def cache_namespace(self):
+        return self.processor.cache_namespace(self.fast_preprocess)
+
+    def preprocess(self, image_path, trace=None):
+        return self.processor.load_image(image_path, self.fast_preprocess, trace)
+
+    def embed_batch(self, inputs):
+        return [self.processor.compute_advanced_features(image) for image in inputs]
+
+    def extract_embedding(self, image_path, trace=None):
+        key = None
+        if self._cache is not None:
+            with stage(trace, "cache"):
+                key, cached = self._cache.lookup(image_path, self.cache_namespace)
+            if cached is not None:
+                return cached
+        embedding = super().extract_embedding(image_path, trace)
+        if key is not None:
+            self._cache.put(key, embedding)
+        return embedding
+
+
+class LoadAwareEmbedder:
+    """
+    Routes requests between a preferred (expensive) embedder and a cheap one.
+
+    While fewer than ``max_inflight`` requests are running, the preferred
+    embedder is used; beyond that, or when the preferred model fails to
+    load or run, the cheap one answers. Load only builds up with
+    concurrent callers such as ai_service --fallback; a sequential caller
+    only gets the failure fallback.
+
+    A missing or undecodable image is the caller's error and is raised,
+    not retried on the cheap path. Results carry the tag of whichever
+    embedder produced them, so stored vectors can be matched within one
+    model space and re-embedded with the preferred model later.
+    """
+
+    def __init__(self, preferred, cheap, max_inflight=2):
+        self.preferred = preferred
+        self.cheap = cheap
+        self.max_inflight = max_inflight
+        self._inflight = 0
+        self._lock = threading.Lock()
+        self.routed = {preferred.name: 0, cheap.name: 0}
+        self.fallbacks = 0
+
+    def embed(self, image_path, trace=None):
+        """Return (embedding, embedder that produced it)"""
+        with self._lock:
+            use_preferred = self._inflight < self.max_inflight
+            self._inflight += 1
+        try:
+            if use_preferred:
+                embedder = self.preferred
+                try:
+                    # Load first, so an OSError below comes from the image
+                    embedder.processor
+                except Exception as e:
+                    self._fall_back(e)
+                else:
+                    try:
+                        return embedder.extract_embedding(image_path, trace), self._count(embedder)
+                    except INPUT_ERRORS:
+                        raise
+                    except Exception as e:
+                        self._fall_back(e)
+            embedder = self.cheap
+            return embedder.extract_embedding(image_path, trace), self._count(embedder)
+        finally:
+            with self._lock:
+                self._inflight -= 1
+
+    def _fall_back(self, error):
+        print(f"[EMBED] {self.preferred.name} failed, falling back to "
+              f"{self.cheap.name}: {error}", file=sys.stderr)
+        with self._lock:
+            self.fallbacks += 1
+
+    def _count(self, embedder):
+        with self._lock:
+            self.routed[embedder.name] += 1
+        return embedder
+
+    def stats(self):
+        with self._lock:
+            return {"inflight": self._inflight, "max_inflight": self.max_inflight,
+                    "routed": dict(self.routed), "fallbacks": self.fallbacks}
+
+    def build_result(self, image_path):
+        embedding, embedder = self.embed(image_path)
+        return embedder.build_result(embedding)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embed images with a registered embedder")
+    parser.add_argument("images", nargs="*", help="Images to embed, one JSON line each")
+    parser.add_argument("--embedder", default="vit", choices=available_embedders())
+    parser.add_argument("--fallback", choices=available_embedders(),
+                        help="Cheap embedder used when --embedder fails (routing by load needs "
+                             "concurrent requests, see ai_service --fallback)")
+    parser.add_argument("--max-inflight", type=int, default=2,
+                        help="With --fallback, concurrent requests before routing to it")
+    parser.add_argument("--backend", help="Inference backend for torch embedders")
+    parser.add_argument("--cache", metavar="FILE",
+                        help="Embedding cache database (default: $FINDERAI_EMBEDDING_CACHE)")
+    parser.add_argument("--fast-preprocess", action="store_true", default=None,
+                        help="Reduced-scale JPEG decode and NumPy normalisation "
+                             "(default: $FINDERAI_FAST_PREPROCESS)")
+    parser.add_argument("--projection", metavar="FILE",
+                        help="With a torch embedder, emit compact vectors (see ai_projection)")
+    parser.add_argument("--tta", metavar="VIEWS",
+                        help="With vit, mean-pool these test-time augmentation views, e.g. center,flip")
+    parser.add_argument("--bulk", metavar="DIR_OR_GLOB",
+                        help="Stream embeddings for a directory or glob (see ai_bulk)")
+    parser.add_argument("--checkpoint", metavar="FILE", help="With --bulk, resume file")
+    parser.add_argument("--batch-size", type=int, default=16, help="With --bulk, images per batch")
+    parser.add_argument("--serve", action="store_true",
+                        help="Run the JSON-lines worker (see ai_worker) on stdin/stdout")
+    parser.add_argument("--dedup-radius", type=int, default=0,
+                        help="With --serve, reuse the vector of a near-identical earlier upload "
+                             "(perceptual hash within this many bits; 0 = off)")
+    parser.add_argument("--list", action="store_true", help="List registered embedders")
+    args = parser.parse_args()
+
+    if args.list:
+        for name in available_embedders():
+            cls = EMBEDDERS[name]
+            print(json.dumps({"embedder": name, "model_id": cls.model_id,
+                              "model_version": cls.version, "dimensions": cls.dims}))
+        return
+
+    def options(name):
+        opts = {"cache": open_cache(args.cache), "fast_preprocess": args.fast_preprocess}
+        if name != "classical":
+            if args.backend:
+                opts["backend"] = args.backend
+            if args.projection:
+                opts["projection"] = args.projection
+        if name == "vit" and args.tta:
+            opts["tta"] = args.tta
+        return opts
+
+    router = None
+    embedder = get_embedder(args.embedder, **options(args.embedder))
+
+    if args.bulk:
+        from ai_bulk import collect_images, run_bulk
+        summary = run_bulk(embedder, embedder.build_result, collect_images(args.bulk),
+                           batch_size=args.batch_size, checkpoint=args.checkpoint)
+        print(json.dumps(summary), file=sys.stderr)
+        sys.exit(0 if summary["success"] else 1)
+    if args.serve:
+        if args.fallback:
+            # The stdio worker answers one request at a time, so no load builds up
+            parser.error("--fallback is not supported with --serve; use ai_service --fallback")
+        from ai_worker import EmbeddingWorker
+        dedup = None
+        if args.dedup_radius > 0:
+            from ai_phash import NearDuplicateFilter
+            dedup = NearDuplicateFilter(args.dedup_radius)
+        worker = EmbeddingWorker(embedder, embedder.build_result, embedder.model_id, dedup=dedup)
+        worker.install_signal_handlers()
+        worker.serve_stdio()
+        return
+
+    if args.fallback:
+        router = LoadAwareEmbedder(embedder, get_embedder(args.fallback, **options(args.fallback)),
+                                   args.max_inflight)
+
+    failed = False
+    for path in args.images:
+        try:
+            result = router.build_result(path) if router else embedder.build_result(
+                embedder.extract_embedding(path))
+        except Exception as e:
+            failed = True
+            result = {"success": False, "error": str(e)}
+        print(json.dumps({"image": path, **result}))
+        sys.stdout.flush()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,419 @@
+"""
+Vector index for FinderAI item matching
+Keeps item embeddings as an L2-normalised float32 matrix and answers
+top-k cosine queries with a single matrix-vector product
+"""
+
+import json
+import numpy as np
+
+
+def normalize(vectors):
+    """L2-normalise a vector or each row of a matrix (zero rows stay zero)"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class VectorIndex:
+    """
+    In-memory cosine similarity index over item embeddings.
+
+    Rows live in a preallocated matrix that grows geometrically. Removing
+    an item moves the last row into its slot, so the live rows are always
+    the contiguous prefix ``matrix[:len(index)]`` and a brute-force query
+    is one ``matrix @ query`` over it.
+
+    Metadata fields named in ``filter_fields`` (for example type,
+    category, status) are stored column-wise so pre-filters are vectorised
+    comparisons rather than Python loops.
+
+    Once ``build_ivf()`` has been called, queries only score rows in the
+    ``nprobe`` clusters nearest to the query (an IVF-style approximate
+    search); items added later are assigned to their nearest centroid.
+
+    Args:
+        dims: Embedding dimensionality
+        filter_fields: Metadata keys usable in search(filters=...)
+        capacity: Initial number of preallocated rows
+    """
+
+    def __init__(self, dims, filter_fields=("type", "category", "status"), capacity=1024):
+        self.dims = dims
+        self.filter_fields = tuple(filter_fields)
+        self._size = 0
+        self._matrix = np.zeros((capacity, dims), dtype=np.float32)
+        self._ids = [None] * capacity
+        self._rows = {}
+        self._metadata = [None] * capacity
+        self._columns = {field: np.empty(capacity, dtype=object) for field in self.filter_fields}
+        self._centroids = None
+        self._assign = np.full(capacity, -1, dtype=np.int32)
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, item_id):
+        return item_id in self._rows
+
+    @property
+    def vectors(self):
+        """Read-only view of the live normalised vectors"""
+        view = self._matrix[:self._size]
+        view.flags.writeable = False
+        return view
+
+    @property
+    def ids(self):
+        return self._ids[:self._size]
+
+    def _grow(self, needed):
+        capacity = len(self._matrix)
+        if needed <= capacity:
+            return
+        new_capacity = max(needed, capacity * 2)
+        matrix = np.zeros((new_capacity, self.dims), dtype=np.float32)
+        matrix[:self._size] = self._matrix[:self._size]
+        self._matrix = matrix
+        self._ids.extend([None] * (new_capacity - capacity))
+        self._metadata.extend([None] * (new_capacity - capacity))
+        for field, column in self._columns.items():
+            grown = np.empty(new_capacity, dtype=object)
+            grown[:self._size] = column[:self._size]
+            self._columns[field] = grown
+        assign = np.full(new_capacity, -1, dtype=np.int32)
+        assign[:self._size] = self._assign[:self._size]
+        self._assign = assign
+
+    def add(self, item_id, vector, metadata=None):
+        """Insert an item, replacing any existing entry with the same id"""
+        self.add_many([item_id], [vector], [metadata])
+
+    def add_many(self, item_ids, vectors, metadatas=None):
+        vectors = normalize(np.asarray(vectors, dtype=np.float32).reshape(-1, self.dims))
+        if len(item_ids) != len(vectors):
+            raise ValueError("item_ids and vectors must have the same length")
+        metadatas = metadatas if metadatas is not None else [None] * len(item_ids)
+
+        self._grow(self._size + len(item_ids))
+        for item_id, vector, metadata in zip(item_ids, vectors, metadatas):
+            row = self._rows.get(item_id)
+            if row is None:
+                row = self._size
+                self._size += 1
+                self._rows[item_id] = row
+                self._ids[row] = item_id
+            self._matrix[row] = vector
+            self._set_metadata(row, metadata or {})
+
+        if self._centroids is not None:
+            rows = np.fromiter((self._rows[i] for i in item_ids), dtype=np.int64, count=len(item_ids))
+            self._assign[rows] = np.argmax(self._matrix[rows] @ self._centroids.T, axis=1)
+
+    def _set_metadata(self, row, metadata):
+        self._metadata[row] = metadata
+        for field, column in self._columns.items():
+            column[row] = metadata.get(field)
+
+    def update_metadata(self, item_id, **fields):
+        """Merge fields into an item's metadata, e.g. status="claimed" """
+        row = self._rows[item_id]
+        self._set_metadata(row, {**self._metadata[row], **fields})
+
+    def remove(self, item_id):
+        """Remove an item; returns False if it was not indexed"""
+        row = self._rows.pop(item_id, None)
+        if row is None:
+            return False
+        last = self._size - 1
+        if row != last:
+            moved = self._ids[last]
+            self._matrix[row] = self._matrix[last]
+            self._ids[row] = moved
+            self._metadata[row] = self._metadata[last]
+            for column in self._columns.values():
+                column[row] = column[last]
+            self._assign[row] = self._assign[last]
+            self._rows[moved] = row
+        self._ids[last] = None
+        self._metadata[last] = None
+        for column in self._columns.values():
+            column[last] = None
+        self._assign[last] = -1
+        self._size = last
+        return True
+
+    def metadata(self, item_id):
+        return self._metadata[self._rows[item_id]]
+
+    def _filter_mask(self, filters):
+        mask = np.ones(self._size, dtype=bool)
+        for field, wanted in filters.items():
+            if field not in self._columns:
+                raise KeyError(f"'{field}' is not a filter field of this index")
+            column = self._columns[field][:self._size]
+            if isinstance(wanted, (list, tuple, set, frozenset)):
+                field_mask = np.zeros(self._size, dtype=bool)
+                for value in wanted:
+                    field_mask |= column == value
+                mask &= field_mask
+            else:
+                mask &= column == wanted
+        return mask
+
+    def _candidate_rows(self, query, filters, nprobe, exclude, include=None):
+        rows = None
+        if include is not None:
+            rows = np.array(sorted({self._rows[i] for i in include if i in self._rows}), dtype=np.int64)
+        elif self._centroids is not None and nprobe:
+            nearest = np.argsort(-(self._centroids @ query))[:nprobe]
+            rows = np.flatnonzero(np.isin(self._assign[:self._size], nearest))
+        if filters:
+            mask = self._filter_mask(filters)
+            rows = np.flatnonzero(mask) if rows is None else rows[mask[rows]]
+        if exclude:
+            excluded = [self._rows[i] for i in exclude if i in self._rows]
+            if excluded:
+                if rows is None:
+                    rows = np.arange(self._size)
+                rows = rows[~np.isin(rows, excluded)]
+        return rows
+
+    def search(self, query, k=10, filters=None, min_score=None, nprobe=None, exclude=None, include=None):
+        """
+        Return the k most similar items to ``query``.
+
+        Args:
+            query: Embedding to match (normalised internally)
+            k: Number of results
+            filters: {field: value or collection of values} pre-filter
+            min_score: Drop results with cosine similarity below this
+            nprobe: Clusters to scan once build_ivf() has been called
+                (None or 0 scans everything)
+            exclude: Item ids to leave out, e.g. the query item itself
+            include: Only score these item ids, e.g. the candidates of a
+                cheaper first stage such as ai_phash.HashIndex (IVF is
+                then skipped)
+
+        Returns:
+            List of (item_id, cosine similarity, metadata), best first
+        """
+        if self._size == 0 or k <= 0:
+            return []
+        query = normalize(np.asarray(query, dtype=np.float32).reshape(self.dims))
+        rows = self._candidate_rows(query, filters, nprobe, exclude, include)
+
+        if rows is None:
+            scores = self._matrix[:self._size] @ query
+        else:
+            if len(rows) == 0:
+                return []
+            scores = self._matrix[rows] @ query
+        return self._results(scores, rows, k, min_score)
+
+    def _results(self, scores, rows, k, min_score):
+        """Top-k (id, score, metadata) of scores over ``rows`` (None = all rows)"""
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        if min_score is not None:
+            top = top[scores[top] >= min_score]
+
+        results = []
+        for i in top:
+            row = int(i) if rows is None else int(rows[i])
+            results.append((self._ids[row], float(scores[i]), self._metadata[row]))
+        return results
+
+    def build_ivf(self, n_lists=None, iterations=10, seed=0):
+        """
+        Cluster the stored vectors with spherical k-means for approximate search.
+
+        Args:
+            n_lists: Number of clusters (defaults to about sqrt(n))
+            iterations: k-means iterations
+            seed: Random seed for centroid initialisation
+        """
+        if self._size == 0:
+            raise ValueError("Cannot build an IVF index over an empty index")
+        vectors = self._matrix[:self._size]
+        n_lists = min(n_lists or max(1, int(np.sqrt(self._size))), self._size)
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(self._size, n_lists, replace=False)].copy()
+
+        for _ in range(iterations):
+            assign = np.argmax(vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, vectors)
+            counts = np.bincount(assign, minlength=n_lists)
+            empty = counts == 0
+            # Re-seed empty clusters from random vectors so none go unused
+            sums[empty] = vectors[rng.choice(self._size, int(empty.sum()))]
+            centroids = normalize(sums)
+
+        self._centroids = centroids
+        self._assign[:self._size] = np.argmax(vectors @ centroids.T, axis=1)
+        return self
+
+    def drop_ivf(self):
+        self._centroids = None
+        self._assign[:] = -1
+
+    def save(self, path):
+        """Write the index to a .npz file"""
+        np.savez(path, **self._arrays())
+
+    def _arrays(self):
+        return dict(vectors=self._matrix[:self._size],
+                    ids=np.array(json.dumps(self.ids)),
+                    metadata=np.array(json.dumps(self._metadata[:self._size])),
+                    filter_fields=np.array(json.dumps(self.filter_fields)),
+                    centroids=self._centroids if self._centroids is not None
+                    else np.zeros((0, self.dims), np.float32))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path, allow_pickle=False)
+        vectors = data["vectors"]
+        index = cls(vectors.shape[1], json.loads(str(data["filter_fields"])), max(len(vectors), 1))
+        index.add_many(json.loads(str(data["ids"])), vectors, json.loads(str(data["metadata"])))
+        index._restore_ivf(data)
+        return index
+
+    def _restore_ivf(self, data):
+        if len(data["centroids"]):
+            self._centroids = data["centroids"]
+            self._assign[:self._size] = np.argmax(self._matrix[:self._size] @ self._centroids.T, axis=1)
+
+
+class MultiVectorIndex(VectorIndex):
+    """
+    Index of items that each have a small set of vectors, such as the
+    test-time augmentation views of ai_processor_enhanced, scored by
+    max-sim: the best cosine between any query vector and any of the
+    item's vectors.
+
+    The base index keeps each item's pooled vector (the mean of its
+    normalised views), so filters, IVF, include/exclude and metadata work
+    unchanged and choose the candidate rows. The views live in a parallel
+    (capacity, max_views, dims) array, padded by repeating an item's own
+    views, which never changes a max. Scoring is one matrix product over
+    the candidates' views; with ``shortlist``, only that many rows with
+    the best pooled score are re-scored, bounding the cost on large
+    indexes.
+
+    Queries may be single vectors, so stored items can carry views
+    computed offline (bulk --tta --views) while uploads are embedded with
+    one forward pass.
+
+    Args:
+        dims: Embedding dimensionality
+        max_views: Largest number of vectors per item
+        filter_fields: Metadata keys usable in search(filters=...)
+        capacity: Initial number of preallocated rows
+    """
+
+    def __init__(self, dims, max_views=4, filter_fields=("type", "category", "status"), capacity=1024):
+        super().__init__(dims, filter_fields, capacity)
+        self.max_views = max_views
+        self._views = np.zeros((capacity, max_views, dims), dtype=np.float32)
+        self._view_counts = np.zeros(capacity, dtype=np.int32)
+
+    def _grow(self, needed):
+        capacity = len(self._matrix)
+        super()._grow(needed)
+        if len(self._matrix) != capacity:
+            views = np.zeros((len(self._matrix), self.max_views, self.dims), dtype=np.float32)
+            views[:self._size] = self._views[:self._size]
+            self._views = views
+            counts = np.zeros(len(self._matrix), dtype=np.int32)
+            counts[:self._size] = self._view_counts[:self._size]
+            self._view_counts = counts
+
+    def add_many(self, item_ids, view_sets, metadatas=None):
+        """
+        Insert items from their vector sets: (views, dims) arrays, single
+        vectors (one view), or a (count, views, dims) array
+        """
+        sets = [normalize(np.asarray(views, dtype=np.float32).reshape(-1, self.dims)) for views in view_sets]
+        for views in sets:
+            if not 1 <= len(views) <= self.max_views:
+                raise ValueError(f"Items need 1 to {self.max_views} vectors, got {len(views)}")
+        pooled = np.stack([views.mean(axis=0) for views in sets]) if sets else np.zeros((0, self.dims))
+        super().add_many(item_ids, pooled, metadatas)
+        for item_id, views in zip(item_ids, sets):
+            row = self._rows[item_id]
+            self._views[row] = views[np.arange(self.max_views) % len(views)]
+            self._view_counts[row] = len(views)
+
+    def remove(self, item_id):
+        row = self._rows.get(item_id)
+        last = self._size - 1
+        if not super().remove(item_id):
+            return False
+        if row != last:
+            self._views[row] = self._views[last]
+            self._view_counts[row] = self._view_counts[last]
+        self._view_counts[last] = 0
+        return True
+
+    def item_views(self, item_id):
+        """An item's stored (views, dims) normalised vectors"""
+        row = self._rows[item_id]
+        return self._views[row, :self._view_counts[row]]
+
+    def search(self, query, k=10, filters=None, min_score=None, nprobe=None, exclude=None, include=None,
+               shortlist=None):
+        """
+        Return the k items with the best max-sim to ``query``.
+
+        Args:
+            query: One embedding or a (views, dims) set
+            shortlist: Re-score only this many candidates with the best
+                pooled score (None scores every candidate)
+            Other arguments as in VectorIndex.search
+
+        Returns:
+            List of (item_id, max-sim cosine, metadata), best first
+        """
+        if self._size == 0 or k <= 0:
+            return []
+        queries = normalize(np.asarray(query, dtype=np.float32).reshape(-1, self.dims))
+        pooled = normalize(queries.mean(axis=0))
+        rows = self._candidate_rows(pooled, filters, nprobe, exclude, include)
+        if rows is not None and len(rows) == 0:
+            return []
+        count = self._size if rows is None else len(rows)
+        if shortlist and count > shortlist:
+            coarse = self._matrix[:self._size] @ pooled if rows is None else self._matrix[rows] @ pooled
+            best = np.argpartition(-coarse, shortlist - 1)[:shortlist]
+            rows = best if rows is None else rows[best]
+            count = len(rows)
+
+        # A slice of the live rows is a view; only candidate subsets are gathered
+        views = self._views[:self._size] if rows is None else self._views[rows]
+        scores = (views.reshape(-1, self.dims) @ queries.T).reshape(count, -1).max(axis=1)
+        return self._results(scores, rows, k, min_score)
+
+    def _arrays(self):
+        return {**super()._arrays(), "views": self._views[:self._size],
+                "view_counts": self._view_counts[:self._size], "max_views": np.array(self.max_views)}
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path, allow_pickle=False)
+        views = data["views"]
+        index = cls(views.shape[2], int(data["max_views"]), json.loads(str(data["filter_fields"])),
+                    max(len(views), 1))
+        index.add_many(json.loads(str(data["ids"])),
+                       [item[:count] for item, count in zip(views, data["view_counts"])],
+                       json.loads(str(data["metadata"])))
+        index._restore_ivf(data)
+        return index
+
+
+def load_index(path):
+    """Load a .npz written by VectorIndex.save or MultiVectorIndex.save, whichever it is"""
+    with np.load(path, allow_pickle=False) as data:
+        multi = "views" in data.files
+    return (MultiVectorIndex if multi else VectorIndex).load(path)
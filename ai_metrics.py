@@ -0,0 +1,219 @@
+"""
+Per-request instrumentation for FinderAI processors
+Records stage durations and memory deltas, writes them to an optional
+metrics sink, and can profile the requests that turn out to be slow
+"""
+
+import sys
+import os
+import json
+import time
+import tempfile
+import resource
+import threading
+from contextlib import contextmanager, nullcontext
+
+METRICS_ENV = "FINDERAI_METRICS"
+LOG_FORMAT_ENV = "FINDERAI_LOG_FORMAT"
+PROFILE_ENV = "FINDERAI_PROFILE"
+PROFILE_SLOW_MS_ENV = "FINDERAI_PROFILE_SLOW_MS"
+PROFILE_DIR_ENV = "FINDERAI_PROFILE_DIR"
+
+PROFILERS = ("cprofile", "torch")
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+_sink_lock = threading.Lock()
+
+
+def rss_bytes():
+    """Current resident set size of this process (peak RSS where /proc is missing)"""
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def log(tag, message, **fields):
+    """
+    One progress line on stderr: ``[TAG] message key=value ...``.
+
+    With $FINDERAI_LOG_FORMAT=json the line is a JSON object instead, for
+    log collectors. stdout stays reserved for results.
+    """
+    if os.environ.get(LOG_FORMAT_ENV) == "json":
+        print(json.dumps({"tag": tag, "message": message, **fields}), file=sys.stderr)
+    else:
+        suffix = "".join(f" {key}={value}" for key, value in fields.items())
+        print(f"[{tag}] {message}{suffix}", file=sys.stderr)
+
+
+class Trace:
+    """
+    Stage timings and memory deltas for one request (or one startup).
+
+    Stages are recorded with ``with trace.stage("decode"): ...``; a stage
+    entered twice accumulates. Memory deltas are changes in the process
+    RSS across the stage, so concurrent requests in one process see each
+    other's allocations; durations are exact per request.
+
+    Args:
+        name: What is being traced ("vit", "worker"...), kept in the record
+        fields: Extra identifying fields for the metrics sink
+    """
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+        self.started = time.perf_counter()
+        self.seconds = {}
+        self.rss_delta = {}
+        self.elapsed = None
+
+    @contextmanager
+    def stage(self, stage):
+        rss = rss_bytes()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started, rss_bytes() - rss)
+
+    def record(self, stage, seconds, rss_delta=0):
+        """Add a stage measured elsewhere (e.g. model startup)"""
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.rss_delta[stage] = self.rss_delta.get(stage, 0) + rss_delta
+
+    @property
+    def elapsed_ms(self):
+        elapsed = self.elapsed if self.elapsed is not None else time.perf_counter() - self.started
+        return elapsed * 1000.0
+
+    def as_dict(self):
+        return {
+            "stages_ms": {stage: round(s * 1000.0, 3) for stage, s in self.seconds.items()},
+            "rss_delta_mb": {stage: round(b / (1024 * 1024), 2) for stage, b in self.rss_delta.items()},
+            "total_ms": round(self.elapsed_ms, 3),
+            "rss_mb": round(rss_bytes() / (1024 * 1024), 1)
+        }
+
+    def finish(self):
+        """Stop the clock and send the record to the metrics sink, if one is set"""
+        if self.elapsed is None:
+            self.elapsed = time.perf_counter() - self.started
+        emit({"trace": self.name, "timestamp": time.time(), "pid": os.getpid(),
+              **self.fields, **self.as_dict()})
+        return self
+
+
+def stage(trace, name):
+    """``trace.stage(name)``, or a no-op when no trace is being recorded"""
+    return trace.stage(name) if trace is not None else nullcontext()
+
+
+def emit(record):
+    """
+    Append one record to the metrics sink named by $FINDERAI_METRICS.
+
+    The sink is a JSON lines file, or "stderr" for ``[METRICS]`` log
+    lines; unset means records are dropped.
+    """
+    sink = os.environ.get(METRICS_ENV)
+    if not sink:
+        return
+    line = json.dumps(record, default=str)
+    if sink == "stderr":
+        print(f"[METRICS] {line}", file=sys.stderr)
+        return
+    with _sink_lock:
+        with open(sink, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+def with_timings(body, trace):
+    """
+    Append ``"timings"`` to an already serialised JSON object when a
+    metrics sink is configured ($FINDERAI_METRICS).
+
+    Unset, the body is returned as is, so one-shot CLI output stays
+    byte-for-byte what callers parsed before. Appending to the string
+    lets the serialisation stage itself appear in the result without
+    serialising the embedding twice.
+    """
+    if not os.environ.get(METRICS_ENV):
+        return body
+    return body[:-1] + ', "timings": ' + json.dumps(trace.as_dict()) + "}"
+
+
+class SlowRequestProfiler:
+    """
+    Opt-in profiler that keeps traces only for slow requests.
+
+    Every request runs under the profiler while it is enabled; when the
+    request took at least ``slow_ms``, the profile is written to
+    ``directory`` and its path recorded on the trace. "cprofile" dumps
+    pstats files (``python -m pstats`` / snakeviz), "torch" dumps Chrome
+    traces of operator timings (chrome://tracing, Perfetto).
+
+    Args:
+        kind: "cprofile", "torch" or None (default $FINDERAI_PROFILE)
+        slow_ms: Threshold (default $FINDERAI_PROFILE_SLOW_MS or 1000)
+        directory: Output directory (default $FINDERAI_PROFILE_DIR or a
+            finderai-profiles directory under the system temp dir)
+    """
+
+    def __init__(self, kind=None, slow_ms=None, directory=None):
+        kind = kind if kind is not None else os.environ.get(PROFILE_ENV) or None
+        if kind is not None and kind not in PROFILERS:
+            raise ValueError(f"Unknown profiler '{kind}', expected one of {', '.join(PROFILERS)}")
+        self.kind = kind
+        self.slow_ms = float(slow_ms if slow_ms is not None else os.environ.get(PROFILE_SLOW_MS_ENV, 1000))
+        self.directory = directory or os.environ.get(PROFILE_DIR_ENV) or \
+            os.path.join(tempfile.gettempdir(), "finderai-profiles")
+        # cProfile allows one active profiler per thread and the torch
+        # profiler one per process; concurrent requests go unprofiled
+        self._busy = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.kind is not None
+
+    @contextmanager
+    def profile(self, trace):
+        if not self.enabled or not self._busy.acquire(blocking=False):
+            yield
+            return
+        try:
+            if self.kind == "cprofile":
+                import cProfile
+                profiler = cProfile.Profile()
+                profiler.enable()
+                try:
+                    yield
+                finally:
+                    profiler.disable()
+                    if trace.elapsed_ms >= self.slow_ms:
+                        path = self._path(trace, "prof")
+                        profiler.dump_stats(path)
+                        self._report(trace, path)
+            else:
+                import torch
+                with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU],
+                                            record_shapes=True) as profiler:
+                    yield
+                if trace.elapsed_ms >= self.slow_ms:
+                    path = self._path(trace, "json")
+                    profiler.export_chrome_trace(path)
+                    self._report(trace, path)
+        finally:
+            self._busy.release()
+
+    def _path(self, trace, ext):
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        return os.path.join(self.directory, f"{trace.name}-{stamp}-{os.getpid()}-{id(trace):x}.{ext}")
+
+    def _report(self, trace, path):
+        trace.fields["profile"] = path
+        log("PROFILE", f"Slow {trace.name} request profiled", ms=round(trace.elapsed_ms, 1), path=path)
@@ -0,0 +1,361 @@
+"""
+Perceptual hashes for FinderAI near-duplicate detection
+Computes pHash/dHash from the already-resized model input and finds
+near-identical uploads by Hamming radius with a multi-index hash table
+"""
+
+import sys
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from functools import lru_cache
+from itertools import combinations
+import numpy as np
+from PIL import Image
+
+HASH_BITS = 64
+KINDS = ("phash", "dhash")
+
+# ITU-R 601 luma weights
+_LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+@lru_cache(maxsize=None)
+def _dct_matrix(size):
+    """Orthonormal DCT-II basis, one frequency per row"""
+    n = np.arange(size)
+    matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size)) * np.sqrt(2.0 / size)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix.astype(np.float32)
+
+
+@lru_cache(maxsize=None)
+def _area_matrix(size, length):
+    """(size, length) matrix averaging ``length`` samples into ``size`` equal-area bins"""
+    edges = np.linspace(0, length, size + 1)
+    positions = np.arange(length + 1)
+    # Overlap of each input sample [j, j + 1) with each output bin
+    overlap = np.clip(np.minimum(edges[1:, None], positions[None, 1:])
+                      - np.maximum(edges[:-1, None], positions[None, :-1]), 0, None)
+    return (overlap / overlap.sum(axis=1, keepdims=True)).astype(np.float32)
+
+
+def _resize(gray, height, width):
+    return _area_matrix(height, gray.shape[0]) @ gray @ _area_matrix(width, gray.shape[1]).T
+
+
+def gray_thumbnail(image, size=32):
+    """
+    Area-averaged size x size luminance thumbnail.
+
+    Args:
+        image: PIL image, (H, W, 3) RGB array (e.g. ai_processor_enhanced_backup
+            load_image), or a (3, H, W) model input tensor/array. Normalised
+            tensors give a per-channel affine of luma, which changes no
+            hash bit when the normalisation is the same for every channel
+            (ViT) and very few otherwise (ImageNet); hashes are only
+            compared within one embedder's inputs anyway. A (views, 3, H, W)
+            test-time augmentation batch is hashed by its first view.
+    """
+    if isinstance(image, Image.Image):
+        image = image.convert("RGB")
+    array = np.asarray(image)
+    if array.ndim == 4:
+        array = array[0]
+    if array.ndim == 3 and array.shape[0] == 3 and array.shape[-1] != 3:
+        # Shrink along width first with one GEMM over all channels, then mix
+        # to luma on the narrow result
+        _, height, width = array.shape
+        narrow = np.asarray(array, dtype=np.float32).reshape(3 * height, width) @ _area_matrix(size, width).T
+        gray = np.tensordot(_LUMA, narrow.reshape(3, height, size), axes=1)
+        return _area_matrix(size, height) @ gray
+    if array.ndim == 3:
+        height, width, channels = array.shape
+        short = _area_matrix(size, height) @ np.asarray(array, dtype=np.float32).reshape(height, width * channels)
+        gray = short.reshape(size, width, channels)[..., :3] @ _LUMA
+        return gray @ _area_matrix(size, width).T
+    return _resize(np.asarray(array, dtype=np.float32), size, size)
+
+
+_WEIGHTS = 1 << np.arange(63, -1, -1, dtype=np.uint64)
+
+
+def _pack(bits):
+    return int(_WEIGHTS[bits.ravel()].sum())
+
+
+def phash(thumbnail):
+    """64-bit DCT hash: the 8x8 lowest frequencies compared with their median (DC excluded)"""
+    dct = _dct_matrix(len(thumbnail))[:8]
+    low = (dct @ thumbnail @ dct.T).ravel()
+    # Median of the 63 AC terms
+    return _pack(low > np.partition(low[1:], 31)[31])
+
+
+def dhash(thumbnail):
+    """64-bit gradient hash: is each of 9x8 area samples brighter than its right neighbour"""
+    small = _resize(thumbnail, 8, 9)
+    return _pack(small[:, 1:] > small[:, :-1])
+
+
+def image_hashes(image):
+    """{"phash": int, "dhash": int} for anything gray_thumbnail() accepts"""
+    thumbnail = gray_thumbnail(image)
+    return {"phash": phash(thumbnail), "dhash": dhash(thumbnail)}
+
+
+def hamming(first, second):
+    return (first ^ second).bit_count()
+
+
+def to_hex(value):
+    return f"{value:016x}"
+
+
+@lru_cache(maxsize=None)
+def _flips(bits, radius):
+    """All masks over ``bits`` bits with at most ``radius`` bits set"""
+    masks = [0]
+    for weight in range(1, radius + 1):
+        for positions in combinations(range(bits), weight):
+            mask = 0
+            for position in positions:
+                mask |= 1 << position
+            masks.append(mask)
+    return tuple(masks)
+
+
+class HashIndex:
+    """
+    Multi-index hashing for Hamming-radius queries over 64-bit hashes.
+
+    Each hash is split into ``chunks`` substrings with one exact-match
+    table per substring. Two hashes within distance r agree to within
+    r // chunks bits on at least one substring (pigeonhole), so a query
+    probes every table with the substrings at most that far from its own,
+    then checks the full distance of the few candidates found. With 4
+    chunks of 16 bits a radius-10 query is about 550 dict probes,
+    whatever the number of items.
+
+    Args:
+        chunks: Substrings per hash; must divide 64
+    """
+
+    def __init__(self, chunks=4):
+        if HASH_BITS % chunks:
+            raise ValueError(f"chunks must divide {HASH_BITS}, got {chunks}")
+        self.chunks = chunks
+        self.chunk_bits = HASH_BITS // chunks
+        self._mask = (1 << self.chunk_bits) - 1
+        self._tables = [{} for _ in range(chunks)]
+        self._hashes = {}
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __contains__(self, item_id):
+        return item_id in self._hashes
+
+    def _split(self, value):
+        return [(value >> (i * self.chunk_bits)) & self._mask for i in range(self.chunks)]
+
+    def add(self, item_id, value):
+        """Insert an item, replacing any existing entry with the same id"""
+        self.remove(item_id)
+        value = int(value)
+        self._hashes[item_id] = value
+        for table, chunk in zip(self._tables, self._split(value)):
+            table.setdefault(chunk, set()).add(item_id)
+
+    def remove(self, item_id):
+        """Remove an item; returns False if it was not indexed"""
+        value = self._hashes.pop(item_id, None)
+        if value is None:
+            return False
+        for table, chunk in zip(self._tables, self._split(value)):
+            bucket = table[chunk]
+            bucket.discard(item_id)
+            if not bucket:
+                del table[chunk]
+        return True
+
+    def get(self, item_id):
+        return self._hashes.get(item_id)
+
+    def query(self, value, radius, limit=None):
+        """
+        Items within Hamming ``radius`` of ``value``.
+
+        Returns:
+            List of (item_id, distance), nearest first
+        """
+        value = int(value)
+        flips = _flips(self.chunk_bits, radius // self.chunks)
+        seen = set()
+        results = []
+        for table, chunk in zip(self._tables, self._split(value)):
+            for flip in flips:
+                for item_id in table.get(chunk ^ flip, ()):
+                    if item_id not in seen:
+                        seen.add(item_id)
+                        distance = (self._hashes[item_id] ^ value).bit_count()
+                        if distance <= radius:
+                            results.append((distance, item_id))
+        results.sort(key=lambda result: result[0])
+        return [(item_id, distance) for distance, item_id in results[:limit]]
+
+    def candidates(self, value, radius):
+        """Ids within ``radius``, for VectorIndex.search(include=...) as a first stage"""
+        return [item_id for item_id, _ in self.query(value, radius)]
+
+    def save(self, path):
+        """Write the index to a .npz file"""
+        np.savez(path, ids=np.array(json.dumps(list(self._hashes))),
+                 hashes=np.array(list(self._hashes.values()), dtype=np.uint64),
+                 chunks=np.array(self.chunks))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path, allow_pickle=False)
+        index = cls(int(data["chunks"]))
+        for item_id, value in zip(json.loads(str(data["ids"])), data["hashes"].tolist()):
+            index.add(item_id, value)
+        return index
+
+
+class NearDuplicateFilter:
+    """
+    Remembers recent embeddings by perceptual hash so near-identical
+    uploads reuse a stored vector instead of running the model.
+
+    Thread-safe; keeps at most ``max_items`` entries, evicting the oldest.
+    reserve() checks and claims a hash in one step, so near-identical
+    uploads arriving together run the model once: the first reserves a
+    pending entry and the others wait for its vector, up to ``wait``
+    seconds before embedding themselves.
+
+    Args:
+        radius: Largest Hamming distance treated as a duplicate (of 64 bits)
+        kind: "phash" (robust to re-encoding and small resizes) or "dhash"
+        max_items: Bound on remembered vectors
+        wait: Longest wait, in seconds, for a pending near duplicate
+    """
+
+    def __init__(self, radius=4, kind="phash", max_items=100000, wait=10.0):
+        if kind not in KINDS:
+            raise ValueError(f"Unknown hash '{kind}', expected one of {', '.join(KINDS)}")
+        self.radius = radius
+        self.kind = kind
+        self.max_items = max_items
+        self.wait = wait
+        self.index = HashIndex()
+        self._vectors = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._next = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _match(self, hashes):
+        """(ref, distance, vector or pending Future) of the nearest entry; lock held"""
+        found = self.index.query(hashes[self.kind], self.radius, limit=1)
+        if not found:
+            self.misses += 1
+            return None
+        key, distance = found[0]
+        self.hits += 1
+        ref, vector = self._vectors[key]
+        return ref, distance, vector
+
+    def _insert(self, hashes, vector, ref):
+        key = self._next
+        self._next += 1
+        self.index.add(key, hashes[self.kind])
+        self._vectors[key] = (ref, vector)
+        while len(self._vectors) > self.max_items:
+            oldest, _ = self._vectors.popitem(last=False)
+            self.index.remove(oldest)
+        return key
+
+    def add(self, hashes, vector, ref=None):
+        with self._lock:
+            self._insert(hashes, vector, ref)
+
+    def reserve(self, hashes, ref=None):
+        """
+        Find a near duplicate, or claim this upload's hash while it is embedded.
+
+        Returns:
+            (match, key): match is (ref, distance, vector) when a near
+            duplicate exists (waiting for it if it is still being
+            embedded), else None and ``key`` must be passed to fulfil()
+            with the vector, or to fulfil(key, None) if embedding fails.
+            (None, None) when the near duplicate failed to embed or was
+            not ready within ``wait`` seconds: embed without reserving.
+        """
+        with self._lock:
+            match = self._match(hashes)
+            key = None
+            if match is None:
+                key = self._insert(hashes, Future(), ref)
+                self._pending[key] = self._vectors[key][1]
+        if match is not None and isinstance(match[2], Future):
+            try:
+                return match[:2] + (match[2].result(timeout=self.wait),), None
+            except (RuntimeError, FutureTimeoutError):
+                # A stalled or failed source must not hold this request too
+                return None, None
+        return match, key
+
+    def fulfil(self, key, vector):
+        """Store the vector of a reserved entry (None drops it, failing its waiters)"""
+        with self._lock:
+            # Kept apart from _vectors so waiters are released even if the
+            # entry was evicted meanwhile
+            pending = self._pending.pop(key, None)
+            if key in self._vectors:
+                if vector is None:
+                    del self._vectors[key]
+                    self.index.remove(key)
+                else:
+                    self._vectors[key] = (self._vectors[key][0], vector)
+        if pending is not None:
+            if vector is None:
+                pending.set_exception(RuntimeError("Near-duplicate source failed to embed"))
+            else:
+                pending.set_result(vector)
+
+    def stats(self):
+        return {"kind": self.kind, "radius": self.radius, "items": len(self._vectors),
+                "hits": self.hits, "misses": self.misses}
+
+
+def main():
+    import argparse
+    from ai_processor_enhanced_backup import load_image
+
+    parser = argparse.ArgumentParser(description="Perceptual hashes and near-duplicate groups of images")
+    parser.add_argument("images", nargs="+")
+    parser.add_argument("--kind", choices=KINDS, default="phash")
+    parser.add_argument("--radius", type=int, default=4, help="Largest Hamming distance of a duplicate")
+    args = parser.parse_args()
+
+    index = HashIndex()
+    for path in args.images:
+        try:
+            hashes = image_hashes(load_image(path))
+        except Exception as e:
+            print(json.dumps({"image": path, "success": False, "error": str(e)}))
+            continue
+        matches = index.query(hashes[args.kind], args.radius)
+        index.add(path, hashes[args.kind])
+        print(json.dumps({"image": path, "success": True,
+                          **{kind: to_hex(value) for kind, value in hashes.items()},
+                          "near_duplicates": [{"image": other, "distance": distance}
+                                              for other, distance in matches]}))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,460 @@
+"""
+Multi-process embedding worker pool for FinderAI
+A supervisor process runs a fixed number of ViT workers, each with a
+bounded torch thread pool and its own pipe, and answers with a fast
+"busy" reply when the bounded request queue is full instead of piling
+up work
+"""
+
+import sys
+import os
+import time
+import signal
+import argparse
+import threading
+import multiprocessing
+from collections import deque
+from multiprocessing.connection import wait
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from ai_worker import EmbeddingWorker
+from ai_embedders import available_embedders
+from ai_backends import BACKENDS, THREADS_ENV, INTEROP_THREADS_ENV
+
+MODEL_NAME = "ViT-Base-Patch16-224 (timm)"
+
+
+class PoolBusy(Exception):
+    """Raised by WorkerPool.submit() when the request queue is full"""
+
+
+def _memory(pid):
+    """Resident and file-backed (shareable) memory of a process in MB, Linux only"""
+    try:
+        with open(f"/proc/{pid}/status", "r", encoding="utf-8") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return {}
+    memory = {}
+    for field, name in (("VmRSS", "rss_mb"), ("RssFile", "rss_file_mb"), ("RssShmem", "rss_shmem_mb")):
+        if field in fields:
+            memory[name] = round(int(fields[field].split()[0]) / 1024, 1)
+    return memory
+
+
+def _worker_main(index, threads, embedder, options, conn):
+    """Entry point of one pool process: load the model once, then serve tasks from ``conn``"""
+    # Bound every thread pool before torch (and its OpenMP runtime) loads
+    for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", THREADS_ENV):
+        os.environ[name] = str(threads)
+    os.environ[INTEROP_THREADS_ENV] = "1"
+    # Ctrl-C goes to the whole process group; the supervisor decides when we stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    from ai_cache import open_cache
+
+    options = dict(options)
+    cache = open_cache(options.pop("cache", None))
+    try:
+        if embedder == "vit":
+            # Same replies as the one-shot ViT CLI
+            from ai_processor_enhanced import ViTProcessor, model_name, result_builder
+            processor = ViTProcessor(cache=cache, **options)
+            worker = EmbeddingWorker(processor, result_builder(processor), model_name(processor))
+        else:
+            from ai_embedders import get_embedder
+            processor = get_embedder(embedder, cache=cache, **options)
+            processor.processor
+            worker = EmbeddingWorker(processor, processor.build_result, processor.model_id)
+    except Exception as e:
+        conn.send(("failed", str(e)))
+        return
+    conn.send(("ready", os.getpid()))
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        request_id, request = task
+        try:
+            reply = worker.handle(request)
+        except Exception as e:
+            reply = {"success": False, "error": str(e)}
+        conn.send(("done", request_id, reply))
+
+
+class WorkerPool:
+    """
+    Fixed pool of embedding processes behind one bounded queue.
+
+    The supervisor hands each request to an idle worker over that
+    worker's own pipe, so work goes to whichever worker frees up first
+    and the supervisor always knows which request each worker holds. At
+    most ``max_queue`` requests wait on top of the ones being processed;
+    submit() raises PoolBusy beyond that. A worker that dies is restarted
+    with a new pipe and the request it held fails with an error; no
+    other worker's channel is touched.
+
+    Each worker loads its own ViTProcessor (or the registered
+    ``embedder``) with ``threads`` intra-op threads. Passing a .pt
+    ``snapshot`` (see ViTProcessor) lets all workers memory-map the same
+    weight file, so the fp32 weights sit once in the page cache rather
+    than once per worker.
+
+    Args:
+        workers: Number of processes
+        threads: torch threads per worker (default: cores / workers)
+        max_queue: Requests allowed to wait for a free worker
+        processor_options: ViTProcessor keyword arguments (backend,
+            weights, snapshot, fast_preprocess, projection, tta) plus
+            "cache", a cache path
+        start_timeout: Seconds to wait for all workers to load
+        embedder: "vit" for ViTProcessor with the one-shot CLI's replies,
+            or another ai_embedders name (its options then apply)
+    """
+
+    def __init__(self, workers=2, threads=None, max_queue=None, processor_options=None,
+                 start_timeout=300.0, embedder="vit"):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self.workers = workers
+        self.threads = threads or max(1, (os.cpu_count() or 1) // workers)
+        self.max_queue = max_queue if max_queue is not None else 2 * workers
+        self.options = dict(processor_options or {})
+        self.start_timeout = start_timeout
+        self.embedder = embedder
+
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._pending = {}
+        self._next_id = 0
+        self._processes = [None] * workers
+        self._conns = [None] * workers
+        self._current = [None] * workers
+        self._ready = [threading.Event() for _ in range(workers)]
+        self._handled = [0] * workers
+        self._errors = {}
+        self.restarts = 0
+        self.rejected = 0
+        self.completed = 0
+        self._closing = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    # ---------- lifecycle ----------
+
+    def start(self):
+        """Spawn all workers and wait until each has loaded its model"""
+        snapshot = self.options.get("snapshot") or os.environ.get("FINDERAI_VIT_SNAPSHOT")
+        if self.embedder == "vit" and (not snapshot or snapshot.endswith(".safetensors")):
+            print("[POOL] Workers hold private weight copies; pass a .pt --snapshot "
+                  "to share them through the page cache", file=sys.stderr)
+
+        for index in range(self.workers):
+            self._spawn(index)
+        self._thread = threading.Thread(target=self._run, name="pool-io", daemon=True)
+        self._thread.start()
+
+        deadline = time.monotonic() + self.start_timeout
+        for index, ready in enumerate(self._ready):
+            while not ready.wait(0.2):
+                if index in self._errors:
+                    self.close()
+                    raise RuntimeError(f"Worker {index} failed to start: {self._errors[index]}")
+                if time.monotonic() > deadline:
+                    self.close()
+                    raise RuntimeError(f"Worker {index} did not start within {self.start_timeout:g}s")
+        print(f"[POOL] {self.workers} workers ready, {self.threads} threads each, "
+              f"queue of {self.max_queue}", file=sys.stderr)
+        return self
+
+    def _spawn(self, index):
+        self._ready[index].clear()
+        self._errors.pop(index, None)
+        conn, child = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main, name=f"embed-worker-{index}",
+            args=(index, self.threads, self.embedder, self.options, child), daemon=True)
+        process.start()
+        # Only the worker holds the other end, so its exit reads as EOF here
+        child.close()
+        with self._lock:
+            self._processes[index] = process
+            self._conns[index] = conn
+
+    def close(self, timeout=10.0):
+        """Stop accepting work, let workers finish their current request and exit"""
+        if self._closing.is_set():
+            return
+        self._closing.set()
+        with self._lock:
+            queued = list(self._queue)
+            self._queue.clear()
+            for conn in self._conns:
+                if conn is not None:
+                    try:
+                        conn.send(None)
+                    except OSError:
+                        pass
+        for request_id, _ in queued:
+            self._resolve(request_id, {"success": False, "error": "Worker pool stopped"})
+        deadline = time.monotonic() + timeout
+        for process in self._processes:
+            if process is not None:
+                process.join(max(0.0, deadline - time.monotonic()))
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+        # The I/O thread has now seen every reply sent before the workers exited
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            for index, conn in enumerate(self._conns):
+                if conn is not None:
+                    conn.close()
+                    self._conns[index] = None
+        for future in pending.values():
+            if not future.done():
+                future.set_result({"success": False, "error": "Worker pool stopped"})
+        print("[POOL] Stopped", file=sys.stderr)
+
+    # ---------- requests ----------
+
+    def submit(self, request):
+        """
+        Hand one worker request (see ai_worker.EmbeddingWorker) to an idle
+        worker, or queue it.
+
+        Returns:
+            Future resolving to the reply dict
+
+        Raises:
+            PoolBusy: the queue is full; callers should answer "busy" at once
+        """
+        future = Future()
+        with self._lock:
+            if self._closing.is_set():
+                raise RuntimeError("Worker pool is closed")
+            request_id = self._next_id
+            self._next_id += 1
+            index = self._idle_worker()
+            if index is None and len(self._queue) >= self.max_queue:
+                self.rejected += 1
+                raise PoolBusy(f"All {self.workers} workers busy and {self.max_queue} requests queued")
+            self._pending[request_id] = future
+            if index is None:
+                self._queue.append((request_id, request))
+            else:
+                self._send(index, request_id, request)
+        return future
+
+    def _idle_worker(self):
+        for index, request_id in enumerate(self._current):
+            if request_id is None and self._conns[index] is not None and self._ready[index].is_set():
+                return index
+        return None
+
+    def _send(self, index, request_id, request):
+        """Hand a request to worker ``index``; called with the lock held"""
+        # Recorded before sending, so a crash at any point after this fails this request
+        self._current[index] = request_id
+        try:
+            self._conns[index].send((request_id, request))
+        except OSError:
+            # The worker is gone; the I/O thread restarts it and fails the request
+            pass
+
+    def _dispatch(self, index):
+        """Give worker ``index`` the next queued request, if any; called with the lock held"""
+        if self._queue and not self._closing.is_set():
+            self._send(index, *self._queue.popleft())
+
+    def _resolve(self, request_id, reply):
+        with self._lock:
+            future = self._pending.pop(request_id, None)
+            self.completed += 1
+        if future is not None and not future.done():
+            future.set_result(reply)
+
+    def _run(self):
+        """Read worker replies and watch for exits until the pool is stopped"""
+        while not self._stopped.is_set():
+            with self._lock:
+                conns = {conn: index for index, conn in enumerate(self._conns) if conn is not None}
+                sentinels = {self._processes[index].sentinel: index for index in conns.values()}
+            ready = wait(list(conns) + list(sentinels), timeout=0.2)
+            # Replies first: a worker may send its last one and then exit
+            for conn in ready:
+                if conn in conns:
+                    try:
+                        message = conn.recv()
+                    except (EOFError, OSError):
+                        continue
+                    self._handle(conns[conn], message)
+            for sentinel in ready:
+                if sentinel in sentinels:
+                    self._exited(sentinels[sentinel])
+
+    def _handle(self, index, message):
+        kind = message[0]
+        if kind == "ready":
+            print(f"[POOL] Worker {index} ready (pid {message[1]})", file=sys.stderr)
+            with self._lock:
+                self._ready[index].set()
+                self._dispatch(index)
+        elif kind == "failed":
+            self._errors[index] = message[1]
+        elif kind == "done":
+            with self._lock:
+                self._current[index] = None
+                self._handled[index] += 1
+            self._resolve(message[1], message[2])
+            with self._lock:
+                if self._current[index] is None:
+                    self._dispatch(index)
+
+    def _exited(self, index):
+        process = self._processes[index]
+        process.join()
+        with self._lock:
+            request_id, self._current[index] = self._current[index], None
+            self._conns[index].close()
+            self._conns[index] = None
+        if request_id is not None:
+            self._resolve(request_id, {"success": False,
+                                       "error": f"Worker exited with code {process.exitcode}"})
+        if self._closing.is_set() or index in self._errors:
+            return
+        print(f"[POOL] Worker {index} exited with code {process.exitcode}; restarting",
+              file=sys.stderr)
+        self.restarts += 1
+        self._spawn(index)
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+            queued = len(self._queue)
+        workers = []
+        for index, process in enumerate(self._processes):
+            alive = process is not None and process.is_alive()
+            workers.append({
+                "index": index,
+                "pid": process.pid if process is not None else None,
+                "alive": alive,
+                "ready": self._ready[index].is_set(),
+                "busy": self._current[index] is not None,
+                "handled": self._handled[index],
+                **(_memory(process.pid) if alive else {})
+            })
+        return {
+            "workers": workers,
+            "threads_per_worker": self.threads,
+            "max_queue": self.max_queue,
+            "pending": pending,
+            "queued": queued,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "restarts": self.restarts
+        }
+
+
+class PoolSupervisor(EmbeddingWorker):
+    """
+    EmbeddingWorker front end that forwards embed requests to a WorkerPool.
+
+    Speaks the same JSON-lines protocol on stdio or a Unix socket. When
+    the pool queue is full the reply is immediate:
+        {"success": false, "busy": true, "error": "..."}
+    """
+
+    def __init__(self, pool, timeout=60.0):
+        super().__init__(None, None, MODEL_NAME)
+        self.pool = pool
+        self.timeout = timeout
+
+    def max_concurrency(self):
+        # One more than the pool can hold so overflow gets its busy reply
+        return self.pool.workers + self.pool.max_queue + 1
+
+    def health(self):
+        return {**super().health(), "pool": self.pool.stats()}
+
+    def handle(self, request):
+        if not isinstance(request, dict) or request.get("op", "embed") != "embed":
+            return super().handle(request)
+        try:
+            future = self.pool.submit(request)
+        except PoolBusy as e:
+            return {"success": False, "busy": True, "error": str(e)}
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            # Before Python 3.11 this is not the builtin TimeoutError
+            return {"success": False, "error": f"Timed out after {self.timeout:g}s"}
+
+    def close(self):
+        self.pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Supervised pool of ViT embedding workers")
+    parser.add_argument("--workers", type=int, default=2, help="Worker processes")
+    parser.add_argument("--threads", type=int,
+                        help="torch threads per worker (default: cores / workers)")
+    parser.add_argument("--max-queue", type=int,
+                        help="Requests waiting for a worker before replying busy (default: 2 x workers)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds to wait for one embedding")
+    parser.add_argument("--socket", metavar="PATH", help="Listen on this Unix socket instead of stdin")
+    parser.add_argument("--backend", choices=BACKENDS,
+                        help="Inference backend (default: $FINDERAI_BACKEND or fp32)")
+    parser.add_argument("--snapshot", metavar="FILE",
+                        help=".pt state_dict snapshot memory-mapped by every worker "
+                             "(default: $FINDERAI_VIT_SNAPSHOT)")
+    parser.add_argument("--weights", metavar="FILE", help="Local pretrained checkpoint")
+    parser.add_argument("--cache", metavar="FILE",
+                        help="Embedding cache database shared by the workers")
+    parser.add_argument("--fast-preprocess", action="store_true", default=None,
+                        help="Reduced-scale JPEG decode and NumPy normalisation")
+    parser.add_argument("--projection", metavar="FILE",
+                        help="Emit compact vectors (see ai_projection)")
+    parser.add_argument("--tta", metavar="VIEWS",
+                        help="Mean-pool these test-time augmentation views, e.g. center,flip")
+    parser.add_argument("--embedder", default="vit", choices=available_embedders(),
+                        help="Registered embedder run by the workers (default: vit, with the "
+                             "one-shot CLI's replies)")
+    args = parser.parse_args()
+
+    options = {name: value for name, value in (
+        ("backend", args.backend), ("snapshot", args.snapshot), ("weights", args.weights),
+        ("cache", args.cache), ("fast_preprocess", args.fast_preprocess),
+        ("projection", args.projection), ("tta", args.tta)) if value is not None}
+    if args.embedder != "vit":
+        # vit-only options; classical has no torch backend or projection either
+        unsupported = sorted(set(options) - {"cache", "fast_preprocess"}
+                             - (set() if args.embedder == "classical" else {"backend", "projection"}))
+        if unsupported:
+            parser.error(f"--embedder {args.embedder} does not take "
+                         + ", ".join("--" + name.replace("_", "-") for name in unsupported))
+    pool = WorkerPool(args.workers, args.threads, args.max_queue, options, embedder=args.embedder)
+    try:
+        pool.start()
+    except Exception as e:
+        print(f"[ERROR] {e}", file=sys.stderr)
+        sys.exit(1)
+
+    supervisor = PoolSupervisor(pool, args.timeout)
+    supervisor.install_signal_handlers()
+    if args.socket:
+        supervisor.serve_socket(args.socket)
+    else:
+        supervisor.serve_stdio()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Image decoding and preprocessing for FinderAI processors
+Reduced-scale JPEG decoding, optional EXIF orientation and a NumPy-native
+resize/crop/normalise path that replaces the per-image torchvision Compose
+"""
+
+import io
+import os
+import math
+import numpy as np
+from PIL import Image, ImageOps
+
+FAST_ENV = "FINDERAI_FAST_PREPROCESS"
+EXIF_ENV = "FINDERAI_EXIF_TRANSPOSE"
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+# Test-time augmentation views FastTransform.views() can cut from one decode
+TTA_VIEWS = ("center", "flip", "wide", "top_left", "top_right", "bottom_left", "bottom_right")
+
+INTERPOLATIONS = {
+    "nearest": Image.NEAREST,
+    "bilinear": Image.BILINEAR,
+    "bicubic": Image.BICUBIC,
+    "lanczos": Image.LANCZOS,
+}
+
+
+def parse_views(value):
+    """TTA views from "center,flip" or a sequence; None when empty"""
+    if not value:
+        return None
+    names = tuple(v.strip() for v in value.split(",")) if isinstance(value, str) else tuple(value)
+    names = tuple(name for name in names if name)
+    unknown = [name for name in names if name not in TTA_VIEWS]
+    if unknown:
+        raise ValueError(f"Unknown view(s) {', '.join(unknown)}, expected some of {', '.join(TTA_VIEWS)}")
+    return names or None
+
+
+def fast_preprocess_default():
+    return os.environ.get(FAST_ENV, "").lower() in ("1", "true", "yes", "on")
+
+
+def exif_transpose_default():
+    return os.environ.get(EXIF_ENV, "").lower() in ("1", "true", "yes", "on")
+
+
+def is_buffer(source):
+    return isinstance(source, (bytes, bytearray, memoryview))
+
+
+def read_bytes(source):
+    """Raw encoded bytes of an image path or in-memory buffer"""
+    if is_buffer(source):
+        return bytes(source)
+    with open(source, "rb") as f:
+        return f.read()
+
+
+def open_image(source, min_size=None, exif=None):
+    """
+    Decode an image to an RGB PIL image.
+
+    Args:
+        source: File path, encoded bytes (bytes, bytearray or memoryview)
+            or a binary file object
+        min_size: Smallest side length the caller needs. JPEGs are then
+            decoded at the largest 1/2, 1/4 or 1/8 DCT scale that still
+            covers it, which skips most of the work on phone photos.
+        exif: Rotate the image upright per its EXIF orientation tag
+            (default $FINDERAI_EXIF_TRANSPOSE). Off by default: it changes
+            the embeddings of rotated photos, so processors only turn it
+            on together with an "exif" cache namespace marker.
+
+    Returns:
+        PIL.Image in RGB mode
+    """
+    image = Image.open(io.BytesIO(source) if is_buffer(source) else source)
+    if min_size:
+        # draft() only ever reduces by whole DCT scales, keeping both
+        # sides >= the request; it is a no-op for non-JPEG formats
+        image.draft("RGB", (min_size, min_size))
+    if exif_transpose_default() if exif is None else exif:
+        image = ImageOps.exif_transpose(image)
+    return image.convert("RGB")
+
+
+def resize_shorter(image, size, resample=Image.BILINEAR):
+    """Resize so the shorter side is ``size`` (torchvision Resize(int) rounding)"""
+    width, height = image.size
+    if width <= height:
+        new_size = (size, int(size * height / width))
+    else:
+        new_size = (int(size * width / height), size)
+    if new_size == image.size:
+        return image
+    return image.resize(new_size, resample)
+
+
+def center_crop(image, size):
+    """Centre crop to size x size (torchvision CenterCrop rounding)"""
+    width, height = image.size
+    left = int(round((width - size) / 2.0))
+    top = int(round((height - size) / 2.0))
+    return image.crop((left, top, left + size, top + size))
+
+
+class FastTransform:
+    """
+    NumPy replacement for Resize -> CenterCrop -> ToTensor -> Normalize.
+
+    Resizing and cropping are the same PIL calls torchvision makes, so the
+    output matches the Compose pipeline to float rounding; the scale and
+    normalisation are folded into one multiply-add on a CHW float32 array.
+
+    Args:
+        resize: Shorter-side size before cropping
+        crop: Output side length
+        mean: Per-channel mean in [0, 1] units
+        std: Per-channel standard deviation in [0, 1] units
+        interpolation: PIL resampling filter
+    """
+
+    def __init__(self, resize, crop, mean, std, interpolation=Image.BILINEAR):
+        self.resize = resize
+        self.crop = crop
+        self.interpolation = interpolation
+        std = np.asarray(std, dtype=np.float32)
+        self._scale = (1.0 / (255.0 * std)).reshape(3, 1, 1)
+        self._offset = (-np.asarray(mean, dtype=np.float32) / std).reshape(3, 1, 1)
+
+    @classmethod
+    def from_timm_config(cls, config):
+        """Build from resolve_data_config() output; None if it is not a centre crop"""
+        if config.get("crop_mode", "center") != "center":
+            return None
+        channels, height, width = config["input_size"]
+        if channels != 3 or height != width:
+            return None
+        resize = math.floor(height / config.get("crop_pct", 1.0))
+        return cls(resize, height, config["mean"], config["std"],
+                   INTERPOLATIONS.get(config.get("interpolation"), Image.BILINEAR))
+
+    def to_array(self, image):
+        """Normalise an already cropped RGB image to a (3, H, W) float32 array"""
+        chw = np.asarray(image, dtype=np.uint8).transpose(2, 0, 1)
+        out = chw.astype(np.float32)
+        out *= self._scale
+        out += self._offset
+        return out
+
+    def __call__(self, image):
+        image = center_crop(resize_shorter(image, self.resize, self.interpolation), self.crop)
+        return self.to_array(image)
+
+    def load(self, source):
+        """Decode (at reduced JPEG scale) and transform in one step"""
+        return self(open_image(source, self.resize))
+
+    def views(self, image, names=("center", "flip")):
+        """
+        Several crops of one decoded image as a (len(names), 3, H, W) array.
+
+        "center" is exactly __call__'s crop and "flip" its mirror image;
+        "wide" resizes the shorter side straight to the crop size, keeping
+        more of the frame; the corner views crop the corners of the
+        resized image (the five-crop corners). All views share the single
+        decode and resize.
+        """
+        resized = resize_shorter(image, self.resize, self.interpolation)
+        width, height = resized.size
+        center = None
+        crops = []
+        for name in names:
+            if name in ("center", "flip"):
+                if center is None:
+                    center = center_crop(resized, self.crop)
+                crop = center if name == "center" else center.transpose(Image.FLIP_LEFT_RIGHT)
+            elif name == "wide":
+                crop = center_crop(resize_shorter(image, self.crop, self.interpolation), self.crop)
+            elif name in TTA_VIEWS:
+                left = 0 if name.endswith("left") else width - self.crop
+                top = 0 if name.startswith("top") else height - self.crop
+                crop = resized.crop((left, top, left + self.crop, top + self.crop))
+            else:
+                raise ValueError(f"Unknown view '{name}', expected one of {', '.join(TTA_VIEWS)}")
+            crops.append(np.asarray(crop, dtype=np.uint8))
+        out = np.stack(crops).transpose(0, 3, 1, 2).astype(np.float32)
+        out *= self._scale
+        out += self._offset
+        return out
@@ -4,63 +4,442 @@ Provides 768-dimensional semantic embeddings
 """
 
 import sys
+import os
 import json
-import torch
-import timm
-from PIL import Image
-from timm.data import resolve_data_config
-from timm.data.transforms_factory import create_transform
+import argparse
+import numpy as np
+from ai_cache import open_cache
+from ai_codec import FORMATS, write_embedding
+from ai_backends import BACKENDS, configure_threads, default_backend, prepare_model, weights_fingerprint
+from ai_preprocess import FastTransform, exif_transpose_default, fast_preprocess_default, open_image, parse_views
+from ai_projection import Projection
+from ai_index import normalize
+from ai_metrics import SlowRequestProfiler, Trace, log, stage, with_timings
+
+# torch and timm are imported inside ViTProcessor so usage errors, cache
+# hits in the worker and --help never pay for them
+
+MODEL_ID = "vit_base_patch16_224"
+WEIGHTS_ENV = "FINDERAI_VIT_WEIGHTS"
+SNAPSHOT_ENV = "FINDERAI_VIT_SNAPSHOT"
+PROJECTION_ENV = "FINDERAI_VIT_PROJECTION"
+TTA_ENV = "FINDERAI_VIT_TTA"
+
+def _load_state_dict(path):
+    """Load a state_dict memory-mapped from a .safetensors or torch file"""
+    if path.endswith(".safetensors"):
+        from safetensors.torch import load_file
+        return load_file(path, device="cpu")
+    import torch
+    return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+
+def save_snapshot(model, path):
+    """Serialise a loaded model's state_dict for fast startup"""
+    state = {name: tensor.contiguous() for name, tensor in model.state_dict().items()}
+    tmp = path + ".tmp"
+    if path.endswith(".safetensors"):
+        from safetensors.torch import save_file
+        save_file(state, tmp)
+    else:
+        import torch
+        torch.save(state, tmp)
+    os.replace(tmp, path)
 
 class ViTProcessor:
-    def __init__(self):
-        print("[AI] Loading ViT model...", file=sys.stderr)
-        self.model = timm.create_model("vit_base_patch16_224", pretrained=True, num_classes=0)
+    """
+    ViT-Base/16 embedding extractor.
+    
+    Weights are resolved in order of preference:
+      1. snapshot: a state_dict written by save_snapshot(); the model is
+         built on the meta device (no random init) and the tensors are
+         memory-mapped in place
+      2. weights: a pinned local copy of the timm pretrained checkpoint,
+         loaded without any hub lookup
+      3. the timm pretrained hub download (network or local HF cache)
+    Both paths default to $FINDERAI_VIT_SNAPSHOT / $FINDERAI_VIT_WEIGHTS.
+    
+    With fast_preprocess (default $FINDERAI_FAST_PREPROCESS), JPEGs are
+    decoded at reduced DCT scale and normalised in NumPy (see
+    ai_preprocess) instead of through the timm transform.
+    
+    EXIF orientation is applied when $FINDERAI_EXIF_TRANSPOSE is set; it
+    is part of the cache namespace.
+    
+    With a projection (an ai_projection file, default
+    $FINDERAI_VIT_PROJECTION), every embedding is reduced to the compact
+    float16 vector it defines.
+    
+    With tta (views such as "center,flip,wide", default $FINDERAI_VIT_TTA),
+    each image is cut into those crops from a single decode, all views go
+    through the model as one batch, and extract_embedding()/embed_batch()
+    return the mean of the L2-normalised view vectors; extract_views()
+    returns the per-view set for multi-vector search (ai_index
+    MultiVectorIndex).
+    """
+    
+    def __init__(self, cache=None, backend=None, weights=None, snapshot=None, fast_preprocess=None,
+                 projection=None, tta=None):
+        startup = Trace("vit-startup")
+        log("AI", "Loading ViT model")
+        
+        with startup.stage("import_torch"):
+            import torch
+        with startup.stage("import_timm"):
+            import timm
+            from timm.data import resolve_data_config
+            from timm.data.transforms_factory import create_transform
+        
+        configure_threads()
+        self.backend = backend or default_backend()
+        snapshot = snapshot or os.environ.get(SNAPSHOT_ENV)
+        weights = weights or os.environ.get(WEIGHTS_ENV)
+        
+        if snapshot:
+            with startup.stage("build_model"):
+                with torch.device("meta"):
+                    self.model = timm.create_model(MODEL_ID, pretrained=False, num_classes=0)
+            with startup.stage("load_weights"):
+                self.model.load_state_dict(_load_state_dict(snapshot), assign=True)
+            self.weights_source = f"snapshot:{snapshot}"
+        elif weights:
+            with startup.stage("build_model"):
+                self.model = timm.create_model(MODEL_ID, pretrained=True, num_classes=0,
+                                               pretrained_cfg_overlay={"file": weights})
+            self.weights_source = f"file:{weights}"
+        else:
+            with startup.stage("build_model"):
+                self.model = timm.create_model(MODEL_ID, pretrained=True, num_classes=0)
+            self.weights_source = "hub"
+        self.weights_id = weights_fingerprint(self.weights_source, snapshot or weights)
         self.model.eval()
-        config = resolve_data_config({}, model=self.model)
-        self.transform = create_transform(**config)
-        print("[SUCCESS] ViT model loaded", file=sys.stderr)
+        
+        with startup.stage("transform"):
+            config = resolve_data_config({}, model=self.model)
+            self.transform = create_transform(**config)
+            if fast_preprocess is None:
+                fast_preprocess = fast_preprocess_default()
+            self.fast_transform = FastTransform.from_timm_config(config) if fast_preprocess else None
+            self.exif = exif_transpose_default()
+            self.tta = parse_views(tta if tta is not None else os.environ.get(TTA_ENV))
+            # Views are cut with the NumPy transform; its centre view is the timm crop
+            self.view_transform = (self.fast_transform or FastTransform.from_timm_config(config)) \
+                if self.tta else None
+            if self.tta and self.view_transform is None:
+                raise ValueError(f"Test-time augmentation needs a centre-crop config, got {config}")
+        if self.backend != "fp32":
+            log("AI", f"Preparing {self.backend} inference backend")
+            with startup.stage("backend"):
+                self.model = prepare_model(self.model, self.backend, MODEL_ID,
+                                           torch.zeros(1, *config["input_size"]),
+                                           weights_id=self.weights_id)
+        projection = projection or os.environ.get(PROJECTION_ENV)
+        self.projection = Projection.load(projection) if isinstance(projection, str) else projection
+        self.cache = cache
+        self.cache_namespace = (f"{MODEL_ID}|{self.backend}|{json.dumps(config, sort_keys=True)}"
+                                + ("|exif" if self.exif else "")
+                                + ("|draft-numpy" if self.fast_transform is not None else "")
+                                + (f"|tta={'+'.join(self.tta)}" if self.tta else "")
+                                + (f"|{self.projection.fingerprint}" if self.projection is not None else ""))
+        self.last_cache_hit = False
+        
+        startup.finish()
+        # Startup stages in seconds, e.g. for the benchmark report
+        self.startup = startup
+        self.startup_timings = {stage: round(seconds, 4) for stage, seconds in startup.seconds.items()}
+        self.startup_timings["total"] = round(startup.elapsed, 4)
+        log("TIMING", "ViT model loaded", weights=self.weights_source,
+            **{f"{stage}_s": f"{seconds:.3f}" for stage, seconds in self.startup_timings.items()})
     
-    def extract_embedding(self, image_path):
-        image = Image.open(image_path).convert("RGB")
-        input_tensor = self.transform(image).unsqueeze(0)
-        with torch.no_grad():
-            embedding = self.model(input_tensor).squeeze().numpy()
+    def preprocess(self, image, trace=None):
+        """
+        Image path or encoded bytes to a (3, 224, 224) input tensor, or
+        with tta a (views, 3, 224, 224) one
+        """
+        if self.tta:
+            import torch
+            with stage(trace, "decode"):
+                decoded = open_image(image, self.view_transform.resize if self.fast_transform else None,
+                                     exif=self.exif)
+            with stage(trace, "transform"):
+                return torch.from_numpy(self.view_transform.views(decoded, self.tta))
+        if self.fast_transform is not None:
+            import torch
+            with stage(trace, "decode"):
+                decoded = open_image(image, self.fast_transform.resize, exif=self.exif)
+            with stage(trace, "transform"):
+                return torch.from_numpy(self.fast_transform(decoded))
+        with stage(trace, "decode"):
+            decoded = open_image(image, exif=self.exif)
+        with stage(trace, "transform"):
+            return self.transform(decoded)
+    
+    def extract_embedding(self, image, trace=None):
+        key = None
+        if self.cache is not None:
+            with stage(trace, "cache"):
+                key, cached = self.cache.lookup(image, self.cache_namespace)
+            self.last_cache_hit = cached is not None
+            if cached is not None:
+                return cached
+        
+        input_tensor = self.preprocess(image, trace)
+        with stage(trace, "forward"):
+            embedding = self.embed_batch([input_tensor])[0]
+        
+        if key is not None:
+            self.cache.put(key, embedding)
         return embedding
+    
+    def _forward(self, tensors):
+        """Model output rows for all images' views in one pass, and the views per image"""
+        import torch
+        counts = [1 if tensor.dim() == 3 else len(tensor) for tensor in tensors]
+        batch = torch.cat([tensor.reshape(-1, *tensor.shape[-3:]) for tensor in tensors])
+        with torch.no_grad():
+            return self.model(batch).numpy(), counts
+    
+    def _pool(self, outputs, counts):
+        # Any tta, even a single view, pools normalised vectors
+        if self.tta:
+            groups = np.split(outputs, np.cumsum(counts)[:-1])
+            outputs = np.stack([normalize(group).mean(axis=0) for group in groups])
+        if self.projection is not None:
+            outputs = self.projection.apply(outputs)
+        return list(outputs)
+    
+    def embed_batch(self, tensors):
+        """Run one forward pass over preprocessed tensors, one row per image"""
+        return self._pool(*self._forward(tensors))
+    
+    def embed_batch_views(self, tensors):
+        """(pooled embedding, (views, dims) per-view vectors) per image, from one forward pass"""
+        outputs, counts = self._forward(tensors)
+        pooled = self._pool(outputs, counts)
+        if self.projection is not None:
+            outputs = self.projection.apply(outputs)
+        return list(zip(pooled, np.split(outputs, np.cumsum(counts)[:-1])))
+    
+    def extract_views(self, image, trace=None):
+        """Pooled embedding and per-view vectors of one image (one view without tta)"""
+        input_tensor = self.preprocess(image, trace)
+        with stage(trace, "forward"):
+            return self.embed_batch_views([input_tensor])[0]
+    
+    def extract_embeddings(self, image_paths):
+        return self.embed_batch([self.preprocess(path) for path in image_paths])
+
+MODEL_NAME = "ViT-Base-Patch16-224 (timm)"
+
+def build_result(embedding):
+    return {
+        "success": True,
+        "embeddings": embedding.tolist(),
+        "dimensions": len(embedding),
+        "model": MODEL_NAME,
+        "feature_stats": {
+            "mean": float(embedding.mean()),
+            "std": float(embedding.std()),
+            "min": float(embedding.min()),
+            "max": float(embedding.max())
+        }
+    }
+
+def result_builder(processor):
+    """build_result for processor's vectors; projected ones are tagged with the projection"""
+    if processor.projection is None:
+        return build_result
+    fingerprint = processor.projection.fingerprint
+    return lambda embedding: {**build_result(embedding), "projection": fingerprint}
+
+def model_name(processor):
+    """MODEL_NAME, plus the projection for compact vectors (binary output headers)"""
+    if processor.projection is None:
+        return MODEL_NAME
+    return f"{MODEL_NAME} [{processor.projection.fingerprint}]"
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="ViT embedding extractor")
+    parser.add_argument("image_path", nargs="?", help="Image to embed (one-shot mode)")
+    parser.add_argument("--serve", action="store_true",
+                        help="Run as a persistent worker reading JSON lines on stdin")
+    parser.add_argument("--socket", metavar="PATH",
+                        help="With --serve, listen on this Unix socket instead of stdin")
+    parser.add_argument("--max-batch-size", type=int, default=1,
+                        help="With --serve, batch up to this many concurrent requests per forward pass")
+    parser.add_argument("--max-wait-ms", type=float, default=20.0,
+                        help="With --serve, longest a request waits for a batch to fill")
+    parser.add_argument("--dedup-radius", type=int, default=0,
+                        help="With --serve, reuse the vector of an earlier upload whose perceptual "
+                             "hash is within this many bits (0 = off, see ai_phash)")
+    parser.add_argument("--bulk", metavar="DIR_OR_GLOB",
+                        help="Embed every image in a directory or matching a glob")
+    parser.add_argument("--manifest", metavar="FILE",
+                        help="Embed the images listed in a manifest (one path or JSON object per line)")
+    parser.add_argument("--batch-size", type=int, default=16,
+                        help="With --bulk/--manifest, images per forward pass")
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1),
+                        help="With --bulk/--manifest, image decoding threads")
+    parser.add_argument("--checkpoint", metavar="FILE",
+                        help="With --bulk/--manifest, resume file of completed images")
+    parser.add_argument("--output", metavar="FILE",
+                        help="With --bulk/--manifest, append JSON lines here instead of stdout")
+    parser.add_argument("--format", choices=FORMATS, default="json",
+                        help="One-shot output: JSON (default), raw framed float32/float16 "
+                             "bytes, or the framed bytes as one base64 line")
+    parser.add_argument("--backend", choices=BACKENDS,
+                        help="Inference backend (default: $FINDERAI_BACKEND or fp32)")
+    parser.add_argument("--threads", type=int,
+                        help="torch intra-op threads (default: $FINDERAI_TORCH_THREADS)")
+    parser.add_argument("--cache", metavar="FILE",
+                        help="Embedding cache database (default: $FINDERAI_EMBEDDING_CACHE)")
+    parser.add_argument("--weights", metavar="FILE",
+                        help="Local pretrained checkpoint, no network (default: $FINDERAI_VIT_WEIGHTS)")
+    parser.add_argument("--snapshot", metavar="FILE",
+                        help="state_dict snapshot to memory-map at startup (default: $FINDERAI_VIT_SNAPSHOT)")
+    parser.add_argument("--fast-preprocess", action="store_true", default=None,
+                        help="Reduced-scale JPEG decode and NumPy normalisation "
+                             "(default: $FINDERAI_FAST_PREPROCESS)")
+    parser.add_argument("--projection", metavar="FILE",
+                        help="Emit compact vectors with an ai_projection file "
+                             "(default: $FINDERAI_VIT_PROJECTION)")
+    parser.add_argument("--tta", metavar="VIEWS",
+                        help="Comma-separated test-time augmentation views embedded in one batch and "
+                             "mean-pooled, e.g. center,flip,wide (default: $FINDERAI_VIT_TTA)")
+    parser.add_argument("--views", action="store_true",
+                        help="One-shot and bulk JSON output add the per-view vectors as "
+                             "\"view_embeddings\" (for ai_index.MultiVectorIndex)")
+    parser.add_argument("--save-snapshot", metavar="FILE",
+                        help="Load the model, write a snapshot (.safetensors or .pt) and exit")
+    args = parser.parse_args(argv)
+    if args.threads:
+        os.environ["FINDERAI_TORCH_THREADS"] = str(args.threads)
+    if not (args.serve or args.bulk or args.manifest or args.image_path or args.save_snapshot):
+        parser.error("an image path, --serve, --bulk, --manifest or --save-snapshot is required")
+    return args
+
+def make_processor(args):
+    return ViTProcessor(cache=open_cache(args.cache), backend=args.backend,
+                        weights=args.weights, snapshot=args.snapshot,
+                        fast_preprocess=args.fast_preprocess, projection=args.projection, tta=args.tta)
+
+def serve(args):
+    from ai_worker import EmbeddingWorker
+
+    try:
+        processor = make_processor(args)
+    except Exception as e:
+        print(json.dumps({"success": False, "error": str(e)}), file=sys.stderr)
+        sys.exit(1)
+
+    batcher = None
+    if args.max_batch_size > 1:
+        from ai_batching import MicroBatcher
+        batcher = MicroBatcher(processor.embed_batch, args.max_batch_size, args.max_wait_ms)
+        print(f"[WORKER] Micro-batching up to {args.max_batch_size} images "
+              f"or {args.max_wait_ms:g} ms", file=sys.stderr)
+    
+    dedup = None
+    if args.dedup_radius > 0:
+        from ai_phash import NearDuplicateFilter
+        dedup = NearDuplicateFilter(args.dedup_radius)
+    
+    worker = EmbeddingWorker(processor, result_builder(processor), model_name(processor), batcher=batcher,
+                             dedup=dedup)
+    worker.install_signal_handlers()
+    if args.socket:
+        worker.serve_socket(args.socket)
+    else:
+        worker.serve_stdio()
+
+def bulk(args):
+    from ai_bulk import collect_images, run_bulk
+
+    paths = collect_images(args.bulk, args.manifest)
+    print(f"[BULK] {len(paths)} images to embed", file=sys.stderr)
+    if not paths:
+        print(json.dumps({"success": False, "error": "No images found"}), file=sys.stderr)
+        sys.exit(1)
+
+    processor = make_processor(args)
+    embedder, result = processor, result_builder(processor)
+    if args.views:
+        # Same pipeline, but each result also carries its per-view vectors;
+        # the cache holds pooled vectors only, so this path bypasses it
+        from types import SimpleNamespace
+        embedder = SimpleNamespace(preprocess=processor.preprocess, embed_batch=processor.embed_batch_views)
+        pooled_result = result
+        result = lambda pair: {**pooled_result(pair[0]), "view_embeddings": pair[1].tolist()}
+    out = open(args.output, "a", encoding="utf-8") if args.output else sys.stdout
+    try:
+        summary = run_bulk(embedder, result, paths, out=out,
+                           batch_size=args.batch_size, workers=args.workers,
+                           checkpoint=args.checkpoint)
+    finally:
+        if args.output:
+            out.close()
+    print(json.dumps(summary), file=sys.stderr)
+    if not summary["success"]:
+        sys.exit(1)
 
 def main():
     if len(sys.argv) < 2:
         print(json.dumps({"success": False, "error": "Usage: python ai_processor_enhanced.py <image_path>"}))
         sys.exit(1)
     
-    image_path = sys.argv[1]
+    args = parse_args(sys.argv[1:])
+    if args.save_snapshot:
+        # Snapshots hold fp32 weights; backends are applied after loading
+        args.backend = "fp32"
+        processor = make_processor(args)
+        save_snapshot(processor.model, args.save_snapshot)
+        print(f"[SUCCESS] Snapshot written to {args.save_snapshot}", file=sys.stderr)
+        return
+    if args.serve:
+        serve(args)
+        return
+    if args.bulk or args.manifest:
+        bulk(args)
+        return
+    
+    image_path = args.image_path
+    trace = Trace("vit", image=image_path)
     
     try:
-        processor = ViTProcessor()
-        print(f"[PROCESSING] Processing image: {image_path}", file=sys.stderr)
-        embedding = processor.extract_embedding(image_path)
-        
-        print(f"[SUCCESS] Extracted {len(embedding)} features", file=sys.stderr)
-        print(f"[STATS] Mean: {embedding.mean():.4f}, Std: {embedding.std():.4f}", file=sys.stderr)
+        with SlowRequestProfiler().profile(trace):
+            processor = make_processor(args)
+            # Startup splits into the import and model-load stages of this request
+            for name, seconds in processor.startup.seconds.items():
+                trace.record("import" if name.startswith("import_") else "model_load", seconds,
+                             processor.startup.rss_delta[name])
+            if args.views:
+                embedding, views = processor.extract_views(image_path, trace)
+            else:
+                embedding = processor.extract_embedding(image_path, trace)
+            
+            if args.format != "json":
+                with trace.stage("serialize"):
+                    write_embedding(embedding, model_name(processor), args.format)
+                return
+            
+            output = result_builder(processor)(embedding)
+            if processor.tta:
+                output["tta"] = list(processor.tta)
+            if args.views:
+                output["view_embeddings"] = views.tolist()
+            if processor.cache is not None:
+                output["cache"] = {"hit": processor.last_cache_hit, **processor.cache.stats()}
+            with trace.stage("serialize"):
+                body = json.dumps(output)
         
-        output = {
-            "success": True,
-            "embeddings": embedding.tolist(),
-            "dimensions": len(embedding),
-            "model": "ViT-Base-Patch16-224 (timm)",
-            "feature_stats": {
-                "mean": float(embedding.mean()),
-                "std": float(embedding.std()),
-                "min": float(embedding.min()),
-                "max": float(embedding.max())
-            }
-        }
-        
-        print(json.dumps(output))
+        print(with_timings(body, trace))
         
     except Exception as e:
         print(json.dumps({"success": False, "error": str(e)}), file=sys.stderr)
         sys.exit(1)
+    finally:
+        trace.finish()
+        log("TIMING", "Request done", **{f"{name}_ms": ms for name, ms in trace.as_dict()["stages_ms"].items()},
+            total_ms=round(trace.elapsed_ms, 1))
 
 if __name__ == "__main__":
     main()
-
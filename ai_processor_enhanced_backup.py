@@ -4,15 +4,194 @@ Uses sophisticated computer vision techniques to generate 768-dimensional embedd
 Similar to ViT but without requiring heavy ML libraries
 """
 
-from PIL import Image
 import sys
 import json
 import os
 import numpy as np
 from scipy import ndimage
 import cv2
+from ai_cache import open_cache
+from ai_preprocess import exif_transpose_default, fast_preprocess_default, is_buffer, open_image
+from ai_metrics import SlowRequestProfiler, Trace, log, stage, with_timings
 
-def extract_advanced_features(image_path):
+# Bump the version whenever the feature layout below changes so cached
+# vectors from an older layout are never returned
+CACHE_NAMESPACE = "enhanced-cv-768|v1|resize224"
+
+FEATURE_DIMS = 768
+IMAGE_SIZE = 224
+
+def _cells(array, grid):
+    """
+    Split a square (H, W[, C]) array into grid x grid cells.
+    
+    Returns a contiguous (grid * grid, cell_pixels) array, one row per
+    cell in row-major order, each row flattened in the same order as
+    slicing the cell out of the image.
+    """
+    cell = array.shape[0] // grid
+    blocks = array.reshape(grid, cell, grid, cell, *array.shape[2:]).swapaxes(1, 2)
+    return blocks.reshape(grid * grid, -1)
+
+def _bin_index(values, bins, upper):
+    """Histogram bin of each value, matching np.histogram(range=(0, upper))"""
+    edges = np.linspace(0, upper, bins + 1, dtype=values.dtype)
+    return np.clip(np.searchsorted(edges, values, side="right") - 1, 0, bins - 1)
+
+def _channel_histograms(image, bins=16):
+    """Normalised 16-bin histogram of each uint8 channel, computed in one bincount"""
+    channels = image.shape[2]
+    index = (image >> 4).astype(np.intp) + np.arange(channels) * bins
+    counts = np.bincount(index.ravel(), minlength=channels * bins).reshape(channels, bins)
+    return counts / counts.sum(axis=1, keepdims=True)
+
+class _FeatureWriter:
+    """Fills a preallocated float32 vector, dropping anything past its end"""
+    
+    def __init__(self, dims):
+        self.vector = np.zeros(dims, dtype=np.float32)
+        self.position = 0
+    
+    @property
+    def full(self):
+        return self.position >= len(self.vector)
+    
+    def write(self, values):
+        values = np.ravel(values)
+        room = len(self.vector) - self.position
+        if room > 0:
+            self.vector[self.position:self.position + min(room, len(values))] = values[:room]
+        self.position += len(values)
+
+def compute_advanced_features(image):
+    """
+    Compute the 768-dimensional classical feature vector
+    
+    Gradients are computed once and shared, grid statistics use
+    reshape-based block reductions and results are written straight into
+    a preallocated float32 vector.
+    
+    Args:
+        image: 224x224 RGB uint8 array
+        
+    Returns:
+        L2-normalised float32 array of FEATURE_DIMS values
+    """
+    rgb = np.ascontiguousarray(image, dtype=np.uint8)
+    img_array = rgb.astype(np.float32)
+    img_cv = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+    half, quarter = IMAGE_SIZE // 2, IMAGE_SIZE // 4
+    out = _FeatureWriter(FEATURE_DIMS)
+    
+    # ========== COLOR FEATURES (256 dimensions) ==========
+    # 1-3. RGB, HSV and LAB histograms (3 x 48 dims: 16 bins x 3 channels)
+    out.write(_channel_histograms(rgb))
+    out.write(_channel_histograms(cv2.cvtColor(img_cv, cv2.COLOR_BGR2HSV)))
+    out.write(_channel_histograms(cv2.cvtColor(img_cv, cv2.COLOR_BGR2LAB)))
+    
+    # 4. Spatial Color Grid (64 dims: 8x8 grid, mean of the average RGB)
+    cells = _cells(img_array, 8).reshape(64, -1, 3)
+    out.write((cells.mean(axis=1) / 255.0).mean(axis=1))
+    
+    # 5. Color Moments (48 dims: mean, std, skew per cell of a 4x4 grid)
+    cells = _cells(img_array, 4)
+    mean = cells.mean(axis=1)
+    std = cells.std(axis=1)
+    skew = (((cells - mean[:, None]) / (std[:, None] + 1e-5)) ** 3).mean(axis=1)
+    out.write(np.stack([mean / 255.0, std / 255.0, skew], axis=1))
+    
+    # ========== TEXTURE FEATURES ==========
+    gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+    gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+    
+    # 1. Local variance per cell of an 8x8 grid (64 dims)
+    out.write(_cells(gray, 8).std(axis=1) / 255.0)
+    
+    # 2. Oriented gradient responses (72 dims: 9 orientations x 8 regions,
+    #    4 quadrants then 4 horizontal strips)
+    thetas = np.radians(np.arange(0, 180, 22))
+    oriented = np.abs(gx * np.cos(thetas)[:, None, None] + gy * np.sin(thetas)[:, None, None])
+    quadrants = oriented.reshape(-1, 2, half, 2, half).mean(axis=(2, 4)).reshape(-1, 4)
+    strips = oriented.reshape(-1, 4, quarter, IMAGE_SIZE).mean(axis=(2, 3))
+    out.write(np.concatenate([quadrants, strips], axis=1) / 100.0)
+    
+    # 3. Multi-scale Gradient Magnitudes (64 dims: 4 scales x 4x4 grid)
+    for scale in [1, 2, 3, 4]:
+        blurred = cv2.GaussianBlur(gray, (2*scale+1, 2*scale+1), scale)
+        bx = cv2.Sobel(blurred, cv2.CV_32F, 1, 0, ksize=3)
+        by = cv2.Sobel(blurred, cv2.CV_32F, 0, 1, ksize=3)
+        magnitude = np.sqrt(bx**2 + by**2)
+        out.write(_cells(magnitude, 4).mean(axis=1) / 100.0)
+    
+    # 4. Edge Orientation Histogram (64 dims: 16 orientations x 4 quadrants)
+    orientation = (np.arctan2(gy, gx) * 180 / np.pi + 180) % 360
+    quadrant = (np.arange(IMAGE_SIZE) >= half).astype(np.intp)
+    quadrant = quadrant[:, None] * 2 + quadrant[None, :]
+    index = quadrant * 16 + _bin_index(orientation, 16, 360)
+    hist = np.bincount(index.ravel(), minlength=64).reshape(4, 16)
+    out.write(hist / (hist.sum(axis=1, keepdims=True) + 1e-5))
+    
+    # ========== SHAPE FEATURES ==========
+    # 1. Canny edge density at multiple thresholds (64 dims: 4 x 4x4 grid)
+    for thresh_low in [30, 50, 70, 100]:
+        edges = cv2.Canny(img_cv, thresh_low, thresh_low * 2)
+        out.write(_cells(edges, 4).mean(axis=1) / 255.0)
+    
+    # 2. Harris corner strength per cell of an 8x8 grid (64 dims)
+    gray_uint8 = gray.astype(np.uint8)
+    corners = cv2.dilate(cv2.cornerHarris(gray_uint8, blockSize=2, ksize=3, k=0.04), None)
+    out.write(_cells(corners, 8).max(axis=1) / (corners.max() + 1e-5))
+    
+    # 3. Hough line angle histogram (64 dims). The same 8-bin histogram
+    #    fills all 8 slots; it is computed once and repeated.
+    lines = cv2.HoughLines(cv2.Canny(img_cv, 50, 150), 1, np.pi / 180, threshold=50)
+    if lines is not None:
+        hist, _ = np.histogram(lines[:, 0, 1] * 180 / np.pi, bins=8, range=(0, 180))
+        out.write(np.tile(hist / (hist.sum() + 1e-5), 8))
+    else:
+        out.write(np.zeros(64))
+    
+    # 4. Contour density per cell of an 8x8 grid (64 dims)
+    _, binary = cv2.threshold(gray_uint8, 127, 255, cv2.THRESH_BINARY)
+    contours, _ = cv2.findContours(binary, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    contour_map = np.zeros((IMAGE_SIZE, IMAGE_SIZE), dtype=np.uint8)
+    cv2.drawContours(contour_map, contours, -1, (255), thickness=1)
+    out.write(_cells(contour_map, 8).mean(axis=1) / 255.0)
+    
+    # The layout above adds up to 840 values and has always been cut at
+    # 768, so the tail of the contour grid is dropped and the 64 HOG
+    # dimensions that used to follow never reached the output. They are
+    # not computed.
+    
+    # Normalize the entire feature vector
+    features = out.vector
+    norm = np.linalg.norm(features)
+    if norm > 0:
+        features = features / norm
+    return features
+
+def load_image(image_source, fast=None, trace=None):
+    """
+    Decode an image path or encoded bytes to a 224x224 RGB array.
+    
+    With fast (default $FINDERAI_FAST_PREPROCESS), JPEGs are decoded at the
+    smallest DCT scale that still covers 224x224 before resizing.
+    """
+    fast = fast_preprocess_default() if fast is None else fast
+    with stage(trace, "decode"):
+        image = open_image(image_source, IMAGE_SIZE if fast else None)
+    with stage(trace, "transform"):
+        return np.asarray(image.resize((IMAGE_SIZE, IMAGE_SIZE)))
+
+def _describe(image_source):
+    return f"<{len(image_source)} bytes>" if is_buffer(image_source) else image_source
+
+def cache_namespace(fast=None):
+    fast = fast_preprocess_default() if fast is None else fast
+    return CACHE_NAMESPACE + ("|exif" if exif_transpose_default() else "") + ("|draft" if fast else "")
+
+def extract_advanced_features(image_path, cache=None, trace=None):
     """
     Extract advanced visual features similar to ViT's approach
     
@@ -22,272 +201,54 @@ def extract_advanced_features(image_path):
     - Shape features (256 dims)
     
     Args:
-        image_path: Path to the image file
+        image_path: Path to the image file, or its encoded bytes
+        cache: Optional ai_cache.EmbeddingCache; a hit skips all decoding
+            and feature work
+        trace: Optional ai_metrics.Trace receiving the stage timings
         
     Returns:
         Dictionary with 768-dimensional embeddings or error message
     """
-    if not os.path.exists(image_path):
+    if not is_buffer(image_path) and not os.path.exists(image_path):
         return {"error": "Image file not found", "success": False}
     
     try:
-        print(f"📸 Processing image: {image_path}", file=sys.stderr)
-        
-        # Load image
-        image = Image.open(image_path).convert('RGB')
-        image = image.resize((224, 224))
-        img_array = np.array(image, dtype=np.float32)
-        
-        # OpenCV format (for advanced processing)
-        img_cv = cv2.cvtColor(img_array.astype(np.uint8), cv2.COLOR_RGB2BGR)
-        
-        features = []
-        
-        # ========== COLOR FEATURES (256 dimensions) ==========
-        print("🎨 Extracting color features...", file=sys.stderr)
-        
-        # 1. RGB Histograms (48 dims: 16 bins × 3 channels)
-        for channel in range(3):
-            hist, _ = np.histogram(img_array[:,:,channel], bins=16, range=(0, 256))
-            features.extend((hist / hist.sum()).tolist())
-        
-        # 2. HSV Histograms (48 dims: 16 bins × 3 channels)
-        img_hsv = cv2.cvtColor(img_cv, cv2.COLOR_BGR2HSV)
-        for channel in range(3):
-            hist, _ = np.histogram(img_hsv[:,:,channel], bins=16, range=(0, 256))
-            features.extend((hist / hist.sum()).tolist())
-        
-        # 3. LAB Color Space (48 dims: 16 bins × 3 channels)
-        img_lab = cv2.cvtColor(img_cv, cv2.COLOR_BGR2LAB)
-        for channel in range(3):
-            hist, _ = np.histogram(img_lab[:,:,channel], bins=16, range=(0, 256))
-            features.extend((hist / hist.sum()).tolist())
-        
-        # 4. Spatial Color Grid (64 dims: 8×8 grid, average RGB)
-        grid_size = 8
-        h_step = 224 // grid_size
-        w_step = 224 // grid_size
-        for i in range(grid_size):
-            for j in range(grid_size):
-                region = img_array[i*h_step:(i+1)*h_step, j*w_step:(j+1)*w_step, :]
-                avg_color = region.mean(axis=(0, 1)) / 255.0
-                # Only take the mean across channels for spatial compactness
-                features.append(float(avg_color.mean()))
-        
-        # 5. Color Moments (48 dims: mean, std, skew for RGB in 4×4 grid)
-        grid_size = 4
-        h_step = 224 // grid_size
-        w_step = 224 // grid_size
-        for i in range(grid_size):
-            for j in range(grid_size):
-                region = img_array[i*h_step:(i+1)*h_step, j*w_step:(j+1)*w_step, :]
-                # Mean, std, skewness for each RGB channel (flatten to get more info)
-                features.append(float(region.mean() / 255.0))
-                features.append(float(region.std() / 255.0))
-                # Skewness approximation
-                centered = (region - region.mean()) / (region.std() + 1e-5)
-                skew = float((centered ** 3).mean())
-                features.append(skew)
-        
-        print(f"   ✅ Color features: {len(features)} dims", file=sys.stderr)
-        
-        # ========== TEXTURE FEATURES (256 dimensions) ==========
-        print("🧩 Extracting texture features...", file=sys.stderr)
-        texture_start = len(features)
-        
-        # Convert to grayscale for texture analysis
-        gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY).astype(np.float32)
-        
-        # 1. Local Binary Pattern (LBP) inspired features (64 dims)
-        # Compute differences with neighbors in 8×8 grid
-        grid_size = 8
-        h_step = 224 // grid_size
-        w_step = 224 // grid_size
-        for i in range(grid_size):
-            for j in range(grid_size):
-                region = gray[i*h_step:(i+1)*h_step, j*w_step:(j+1)*w_step]
-                # Local variance as texture measure
-                features.append(float(region.std() / 255.0))
-        
-        # 2. Gabor Filter-like responses (64 dims: 8 orientations × 8 regions)
-        for angle in range(0, 180, 22):  # 8 orientations
-            # Sobel at different angles (approximation of Gabor)
-            theta = np.radians(angle)
-            kx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
-            ky = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
-            
-            # Directional gradient
-            oriented_grad = kx * np.cos(theta) + ky * np.sin(theta)
-            
-            # Average response in each quadrant
-            h, w = oriented_grad.shape
-            regions = [
-                oriented_grad[:h//2, :w//2],
-                oriented_grad[:h//2, w//2:],
-                oriented_grad[h//2:, :w//2],
-                oriented_grad[h//2:, w//2:],
-                oriented_grad[:h//4, :],
-                oriented_grad[h//4:h//2, :],
-                oriented_grad[h//2:3*h//4, :],
-                oriented_grad[3*h//4:, :]
-            ]
-            for region in regions:
-                features.append(float(np.abs(region).mean() / 100.0))
-        
-        # 3. Multi-scale Gradient Magnitudes (64 dims: 4 scales × 16 regions)
-        for scale in [1, 2, 3, 4]:
-            # Gaussian blur at different scales
-            blurred = cv2.GaussianBlur(gray, (2*scale+1, 2*scale+1), scale)
-            gx = cv2.Sobel(blurred, cv2.CV_32F, 1, 0, ksize=3)
-            gy = cv2.Sobel(blurred, cv2.CV_32F, 0, 1, ksize=3)
-            magnitude = np.sqrt(gx**2 + gy**2)
-            
-            # Divide into 4×4 grid
-            grid_size = 4
-            h_step = 224 // grid_size
-            w_step = 224 // grid_size
-            for i in range(grid_size):
-                for j in range(grid_size):
-                    region = magnitude[i*h_step:(i+1)*h_step, j*w_step:(j+1)*w_step]
-                    features.append(float(region.mean() / 100.0))
-        
-        # 4. Edge Orientation Histogram (64 dims: 16 orientations × 4 quadrants)
-        gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
-        gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
-        orientation = np.arctan2(gy, gx) * 180 / np.pi  # -180 to 180
-        orientation = (orientation + 180) % 360  # 0 to 360
-        
-        h, w = orientation.shape
-        quadrants = [
-            orientation[:h//2, :w//2],
-            orientation[:h//2, w//2:],
-            orientation[h//2:, :w//2],
-            orientation[h//2:, w//2:]
-        ]
-        
-        for quad in quadrants:
-            hist, _ = np.histogram(quad.flatten(), bins=16, range=(0, 360))
-            features.extend((hist / (hist.sum() + 1e-5)).tolist())
-        
-        print(f"   ✅ Texture features: {len(features) - texture_start} dims", file=sys.stderr)
-        
-        # ========== SHAPE FEATURES (256 dimensions) ==========
-        print("📐 Extracting shape features...", file=sys.stderr)
-        shape_start = len(features)
-        
-        # 1. Canny Edge Maps at multiple thresholds (64 dims)
-        for thresh_low in [30, 50, 70, 100]:
-            edges = cv2.Canny(img_cv, thresh_low, thresh_low * 2)
-            
-            # Divide into 4×4 grid
-            grid_size = 4
-            h_step = 224 // grid_size
-            w_step = 224 // grid_size
-            for i in range(grid_size):
-                for j in range(grid_size):
-                    region = edges[i*h_step:(i+1)*h_step, j*w_step:(j+1)*w_step]
-                    # Percentage of edge pixels in region
-                    features.append(float(region.mean() / 255.0))
-        
-        # 2. Corner Detection (Harris corners) (64 dims: 8×8 grid)
-        gray_uint8 = gray.astype(np.uint8)
-        corners = cv2.cornerHarris(gray_uint8, blockSize=2, ksize=3, k=0.04)
-        corners = cv2.dilate(corners, None)
-        
-        grid_size = 8
-        h_step = 224 // grid_size
-        w_step = 224 // grid_size
-        for i in range(grid_size):
-            for j in range(grid_size):
-                region = corners[i*h_step:(i+1)*h_step, j*w_step:(j+1)*w_step]
-                features.append(float(region.max() / (corners.max() + 1e-5)))
-        
-        # 3. Hough Lines (approximate - 64 dims)
-        edges_canny = cv2.Canny(img_cv, 50, 150)
-        
-        # Line detection in different orientations
-        for angle_bin in range(8):
-            # Detect lines around specific angles
-            lines = cv2.HoughLines(edges_canny, 1, np.pi / 180, threshold=50)
-            
-            # Count lines in 8 angular bins
-            if lines is not None:
-                angles = lines[:, 0, 1] * 180 / np.pi  # Convert to degrees
-                hist, _ = np.histogram(angles, bins=8, range=(0, 180))
-                features.extend((hist / (hist.sum() + 1e-5)).tolist())
-            else:
-                features.extend([0.0] * 8)
-        
-        # 4. Contour Features (64 dims)
-        # Find contours
-        _, binary = cv2.threshold(gray_uint8, 127, 255, cv2.THRESH_BINARY)
-        contours, _ = cv2.findContours(binary, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        
-        # Create contour density map in 8×8 grid
-        contour_map = np.zeros((224, 224), dtype=np.uint8)
-        cv2.drawContours(contour_map, contours, -1, (255), thickness=1)
-        
-        grid_size = 8
-        h_step = 224 // grid_size
-        w_step = 224 // grid_size
-        for i in range(grid_size):
-            for j in range(grid_size):
-                region = contour_map[i*h_step:(i+1)*h_step, j*w_step:(j+1)*w_step]
-                features.append(float(region.mean() / 255.0))
-        
-        # 5. HOG-inspired features (64 dims)
-        # Histogram of Oriented Gradients in 4×4 grid
-        gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
-        gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
-        magnitude = np.sqrt(gx**2 + gy**2)
-        orientation = np.arctan2(gy, gx) * 180 / np.pi
-        orientation = (orientation + 180) % 360
-        
-        grid_size = 4
-        h_step = 224 // grid_size
-        w_step = 224 // grid_size
-        for i in range(grid_size):
-            for j in range(grid_size):
-                region_orient = orientation[i*h_step:(i+1)*h_step, j*w_step:(j+1)*w_step]
-                region_mag = magnitude[i*h_step:(i+1)*h_step, j*w_step:(j+1)*w_step]
-                
-                # Weighted histogram
-                hist, _ = np.histogram(region_orient.flatten(), bins=4, range=(0, 360),
-                                      weights=region_mag.flatten())
-                features.extend((hist / (hist.sum() + 1e-5)).tolist())
-        
-        print(f"   ✅ Shape features: {len(features) - shape_start} dims", file=sys.stderr)
-        
-        # ========== FINAL PROCESSING ==========
-        # Ensure exactly 768 dimensions
-        current_dims = len(features)
-        if current_dims < 768:
-            # Pad with zeros if needed
-            features.extend([0.0] * (768 - current_dims))
-        elif current_dims > 768:
-            # Truncate if somehow we have more
-            features = features[:768]
-        
-        # Normalize the entire feature vector
-        features = np.array(features, dtype=np.float32)
-        norm = np.linalg.norm(features)
-        if norm > 0:
-            features = features / norm
+        cache_key = None
+        if cache is not None:
+            with stage(trace, "cache"):
+                cache_key, cached = cache.lookup(image_path, cache_namespace())
+            if cached is not None:
+                log("CV", "Cache hit", image=_describe(image_path))
+                return {
+                    "embeddings": cached.tolist(),
+                    "success": True,
+                    "dimensions": len(cached),
+                    "model": "Enhanced Computer Vision (768D)",
+                    "cache": {"hit": True, **cache.stats()}
+                }
+        
+        image = load_image(image_path, trace=trace)
+        with stage(trace, "forward"):
+            features = compute_advanced_features(image)
+        
+        if cache_key is not None:
+            cache.put(cache_key, features)
         
         features = features.tolist()
         
-        print(f"✅ Generated {len(features)} dimensional feature vector (ViT-like)", file=sys.stderr)
-        
-        return {
+        result = {
             "embeddings": features,
             "success": True,
             "dimensions": len(features),
             "model": "Enhanced Computer Vision (768D)"
         }
+        if cache is not None:
+            result["cache"] = {"hit": False, **cache.stats()}
+        return result
         
     except Exception as e:
         error_msg = str(e)
-        print(f"❌ Error generating features: {error_msg}", file=sys.stderr)
+        log("ERROR", "Feature extraction failed", error=error_msg)
         import traceback
         traceback.print_exc(file=sys.stderr)
         return {"error": error_msg, "success": False}
@@ -300,14 +261,23 @@ if __name__ == "__main__":
         sys.exit(1)
     
     image_path = sys.argv[1]
+    trace = Trace("classical", image=image_path)
     
     # Generate features
-    result = extract_advanced_features(image_path)
+    with SlowRequestProfiler().profile(trace):
+        result = extract_advanced_features(image_path, cache=open_cache(), trace=trace)
     
     # Output JSON to stdout
     try:
-        print(json.dumps(result))
+        with trace.stage("serialize"):
+            body = json.dumps(result)
+        if result.get("success"):
+            body = with_timings(body, trace)
+        print(body)
         sys.stdout.flush()
     except Exception as e:
         print(json.dumps({"error": "JSON dump failed: " + str(e), "success": False}))
         sys.stdout.flush()
+    trace.finish()
+    log("TIMING", "Request done", **{f"{k}_ms": v for k, v in trace.as_dict()["stages_ms"].items()},
+        total_ms=round(trace.elapsed_ms, 1))
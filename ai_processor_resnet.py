@@ -1,37 +1,129 @@
 ﻿code = """
 Enhanced AI Processor using ResNet-50
 """
-import sys, json, torch
+import os, sys, json, torch
 import torchvision.models as models
 import torchvision.transforms as transforms
 import numpy as np
-from PIL import Image
+from ai_cache import open_cache
+from ai_codec import FORMATS, write_embedding
+from ai_backends import configure_threads, default_backend, prepare_model, weights_fingerprint
+from ai_preprocess import (IMAGENET_MEAN, IMAGENET_STD, FastTransform, exif_transpose_default,
+                           fast_preprocess_default, open_image)
+from ai_projection import Projection
+from ai_metrics import SlowRequestProfiler, Trace, log, stage, with_timings
+
+PROJECTION_ENV = "FINDERAI_RESNET_PROJECTION"
 
 class ResNetProcessor:
-    def __init__(self):
-        print("[AI] Loading ResNet-50...")
-        self.model = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V2)
-        self.model = torch.nn.Sequential(*list(self.model.children())[:-1])
-        self.model.eval()
+    def __init__(self, cache=None, backend=None, fast_preprocess=None, projection=None):
+        startup = Trace("resnet-startup")
+        log("AI", "Loading ResNet-50")
+        configure_threads()
+        self.backend = backend or default_backend()
+        with startup.stage("build_model"):
+            self.model = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V2)
+            self.model = torch.nn.Sequential(*list(self.model.children())[:-1])
+            self.model.eval()
+        self.weights_id = weights_fingerprint("torchvision:IMAGENET1K_V2")
+        if self.backend != "fp32":
+            with startup.stage("backend"):
+                self.model = prepare_model(self.model, self.backend, "resnet50", weights_id=self.weights_id)
         self.transform = transforms.Compose([
             transforms.Resize(256), transforms.CenterCrop(224), transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485,0.456,0.406], std=[0.229,0.224,0.225])])
-        print("[OK] Model loaded")
-    def extract_embedding(self, img_path):
-        img = Image.open(img_path).convert("RGB")
-        t = self.transform(img).unsqueeze(0)
+            transforms.Normalize(mean=list(IMAGENET_MEAN), std=list(IMAGENET_STD))])
+        if fast_preprocess is None:
+            fast_preprocess = fast_preprocess_default()
+        # Same resize/crop/normalise as the Compose, minus its per-image overhead
+        self.fast_transform = FastTransform(256, 224, IMAGENET_MEAN, IMAGENET_STD) if fast_preprocess else None
+        # EXIF orientation is opt-in ($FINDERAI_EXIF_TRANSPOSE); it changes vectors of rotated photos
+        self.exif = exif_transpose_default()
+        # Optional ai_projection file reducing the 2048-D output to compact float16
+        projection = projection or os.environ.get(PROJECTION_ENV)
+        self.projection = Projection.load(projection) if isinstance(projection, str) else projection
+        self.cache = cache
+        self.cache_namespace = (f"resnet50|IMAGENET1K_V2|{self.backend}|resize256-crop224-imagenet"
+                                + ("|exif" if self.exif else "")
+                                + ("|draft-numpy" if fast_preprocess else "")
+                                + (f"|{self.projection.fingerprint}" if self.projection is not None else ""))
+        self.last_cache_hit = False
+        self.startup = startup.finish()
+        log("TIMING", "ResNet-50 loaded", **{f"{k}_s": f"{v:.3f}" for k, v in startup.seconds.items()})
+    def preprocess(self, img, trace=None):
+        # img: path or encoded bytes
+        if self.fast_transform is not None:
+            with stage(trace, "decode"):
+                img = open_image(img, self.fast_transform.resize, exif=self.exif)
+            with stage(trace, "transform"):
+                return torch.from_numpy(self.fast_transform(img))
+        with stage(trace, "decode"):
+            img = open_image(img, exif=self.exif)
+        with stage(trace, "transform"):
+            return self.transform(img)
+    def embed_batch(self, tensors):
+        # One forward pass over preprocessed tensors, one (projected) row per image
         with torch.no_grad():
-            return self.model(t).squeeze().numpy()
+            emb = self.model(torch.stack(tensors)).reshape(len(tensors), -1).numpy()
+        if self.projection is not None:
+            emb = self.projection.apply(emb)
+        return list(emb)
+    def extract_embedding(self, img_path, trace=None):
+        key = None
+        if self.cache is not None:
+            with stage(trace, "cache"):
+                key, cached = self.cache.lookup(img_path, self.cache_namespace)
+            self.last_cache_hit = cached is not None
+            if cached is not None:
+                return cached
+        t = self.preprocess(img_path, trace)
+        with stage(trace, "forward"):
+            emb = self.embed_batch([t])[0]
+        if key is not None:
+            self.cache.put(key, emb)
+        return emb
+
+def main():
+    # Usage: python ai_processor_resnet.py <image_path> [--format json|f32|f16|b64-f32|b64-f16]
+    args = sys.argv[1:]
+    fmt = "json"
+    if "--format" in args:
+        i = args.index("--format")
+        fmt = args[i+1] if i+1 < len(args) else ""
+        del args[i:i+2]
+    if not args:
+        print(json.dumps({"success":False,"error":"Need image path"}))
+        sys.exit(1)
+    if fmt not in FORMATS:
+        print(json.dumps({"success":False,"error":f"Unknown format: {fmt}"}))
+        sys.exit(1)
+    trace = Trace("resnet", image=args[0])
+    try:
+        # torch and torchvision are imported with this module, before the trace starts
+        with SlowRequestProfiler().profile(trace):
+            with trace.stage("model_load"):
+                p = ResNetProcessor(cache=open_cache())
+            emb = p.extract_embedding(args[0], trace)
+            # Compact vectors carry their projection so they are never compared with raw 2048-D ones
+            projection = p.projection.fingerprint if p.projection is not None else None
+            if fmt != "json":
+                with trace.stage("serialize"):
+                    write_embedding(emb, f"ResNet-50 [{projection}]" if projection else "ResNet-50", fmt)
+                return
+            out = {"success":True,"embeddings":emb.tolist(),"dimensions":len(emb),"model":"ResNet-50"}
+            if projection:
+                out["projection"] = projection
+            if p.cache is not None:
+                out["cache"] = {"hit":p.last_cache_hit, **p.cache.stats()}
+            with trace.stage("serialize"):
+                body = json.dumps(out)
+        print(with_timings(body, trace))
+    except Exception as e:
+        print(json.dumps({"success":False,"error":str(e)}))
+        sys.exit(1)
+    finally:
+        trace.finish()
+        log("TIMING", "Request done", **{f"{k}_ms": v for k, v in trace.as_dict()["stages_ms"].items()},
+            total_ms=round(trace.elapsed_ms, 1))
 
-if len(sys.argv) < 2:
-    print(json.dumps({"success":False,"error":"Need image path"}))
-    sys.exit(1)
-try:
-    p = ResNetProcessor()
-    print(f"[Processing] {sys.argv[1]}")
-    emb = p.extract_embedding(sys.argv[1])
-    print(f"[OK] {len(emb)} features")
-    print(json.dumps({"success":True,"embeddings":emb.tolist(),"dimensions":len(emb),"model":"ResNet-50"}))
-except Exception as e:
-    print(json.dumps({"success":False,"error":str(e)}))
-    sys.exit(1)
+if __name__ == "__main__":
+    main()
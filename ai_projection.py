@@ -0,0 +1,288 @@
+"""
+Reduced-dimension embeddings for FinderAI
+Fits a PCA or random (Johnson-Lindenstrauss) projection on existing
+embeddings, applies it to emit compact float16 vectors, and measures the
+top-k recall lost against full-dimension cosine search
+"""
+
+import sys
+import os
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+
+from ai_index import normalize
+
+METHODS = ("pca", "random")
+
+
+class Projection:
+    """
+    Linear map from full embeddings to ``dims`` compact dimensions.
+
+    apply() L2-normalises the input, subtracts ``mean`` (zero unless the
+    projection was fitted with centring), multiplies by ``matrix``,
+    re-normalises and casts to ``dtype``, so compact vectors compare with
+    a plain dot product or the existing cosine code.
+
+    Args:
+        matrix: (input_dims, dims) float32 projection matrix
+        mean: Optional (input_dims,) vector subtracted before projecting
+        method: "pca" or "random", for bookkeeping
+        dtype: Output dtype of apply() (float16 halves storage again)
+        info: Free-form dict saved alongside (source, explained variance...)
+    """
+
+    def __init__(self, matrix, mean=None, method="pca", dtype="float16", info=None):
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        self.input_dims, self.dims = self.matrix.shape
+        self.mean = (np.zeros(self.input_dims, dtype=np.float32) if mean is None
+                     else np.asarray(mean, dtype=np.float32))
+        self.method = method
+        self.dtype = np.dtype(dtype)
+        self.info = info or {}
+
+    @property
+    def fingerprint(self):
+        """Short content hash, used in cache namespaces and result tags"""
+        digest = hashlib.sha256(self.matrix.tobytes())
+        digest.update(self.mean.tobytes())
+        # float16 and float32 outputs of one matrix are different vectors
+        digest.update(self.dtype.name.encode("ascii"))
+        return f"{self.method}{self.dims}-{digest.hexdigest()[:12]}"
+
+    def apply(self, vectors):
+        """Project one vector or a (count, input_dims) matrix"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.shape[-1] != self.input_dims:
+            raise ValueError(f"Projection expects {self.input_dims}-D vectors, got {vectors.shape[-1]}-D")
+        projected = (normalize(vectors) - self.mean) @ self.matrix
+        return normalize(projected).astype(self.dtype)
+
+    def save(self, path):
+        np.savez(path, matrix=self.matrix, mean=self.mean,
+                 meta=np.array(json.dumps({"method": self.method, "dtype": self.dtype.name,
+                                           "info": self.info})))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path, allow_pickle=False)
+        meta = json.loads(str(data["meta"]))
+        return cls(data["matrix"], data["mean"], meta["method"], meta["dtype"], meta.get("info"))
+
+
+def fit_pca(vectors, dims, center=False):
+    """
+    Principal axes of the L2-normalised vectors.
+
+    Without centring this is the SVD of the second-moment matrix, the best
+    rank-``dims`` approximation of the raw dot products (and so of the
+    cosine scores the routes use); centring instead keeps the directions
+    along which items differ most.
+    """
+    vectors = normalize(vectors)
+    if dims > min(vectors.shape):
+        raise ValueError(f"PCA to {dims} dims needs at least {dims} vectors and input dims, "
+                         f"got {vectors.shape[0]} x {vectors.shape[1]}")
+    mean = vectors.mean(axis=0) if center else None
+    centered = vectors - mean if center else vectors
+    _, singular, vt = np.linalg.svd(centered, full_matrices=False)
+    energy = singular ** 2
+    info = {"explained_variance": float(energy[:dims].sum() / energy.sum()),
+            "fitted_on": int(len(vectors)), "centered": bool(center)}
+    return Projection(vt[:dims].T, mean, "pca", info=info)
+
+
+def fit_random(input_dims, dims, seed=0):
+    """Data-independent Johnson-Lindenstrauss projection with orthonormal columns"""
+    if dims > input_dims:
+        raise ValueError(f"Cannot project {input_dims}-D vectors up to {dims} dims")
+    rng = np.random.default_rng(seed)
+    matrix, _ = np.linalg.qr(rng.standard_normal((input_dims, dims)))
+    return Projection(matrix, None, "random", info={"seed": seed})
+
+
+def fit(vectors, method, dims, center=False, seed=0):
+    if method == "pca":
+        return fit_pca(vectors, dims, center)
+    if method == "random":
+        return fit_random(np.asarray(vectors).shape[1], dims, seed)
+    raise ValueError(f"Unknown method '{method}', expected one of {', '.join(METHODS)}")
+
+
+def load_vectors(source):
+    """
+    Read a corpus of embeddings.
+
+    Args:
+        source: An ai_store directory, an ai_index .npz, a .npy matrix, or
+            JSON lines carrying "embeddings" lists (bulk/one-shot output)
+            or base64 framed "data" (ai_codec)
+
+    Returns:
+        (ids, float32 matrix)
+    """
+    if os.path.isdir(source):
+        from ai_store import EmbeddingStore
+        store = EmbeddingStore(source)
+        ids, rows = [], []
+        for segment_ids, vectors, live in store.iter_segments():
+            ids.extend(i for i, alive in zip(segment_ids, live) if alive)
+            rows.append(np.asarray(vectors[live]))
+        return ids, np.concatenate(rows) if rows else np.zeros((0, store.dims), np.float32)
+    if source.endswith(".npz"):
+        data = np.load(source, allow_pickle=False)
+        return json.loads(str(data["ids"])), data["vectors"].astype(np.float32)
+    if source.endswith(".npy"):
+        matrix = np.load(source).astype(np.float32)
+        return list(range(len(matrix))), matrix
+
+    from ai_codec import decode_embeddings
+    ids, rows = [], []
+    with open(source, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if not record.get("success", True):
+                continue
+            if "embeddings" in record:
+                vector = np.asarray(record["embeddings"], dtype=np.float32)
+            elif "data" in record:
+                vector = decode_embeddings(record["data"])[0][0].astype(np.float32)
+            else:
+                continue
+            ids.append(record.get("id", record.get("image", number)))
+            rows.append(vector)
+    if not rows:
+        raise ValueError(f"No embeddings found in {source}")
+    return ids, np.stack(rows)
+
+
+def _top_k(corpus, queries, query_rows, k, chunk=1024):
+    """Row indices of the k best cosine matches per query, excluding the query row itself"""
+    results = np.empty((len(queries), k), dtype=np.int64)
+    for start in range(0, len(queries), chunk):
+        scores = queries[start:start + chunk] @ corpus.T
+        scores[np.arange(len(scores)), query_rows[start:start + chunk]] = -np.inf
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind="stable")
+        results[start:start + chunk] = np.take_along_axis(top, order, axis=1)
+    return results
+
+
+def evaluate(projection, vectors, k=10, queries=500, seed=0, query_rows=None):
+    """
+    Top-k recall of compact-vector search against full-dimension cosine.
+
+    Each query is a corpus vector searched against the rest of the
+    corpus (leave-one-out), in both spaces.
+
+    Returns:
+        Dict with recall@1, recall@k, mean |score error| of the compact
+        top-k, bytes per vector and projection time
+    """
+    full = normalize(vectors)
+    rng = np.random.default_rng(seed)
+    if query_rows is None:
+        query_rows = rng.choice(len(full), min(queries, len(full)), replace=False)
+    k = min(k, len(full) - 1)
+
+    started = time.perf_counter()
+    compact = projection.apply(full)
+    project_seconds = time.perf_counter() - started
+    compact = compact.astype(np.float32)
+
+    expected = _top_k(full, full[query_rows], query_rows, k)
+    actual = _top_k(compact, compact[query_rows], query_rows, k)
+
+    recall = np.mean([len(set(e) & set(a)) / k for e, a in zip(expected, actual)])
+    recall_1 = np.mean(expected[:, 0] == actual[:, 0])
+    full_scores = np.einsum("qd,qkd->qk", full[query_rows], full[actual])
+    compact_scores = np.einsum("qd,qkd->qk", compact[query_rows], compact[actual])
+    return {
+        "method": projection.method,
+        "dims": projection.dims,
+        "dtype": projection.dtype.name,
+        "k": int(k),
+        "queries": int(len(query_rows)),
+        "corpus": int(len(full)),
+        "recall_at_1": round(float(recall_1), 4),
+        f"recall_at_{k}": round(float(recall), 4),
+        "mean_score_error": round(float(np.abs(full_scores - compact_scores).mean()), 5),
+        "bytes_per_vector": projection.dims * projection.dtype.itemsize,
+        "full_bytes_per_vector": projection.input_dims * 4,
+        "project_us_per_vector": round(project_seconds / len(full) * 1e6, 3),
+        **{f"fit_{key}": value for key, value in projection.info.items()}
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit and evaluate compact embedding projections")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    fit_parser = sub.add_parser("fit", help="Fit a projection and save it")
+    fit_parser.add_argument("--input", required=True, help="Store dir, index .npz, .npy or JSON lines")
+    fit_parser.add_argument("--method", choices=METHODS, default="pca")
+    fit_parser.add_argument("--dims", type=int, default=128)
+    fit_parser.add_argument("--center", action="store_true", help="Centre vectors before PCA")
+    fit_parser.add_argument("--seed", type=int, default=0)
+    fit_parser.add_argument("--dtype", choices=("float16", "float32"), default="float16")
+    fit_parser.add_argument("--output", required=True, help="Projection .npz to write")
+
+    eval_parser = sub.add_parser("evaluate", help="Recall of saved projections, or a sweep")
+    eval_parser.add_argument("--input", required=True, help="Store dir, index .npz, .npy or JSON lines")
+    eval_parser.add_argument("--projection", nargs="*", default=[], help="Saved projections to evaluate")
+    eval_parser.add_argument("--sweep-dims", default="",
+                             help="Comma-separated sizes to fit and evaluate, e.g. 64,128,256")
+    eval_parser.add_argument("--methods", default="pca,random", help="Methods for --sweep-dims")
+    eval_parser.add_argument("--holdout", type=float, default=0.2,
+                             help="With --sweep-dims, fraction kept out of fitting and used as queries")
+    eval_parser.add_argument("--k", type=int, default=10)
+    eval_parser.add_argument("--queries", type=int, default=500)
+    eval_parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    ids, vectors = load_vectors(args.input)
+    print(f"[PROJECTION] Loaded {len(ids)} x {vectors.shape[1]} embeddings from {args.input}", file=sys.stderr)
+
+    if args.command == "fit":
+        projection = fit(vectors, args.method, args.dims, args.center, args.seed)
+        projection.dtype = np.dtype(args.dtype)
+        projection.info["source"] = os.path.abspath(args.input)
+        projection.save(args.output)
+        print(json.dumps({"success": True, "output": args.output, "fingerprint": projection.fingerprint,
+                          "input_dims": projection.input_dims, "dims": projection.dims,
+                          "dtype": args.dtype, **projection.info}))
+        return
+
+    failed = False
+    for path in args.projection:
+        report = evaluate(Projection.load(path), vectors, args.k, args.queries, args.seed)
+        print(json.dumps({"projection": path, **report}))
+
+    sizes = [int(size) for size in args.sweep_dims.split(",") if size]
+    if sizes:
+        rng = np.random.default_rng(args.seed)
+        order = rng.permutation(len(vectors))
+        held_out = order[:max(1, int(len(vectors) * args.holdout))]
+        fit_rows = order[len(held_out):]
+        query_rows = held_out[:args.queries]
+        for method in args.methods.split(","):
+            for size in sizes:
+                try:
+                    projection = fit(vectors[fit_rows], method, size, seed=args.seed)
+                except ValueError as e:
+                    print(json.dumps({"method": method, "dims": size, "success": False, "error": str(e)}))
+                    failed = True
+                    continue
+                print(json.dumps(evaluate(projection, vectors, args.k, query_rows=query_rows)))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
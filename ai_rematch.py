@@ -0,0 +1,270 @@
+"""
+Offline lost-vs-found match recomputation for FinderAI
+Scores every open lost item against every open found item with blocked
+matrix multiplication, applying the same rules as the /my-matches route,
+and writes a ranked candidate list per lost item
+"""
+
+import sys
+import re
+import json
+import time
+import argparse
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+import numpy as np
+
+from ai_index import normalize
+
+# Scoring rules of routes/items.js
+CATEGORY_BONUS = 15.0
+MATCH_THRESHOLD = 50.0
+MAX_SCORE = 100.0
+DESCRIPTION_BONUS = 10.0
+
+
+def _oid(value):
+    """Item id from a plain string or mongoexport's {"$oid": ...}"""
+    if isinstance(value, dict):
+        return value.get("$oid") or json.dumps(value, sort_keys=True)
+    return None if value is None else str(value)
+
+
+def load_items(path):
+    """
+    Read items exported as JSON lines (e.g. mongoexport of the items collection).
+
+    Fields used: _id, type, category, studentId, status, claimed,
+    description, embeddings.
+    """
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                item = json.loads(line)
+                item["_id"] = _oid(item.get("_id"))
+                items.append(item)
+    return items
+
+
+def load_dismissed(path):
+    """studentId -> set of dismissed found item ids, from a DismissedMatch export"""
+    dismissed = defaultdict(set)
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    record = json.loads(line)
+                    dismissed[record.get("studentId")].add(_oid(record.get("dismissedItemId")))
+    return dismissed
+
+
+def _words(description):
+    """Split a description the way the route does (lower case, on whitespace)"""
+    return re.split(r"\s+", description.lower()) if description else None
+
+
+def description_bonus(first, second):
+    """The /my-matches description bonus: shared words longer than 3 characters"""
+    first, second = _words(first), _words(second)
+    if first is None or second is None:
+        return 0.0
+    shared = set(second)
+    common = sum(1 for word in first if len(word) > 3 and word in shared)
+    return common / max(len(first), len(second)) * DESCRIPTION_BONUS
+
+
+def _description_matrices(lost, found):
+    """
+    Sparse word matrices whose product counts the shared words of every pair.
+
+    Row i of the first counts lost item i's words longer than 3 characters
+    (repeats included, as the route counts them); row j of the second marks
+    which of those words found item j's description contains.
+    """
+    from scipy import sparse
+
+    vocabulary = {}
+    rows, columns = [], []
+    lost_lengths = np.zeros(len(lost), dtype=np.float32)
+    for row, item in enumerate(lost):
+        words = _words(item.get("description"))
+        if words is None:
+            continue
+        lost_lengths[row] = len(words)
+        for word in words:
+            if len(word) > 3:
+                rows.append(row)
+                columns.append(vocabulary.setdefault(word, len(vocabulary)))
+    counts = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)),
+                               shape=(len(lost), max(len(vocabulary), 1)))
+
+    rows, columns = [], []
+    found_lengths = np.zeros(len(found), dtype=np.float32)
+    for row, item in enumerate(found):
+        words = _words(item.get("description"))
+        if words is None:
+            continue
+        found_lengths[row] = len(words)
+        for word in set(words):
+            if word in vocabulary:
+                rows.append(row)
+                columns.append(vocabulary[word])
+    present = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)),
+                                shape=(len(found), counts.shape[1]))
+    return counts, present.T.tocsc(), lost_lengths, found_lengths
+
+
+def _open(items, item_type):
+    # Claimed items are out either way: the routes check the status field
+    # and the legacy claimed flag
+    return [item for item in items
+            if item.get("type") == item_type
+            and item.get("status") != "claimed" and not item.get("claimed")
+            and item.get("embeddings") is not None and len(item["embeddings"])]
+
+
+def _block_rows(found_count, max_block_mb, matrices):
+    """Lost rows per block so the float32 score blocks stay within max_block_mb"""
+    return max(1, int(max_block_mb * 1024 * 1024 // (4 * matrices * max(found_count, 1))))
+
+
+def rematch(items, dismissed=None, top_k=20, threshold=MATCH_THRESHOLD, max_block_mb=64,
+            use_descriptions=True):
+    """
+    Rank found-item candidates for every open lost item.
+
+    Scores are cosine * 100, +15 when the categories match, plus the
+    description bonus when ``use_descriptions`` is set, capped at 100.
+    Pairs below ``threshold``, pairs reported by the same student and
+    matches the lost item's owner dismissed are left out, as in
+    /my-matches. Scores are computed for blocks of lost rows at a time,
+    every rule as an array operation over the block, so peak memory stays
+    near ``max_block_mb`` whatever the corpus size.
+
+    Returns:
+        (results, stats) where results is a list of dicts, one per lost item
+    """
+    dismissed = dismissed or {}
+    lost = _open(items, "lost")
+    found = _open(items, "found")
+
+    # Vectors of different lengths come from different models; only
+    # compare within the most common dimensionality
+    dims = Counter(len(item["embeddings"]) for item in lost + found).most_common(1)
+    dims = dims[0][0] if dims else 0
+    skipped = sum(1 for item in lost + found if len(item["embeddings"]) != dims)
+    lost = [item for item in lost if len(item["embeddings"]) == dims]
+    found = [item for item in found if len(item["embeddings"]) == dims]
+
+    stats = {"lost": len(lost), "found": len(found), "dims": dims, "skipped_dims": skipped,
+             "pairs": len(lost) * len(found), "candidates": 0}
+    if not lost:
+        return [], stats
+
+    lost_vectors = normalize(np.array([item["embeddings"] for item in lost], dtype=np.float32))
+    found_vectors = normalize(np.array([item["embeddings"] for item in found], dtype=np.float32)) \
+        if found else np.zeros((0, dims), np.float32)
+
+    # Integer codes make the category and same-student rules vectorised comparisons
+    categories = {}
+    lost_category = np.array([categories.setdefault(i.get("category"), len(categories)) for i in lost])
+    found_category = np.array([categories.setdefault(i.get("category"), len(categories)) for i in found],
+                              dtype=np.int64)
+    students = {None: -1}
+    lost_student = np.array([students.setdefault(i.get("studentId"), len(students)) for i in lost])
+    found_student = np.array([students.setdefault(i.get("studentId"), len(students)) for i in found],
+                             dtype=np.int64)
+    found_row = {item["_id"]: row for row, item in enumerate(found)}
+    if use_descriptions:
+        counts, present, lost_lengths, found_lengths = _description_matrices(lost, found)
+
+    block = _block_rows(len(found), max_block_mb, 3 if use_descriptions else 1)
+    stats["block_rows"] = block
+    results = []
+
+    for start in range(0, len(lost), block):
+        stop = min(start + block, len(lost))
+        rows = slice(start, stop)
+        same_category = lost_category[rows, None] == found_category[None, :]
+        scores = lost_vectors[rows] @ found_vectors.T
+        scores *= 100.0
+        scores += CATEGORY_BONUS * same_category
+        if use_descriptions:
+            common = (counts[rows] @ present).toarray()
+            text = common * (DESCRIPTION_BONUS / np.maximum(
+                np.maximum(lost_lengths[rows, None], found_lengths[None, :]), 1.0))
+            scores += text
+        np.minimum(scores, MAX_SCORE, out=scores)
+
+        scores[(lost_student[rows, None] == found_student[None, :]) & (lost_student[rows, None] >= 0)] = -np.inf
+        for offset in range(stop - start):
+            for found_id in dismissed.get(lost[start + offset].get("studentId"), ()):
+                if found_id in found_row:
+                    scores[offset, found_row[found_id]] = -np.inf
+
+        for offset in range(stop - start):
+            row = scores[offset]
+            columns = np.flatnonzero(row >= threshold)
+            if top_k and len(columns) > top_k:
+                columns = columns[np.argpartition(-row[columns], top_k - 1)[:top_k]]
+            columns = columns[np.argsort(-row[columns], kind="stable")]
+
+            candidates = []
+            for column in columns:
+                bonus = CATEGORY_BONUS if same_category[offset, column] else 0.0
+                candidates.append({
+                    "foundItemId": found[column]["_id"],
+                    "similarity": round(float(row[column]), 4),
+                    "visual": round(float(lost_vectors[start + offset] @ found_vectors[column]) * 100.0, 4),
+                    "categoryBonus": bonus,
+                    "descriptionBonus": round(float(text[offset, column]), 4) if use_descriptions else 0.0
+                })
+            stats["candidates"] += len(candidates)
+            item = lost[start + offset]
+            results.append({"lostItemId": item["_id"], "studentId": item.get("studentId"),
+                            "category": item.get("category"), "candidates": candidates})
+    return results, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Recompute ranked lost-vs-found match candidates for all items")
+    parser.add_argument("items", help="Items as JSON lines (mongoexport of the items collection)")
+    parser.add_argument("--dismissed", metavar="FILE",
+                        help="DismissedMatch records as JSON lines, excluded per student")
+    parser.add_argument("--output", metavar="FILE", help="Write JSON lines here instead of stdout")
+    parser.add_argument("--top-k", type=int, default=20, help="Candidates kept per lost item (0 = all)")
+    parser.add_argument("--threshold", type=float, default=MATCH_THRESHOLD,
+                        help="Minimum final similarity, as in the routes")
+    parser.add_argument("--max-block-mb", type=float, default=64,
+                        help="Memory bound for one block of the similarity matrix")
+    parser.add_argument("--no-descriptions", action="store_true",
+                        help="Skip the /my-matches description-overlap bonus")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    items = load_items(args.items)
+    loaded = time.perf_counter()
+    results, stats = rematch(items, load_dismissed(args.dismissed), args.top_k, args.threshold,
+                             args.max_block_mb, not args.no_descriptions)
+    scored = time.perf_counter()
+
+    computed_at = datetime.now(timezone.utc).isoformat()
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for result in results:
+            out.write(json.dumps({**result, "computedAt": computed_at}) + "\n")
+    finally:
+        if args.output:
+            out.close()
+
+    stats.update({"load_s": round(loaded - started, 3), "score_s": round(scored - loaded, 3),
+                  "total_s": round(time.perf_counter() - started, 3)})
+    print(f"[REMATCH] {json.dumps(stats)}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
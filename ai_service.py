@@ -0,0 +1,490 @@
+"""
+Asyncio embedding service for FinderAI
+Local HTTP/1.1 API (TCP on localhost or a Unix socket) with keep-alive,
+executor-run inference and coalescing of identical in-flight images
+"""
+
+import sys
+import os
+import json
+import time
+import base64
+import signal
+import hashlib
+import asyncio
+import argparse
+import binascii
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ai_codec import pack_result
+from ai_cache import open_cache
+from ai_worker import EmbeddingWorker
+from ai_metrics import Trace
+from ai_embedders import INPUT_ERRORS, available_embedders, get_embedder
+
+MAX_BODY_BYTES = 16 * 1024 * 1024
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           411: "Length Required", 413: "Payload Too Large", 500: "Internal Server Error",
+           503: "Service Unavailable"}
+
+
+class RequestError(Exception):
+    """Client error mapped to an HTTP status"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _number(body, name, kind=int, default=None):
+    """Numeric request option, or a 400 naming it when it is not a number"""
+    value = body.get(name, default)
+    if value is None:
+        return None
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        raise RequestError(400, f"'{name}' must be a number, got {value!r}")
+
+
+class EmbeddingService:
+    """
+    Serves embeddings and similarity search to the Node backend.
+
+    Endpoints (JSON bodies and replies):
+        POST /embed   {"image": path} or {"image_b64": ...}, optional "format"
+                      {"images": [{"image": ...} | {"image_b64": ...}, ...]} for a batch
+                      a raw image/* body is embedded directly
+        POST /search  {"embedding": [...]} or an image as above, plus optional
+                      "k", "filters", "min_score", "exclude", "nprobe", and
+                      "include" (candidate ids from a first stage such as ai_phash);
+                      with a MultiVectorIndex, items are ranked by max-sim over
+                      their views, "shortlist" bounds the re-scored rows and
+                      "embedding" may also be a [views, dims] set
+        GET  /health
+
+    Inference runs on a thread pool so the event loop keeps accepting
+    connections. Requests for the same image content share one
+    computation: the first computes, later ones await the same task.
+
+    Args:
+        embedder: Registered embedder (see ai_embedders)
+        index: Optional ai_index.VectorIndex or MultiVectorIndex for /search
+        store: Optional ai_store.EmbeddingStore for /search (used if no index)
+        batcher: Optional ai_batching.MicroBatcher over embedder.embed_batch
+        threads: Executor threads (defaults to the batch size, or 2)
+        max_inflight: Distinct images being computed before replying 503
+        dedup: Optional ai_phash.NearDuplicateFilter; near-identical uploads
+            reuse an earlier vector without a forward pass
+        router: Optional ai_embedders.LoadAwareEmbedder over ``embedder``;
+            /embed requests beyond its max_inflight, or failing on the
+            preferred model, are answered by its cheap embedder and tagged
+            as such. /search queries always use ``embedder``, whose space
+            the index is in.
+    """
+
+    def __init__(self, embedder, index=None, store=None, batcher=None, threads=None, max_inflight=64,
+                 dedup=None, router=None):
+        self.embedder = embedder
+        self.index = index
+        self.store = store
+        self.router = router
+        self.worker = EmbeddingWorker(embedder, embedder.build_result, embedder.model_id, batcher=batcher,
+                                      dedup=dedup)
+        if threads is None:
+            if batcher is not None:
+                threads = batcher.max_batch_size
+            elif router is not None:
+                # Room for requests beyond max_inflight, which go to the cheap embedder
+                threads = router.max_inflight * 2
+            else:
+                threads = 2
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="service-infer")
+        self.max_inflight = max_inflight
+        self.started = time.time()
+        self._inflight = {}
+        self.counters = {"requests": 0, "errors": 0, "embeddings": 0, "computed": 0,
+                         "coalesced": 0, "rejected": 0, "searches": 0}
+
+    # ---------- embedding ----------
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def _image_bytes(self, item):
+        if isinstance(item, (bytes, bytearray)):
+            return bytes(item)
+        if not isinstance(item, dict):
+            raise RequestError(400, "Each image must be an object with 'image' or 'image_b64'")
+        if item.get("image_b64"):
+            try:
+                return base64.b64decode(item["image_b64"], validate=True)
+            except (binascii.Error, ValueError) as e:
+                raise RequestError(400, f"Invalid image_b64: {e}")
+        path = item.get("image")
+        if not path:
+            raise RequestError(400, "Missing 'image' path or 'image_b64'")
+        if not os.path.exists(path):
+            raise RequestError(400, f"Image file not found: {path}")
+
+        def read():
+            with open(path, "rb") as f:
+                return f.read()
+        return await self._run(read)
+
+    async def embed(self, item, route=False):
+        """
+        (embedding, embedder that produced it) for one image, sharing the
+        work with identical in-flight requests; ``route`` lets the router
+        pick the embedder
+        """
+        image = await self._image_bytes(item)
+        route = route and self.router is not None
+        key = hashlib.sha256(image).hexdigest() + ("|routed" if route else "")
+        self.counters["embeddings"] += 1
+        task = self._inflight.get(key)
+        if task is not None:
+            self.counters["coalesced"] += 1
+        else:
+            if len(self._inflight) >= self.max_inflight:
+                self.counters["rejected"] += 1
+                raise RequestError(503, f"{len(self._inflight)} images already in flight")
+            task = asyncio.get_running_loop().create_task(self._compute(image, route))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield: one client disconnecting must not cancel a shared computation
+        return await asyncio.shield(task)
+
+    async def _compute(self, image, route=False):
+        self.counters["computed"] += 1
+        # Coalesced requests share one computation, so its timings go to
+        # the metrics sink rather than into each reply
+        trace = Trace("service", model=self.embedder.model_id)
+        try:
+            if route:
+                return await self._run(self.router.embed, image, trace)
+            return await self._run(self.worker.compute, image, trace), self.embedder
+        except INPUT_ERRORS as e:
+            # Not an image, truncated or oversized: the client's error
+            raise RequestError(400, f"Could not decode image: {e}")
+        finally:
+            trace.finish()
+
+    def _result(self, computed, fmt):
+        embedding, embedder = computed
+        if fmt == "json":
+            return embedder.build_result(embedding)
+        if not fmt.startswith("b64-"):
+            raise RequestError(400, f"Unsupported format over JSON: {fmt}")
+        return {**pack_result(embedding, embedder.model_id, fmt), **embedder.tag()}
+
+    async def handle_embed(self, body):
+        fmt = body.get("format", "json") if isinstance(body, dict) else "json"
+        if isinstance(body, dict) and "images" in body:
+            if not isinstance(body["images"], list):
+                raise RequestError(400, "'images' must be a list")
+
+            async def one(item):
+                try:
+                    return self._result(await self.embed(item, route=True), fmt)
+                except Exception as e:
+                    return {"success": False, "error": str(e)}
+
+            results = await asyncio.gather(*(one(item) for item in body["images"]))
+            return {"success": all(r["success"] for r in results), "results": list(results)}
+        return self._result(await self.embed(body, route=True), fmt)
+
+    # ---------- search ----------
+
+    async def handle_search(self, body):
+        if self.index is None and self.store is None:
+            raise RequestError(404, "No index or store loaded; start with --index or --store")
+        if not isinstance(body, dict):
+            raise RequestError(400, "Search body must be a JSON object")
+        if body.get("embedding") is not None:
+            try:
+                query = np.asarray(body["embedding"], dtype=np.float32)
+            except (TypeError, ValueError) as e:
+                raise RequestError(400, f"Invalid embedding: {e}")
+        else:
+            query, _ = await self.embed(body)
+        dims = self.index.dims if self.index is not None else self.store.dims
+        # A multi-vector index also takes a set of query views
+        multi = self.index is not None and hasattr(self.index, "max_views")
+        if query.shape != (dims,) and not (multi and query.ndim == 2 and len(query) and query.shape[1] == dims):
+            expected = f"[{dims}] or [views, {dims}]" if multi else f"[{dims}]"
+            raise RequestError(400, f"Query has shape {list(query.shape)}, expected {expected}")
+
+        k = _number(body, "k", default=10)
+        min_score = _number(body, "min_score", float)
+        exclude = body.get("exclude")
+        self.counters["searches"] += 1
+        if self.index is not None:
+            options = {}
+            if body.get("shortlist") is not None:
+                if not multi:
+                    raise RequestError(400, "shortlist needs a multi-vector --index")
+                options["shortlist"] = _number(body, "shortlist")
+            nprobe = _number(body, "nprobe")
+            try:
+                hits = await self._run(lambda: self.index.search(
+                    query, k, filters=body.get("filters"), min_score=min_score,
+                    nprobe=nprobe, exclude=exclude, include=body.get("include"), **options))
+            except KeyError as e:
+                raise RequestError(400, str(e))
+            matches = [{"id": item_id, "score": score, "metadata": metadata}
+                       for item_id, score, metadata in hits]
+        else:
+            if body.get("filters") or body.get("include") is not None:
+                raise RequestError(400, "Filters and include need an --index")
+            hits = await self._run(lambda: self.store.search(query, k, exclude=exclude))
+            matches = [{"id": item_id, "score": score} for item_id, score in hits
+                       if min_score is None or score >= min_score]
+        return {"success": True, "matches": matches}
+
+    def health(self):
+        status = {
+            "success": True,
+            "status": "ready",
+            **self.embedder.tag(),
+            "pid": os.getpid(),
+            "uptime": round(time.time() - self.started, 3),
+            "inflight": len(self._inflight),
+            **self.counters
+        }
+        if self.index is not None:
+            status["index"] = {"items": len(self.index), "dims": self.index.dims}
+            if hasattr(self.index, "max_views"):
+                status["index"]["max_views"] = self.index.max_views
+        elif self.store is not None:
+            status["store"] = self.store.stats()
+        if self.worker.batcher is not None:
+            status["batching"] = self.worker.batcher.stats()
+        if self.embedder.cache is not None:
+            status["cache"] = self.embedder.cache.stats()
+        if self.worker.dedup is not None:
+            status["dedup"] = self.worker.dedup.stats()
+        if self.router is not None:
+            status["routing"] = self.router.stats()
+        return status
+
+    # ---------- HTTP ----------
+
+    async def dispatch(self, method, path, headers, body):
+        route = path.split("?", 1)[0]
+        if route == "/health":
+            if method != "GET":
+                raise RequestError(405, "Use GET /health")
+            return self.health()
+        if route not in ("/embed", "/search"):
+            raise RequestError(404, f"No route for {path}")
+        if method != "POST":
+            raise RequestError(405, f"Use POST {route}")
+
+        content_type = headers.get("content-type", "application/json")
+        if content_type.startswith("image/") or content_type == "application/octet-stream":
+            payload = body
+        else:
+            try:
+                payload = json.loads(body or b"{}")
+            except ValueError as e:
+                raise RequestError(400, f"Invalid JSON: {e}")
+        if route == "/embed":
+            return await self.handle_embed(payload)
+        return await self.handle_search(payload)
+
+    async def handle_connection(self, reader, writer):
+        """Serve HTTP/1.1 requests on one connection until it closes"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self._respond(writer, 400, {"success": False, "error": "Malformed request line"}, False)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = (headers.get("connection", "").lower() != "close"
+                              and version.upper() == "HTTP/1.1")
+
+                status, reply = 200, None
+                length = headers.get("content-length")
+                if length is not None:
+                    # isdigit() also accepts characters int() rejects, such as "²"
+                    length = int(length) if length.isascii() and length.isdecimal() else -1
+                if "chunked" in headers.get("transfer-encoding", "").lower():
+                    status, keep_alive = 411, False
+                    reply = {"success": False, "error": "Send a Content-Length, not chunked encoding"}
+                elif length is not None and length < 0:
+                    # The body cannot be framed, so the connection cannot be reused
+                    status, keep_alive = 400, False
+                    reply = {"success": False, "error": f"Invalid Content-Length: {headers['content-length']}"}
+                elif length is not None and length > MAX_BODY_BYTES:
+                    status, keep_alive = 413, False
+                    reply = {"success": False, "error": f"Body larger than {MAX_BODY_BYTES} bytes"}
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    self.counters["requests"] += 1
+                    try:
+                        reply = await self.dispatch(method.upper(), path, headers, body)
+                    except RequestError as e:
+                        status, reply = e.status, {"success": False, "error": str(e)}
+                    except Exception as e:
+                        print(f"[SERVICE] {method} {path} failed: {e}", file=sys.stderr)
+                        status, reply = 500, {"success": False, "error": str(e)}
+                    if status != 200 or not reply.get("success", True):
+                        self.counters["errors"] += 1
+                await self._respond(writer, status, reply, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, reply, keep_alive):
+        payload = json.dumps(reply).encode("utf-8")
+        head = [f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+                "Content-Type: application/json",
+                f"Content-Length: {len(payload)}",
+                "Connection: " + ("keep-alive" if keep_alive else "close")]
+        if status == 503:
+            head.append("Retry-After: 1")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + payload)
+        await writer.drain()
+
+    async def serve(self, host="127.0.0.1", port=8765, socket_path=None, refresh_interval=None):
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            server = await asyncio.start_unix_server(self.handle_connection, socket_path)
+            where = socket_path
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+            where = f"http://{host}:{port}"
+        print(f"[SERVICE] Listening on {where}", file=sys.stderr)
+
+        if self.store is not None and refresh_interval:
+            async def refresh():
+                # Pick up vectors appended by other processes
+                while True:
+                    await asyncio.sleep(refresh_interval)
+                    await self._run(self.store.refresh)
+            asyncio.get_running_loop().create_task(refresh())
+
+        stop = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            asyncio.get_running_loop().add_signal_handler(signum, stop.set)
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            if socket_path and os.path.exists(socket_path):
+                os.unlink(socket_path)
+
+    def close(self):
+        self.worker.close()
+        self.executor.shutdown(wait=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local HTTP embedding and search service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", metavar="PATH", help="Listen on a Unix socket instead of TCP")
+    parser.add_argument("--embedder", default="vit", choices=available_embedders())
+    parser.add_argument("--backend", help="Inference backend for torch embedders")
+    parser.add_argument("--cache", metavar="FILE",
+                        help="Embedding cache database (default: $FINDERAI_EMBEDDING_CACHE)")
+    parser.add_argument("--fast-preprocess", action="store_true", default=None,
+                        help="Reduced-scale JPEG decode and NumPy normalisation")
+    parser.add_argument("--projection", metavar="FILE",
+                        help="With a torch embedder, emit compact vectors (see ai_projection)")
+    parser.add_argument("--max-batch-size", type=int, default=1,
+                        help="Merge up to this many concurrent images per forward pass")
+    parser.add_argument("--max-wait-ms", type=float, default=20.0,
+                        help="Longest an image waits for its batch to fill")
+    parser.add_argument("--threads", type=int, help="Inference executor threads")
+    parser.add_argument("--max-inflight", type=int, default=64,
+                        help="Distinct images computing at once before replying 503")
+    parser.add_argument("--fallback", choices=available_embedders(),
+                        help="Cheap embedder answering /embed under load or when --embedder fails")
+    parser.add_argument("--fallback-inflight", type=int, default=2,
+                        help="With --fallback, concurrent /embed requests on --embedder before routing to it")
+    parser.add_argument("--dedup-radius", type=int, default=0,
+                        help="Reuse the vector of a near-identical earlier upload "
+                             "(perceptual hash within this many bits; 0 = off)")
+    parser.add_argument("--index", metavar="FILE", help="VectorIndex or MultiVectorIndex .npz to search (see ai_index)")
+    parser.add_argument("--store", metavar="DIR", help="EmbeddingStore directory to search (see ai_store)")
+    parser.add_argument("--refresh-interval", type=float, default=5.0,
+                        help="With --store, seconds between re-reading the store")
+    args = parser.parse_args()
+    if args.fallback and (args.max_batch_size > 1 or args.dedup_radius > 0):
+        # Routed requests call the embedders directly, outside the batcher and filter
+        parser.error("--fallback cannot be combined with --max-batch-size or --dedup-radius")
+
+    def options(name):
+        opts = {"cache": open_cache(args.cache), "fast_preprocess": args.fast_preprocess}
+        if name != "classical":
+            if args.backend:
+                opts["backend"] = args.backend
+            if args.projection:
+                opts["projection"] = args.projection
+        return opts
+
+    embedder = get_embedder(args.embedder, **options(args.embedder))
+    router = None
+    if args.fallback:
+        from ai_embedders import LoadAwareEmbedder
+        router = LoadAwareEmbedder(embedder, get_embedder(args.fallback, **options(args.fallback)),
+                                   args.fallback_inflight)
+
+    index = store = None
+    if args.index:
+        from ai_index import load_index
+        index = load_index(args.index)
+    elif args.store:
+        from ai_store import EmbeddingStore
+        store = EmbeddingStore(args.store)
+
+    batcher = None
+    if args.max_batch_size > 1:
+        from ai_batching import MicroBatcher
+        batcher = MicroBatcher(embedder.embed_batch, args.max_batch_size, args.max_wait_ms)
+
+    # Load the model before listening so the first request does not pay for it
+    if router is None:
+        embedder.processor
+    else:
+        router.cheap.processor
+        try:
+            embedder.processor
+        except Exception as e:
+            # /embed still answers through the fallback; each request retries the load
+            print(f"[SERVICE] {args.embedder} failed to load, serving /embed with "
+                  f"{args.fallback}: {e}", file=sys.stderr)
+    dedup = None
+    if args.dedup_radius > 0:
+        from ai_phash import NearDuplicateFilter
+        dedup = NearDuplicateFilter(args.dedup_radius)
+    service = EmbeddingService(embedder, index, store, batcher, args.threads, args.max_inflight, dedup, router)
+    try:
+        asyncio.run(service.serve(args.host, args.port, args.socket, args.refresh_interval))
+    finally:
+        service.close()
+        print("[SERVICE] Stopped", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,434 @@
+"""
+Memory-mapped embedding store for FinderAI
+Append-only float32 segment files plus id tables, opened with
+numpy.memmap so worker processes share one page-cached copy of the vectors
+"""
+
+import os
+import sys
+import json
+import fcntl
+import threading
+import numpy as np
+from contextlib import contextmanager
+
+from ai_index import normalize
+
+MANIFEST = "manifest.json"
+TOMBSTONES = "tombstones.log"
+LOCKFILE = "LOCK"
+
+
+class EmbeddingStore:
+    """
+    Directory of append-only embedding segments.
+
+    Layout:
+        manifest.json       dims and the ordered list of live segments
+        seg-000001.f32      rows of little-endian float32 vectors
+        seg-000001.ids      one item id per line, row-aligned with .f32
+        tombstones.log      "<segment> <row>" per deleted row
+
+    Writing an id again appends a new row that supersedes the old one.
+    Deleting writes a tombstone for the row currently holding the id.
+    Vectors are written before their id lines, so the id table defines
+    which rows exist and a torn write is ignored on reopen. compact()
+    rewrites all live rows into a fresh segment and drops dead ones.
+    Readers that still map an old segment keep working until they call
+    refresh().
+
+    Each manifest write bumps a generation number. Writers catch up on
+    other processes' appends and tombstones by reading only the bytes
+    added since their last look, and re-read everything only when the
+    generation has moved (rollover or compaction). Before appending,
+    a writer truncates whatever a torn write left past the last complete
+    id line, so new ids never land on a leftover vector row.
+
+    Writers serialise on an flock()ed LOCK file, so several processes
+    may share one store directory.
+
+    Args:
+        path: Store directory (created if missing)
+        dims: Vector dimensionality; required when creating a new store
+        segment_rows: Rows per segment before a new one is started
+        normalize_vectors: L2-normalise vectors on write so search() is
+            a plain dot product
+    """
+
+    def __init__(self, path, dims=None, segment_rows=65536, normalize_vectors=True):
+        self.path = path
+        self.segment_rows = segment_rows
+        self.normalize_vectors = normalize_vectors
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.RLock()
+        self._compactor = None
+        self._compactor_stop = threading.Event()
+        self._generation = 0
+
+        manifest_path = os.path.join(path, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                stored_dims = json.load(f)["dims"]
+            if dims is not None and dims != stored_dims:
+                raise ValueError(f"Store at {path} holds {stored_dims}-D vectors, not {dims}-D")
+            self.dims = stored_dims
+        else:
+            if dims is None:
+                raise ValueError("dims is required to create a new store")
+            self.dims = dims
+            with self._file_lock():
+                if not os.path.exists(manifest_path):
+                    self._write_manifest([1])
+        self.refresh()
+
+    # ---------- files ----------
+
+    def _segment_path(self, seq, ext):
+        return os.path.join(self.path, f"seg-{seq:06d}.{ext}")
+
+    def _read_manifest(self):
+        with open(os.path.join(self.path, MANIFEST), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_manifest(self, segments):
+        tmp = os.path.join(self.path, MANIFEST + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"dims": self.dims, "dtype": "float32", "segments": segments,
+                       "generation": self._generation + 1}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+
+    @contextmanager
+    def _file_lock(self):
+        with open(os.path.join(self.path, LOCKFILE), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _discard(self, seq):
+        # Leftovers of an interrupted compaction or rollover must not be
+        # appended to when the sequence number is reused
+        for ext in ("f32", "ids"):
+            if os.path.exists(self._segment_path(seq, ext)):
+                os.unlink(self._segment_path(seq, ext))
+
+    def _map(self, seq, rows):
+        if rows == 0:
+            return np.zeros((0, self.dims), dtype=np.float32)
+        return np.memmap(self._segment_path(seq, "f32"), dtype="<f4", mode="r", shape=(rows, self.dims))
+
+    # ---------- loading ----------
+
+    def _read_ids(self, seq, offset=0):
+        """Complete id lines from byte ``offset`` on, and the offset just past them"""
+        path = self._segment_path(seq, "ids")
+        if not os.path.exists(path):
+            return [], offset
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        # A trailing line without its newline is a torn write, not an id
+        end = data.rfind(b"\n") + 1
+        return data[:end].decode("utf-8").splitlines(), offset + end
+
+    def _stored_rows(self, seq):
+        path = self._segment_path(seq, "f32")
+        return os.path.getsize(path) // (self.dims * 4) if os.path.exists(path) else 0
+
+    def refresh(self):
+        """Re-read the manifest, id tables and tombstones from disk"""
+        with self._lock:
+            manifest = self._read_manifest()
+            segments = []
+            locations = {}
+            for seq in manifest["segments"]:
+                ids, ids_end = self._read_ids(seq)
+                rows = min(len(ids), self._stored_rows(seq))
+                if rows < len(ids):
+                    ids_end -= sum(len(item_id.encode("utf-8")) + 1 for item_id in ids[rows:])
+                    ids = ids[:rows]
+                segment = {"seq": seq, "ids": [], "vectors": None, "live": np.zeros(0, dtype=bool),
+                           "ids_end": ids_end}
+                segments.append(segment)
+                self._extend(segment, ids, locations)
+
+            self._segments = segments
+            self._by_seq = {segment["seq"]: segment for segment in segments}
+            self._locations = locations
+            self._tombstones_end = 0
+            self._apply_tombstones()
+            self._generation = manifest.get("generation", 0)
+
+    def _extend(self, segment, ids, locations):
+        """Add rows already on disk to a loaded segment, superseding older rows of the same ids"""
+        first = len(segment["ids"])
+        segment["ids"].extend(ids)
+        segment["live"] = np.concatenate([segment["live"], np.ones(len(ids), dtype=bool)])
+        segment["vectors"] = self._map(segment["seq"], len(segment["ids"]))
+        for row, item_id in enumerate(ids, first):
+            previous = locations.get(item_id)
+            if previous is not None:
+                previous[0]["live"][previous[1]] = False
+            locations[item_id] = (segment, row)
+
+    def _apply_tombstones(self):
+        """Apply tombstone lines written since the last call"""
+        path = os.path.join(self.path, TOMBSTONES)
+        if not os.path.exists(path) or os.path.getsize(path) <= self._tombstones_end:
+            return
+        with open(path, "rb") as f:
+            f.seek(self._tombstones_end)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        self._tombstones_end += end
+        for line in data[:end].decode("utf-8").splitlines():
+            parts = line.split()
+            if len(parts) != 2:
+                continue
+            segment = self._by_seq.get(int(parts[0]))
+            row = int(parts[1])
+            if segment is None or row >= len(segment["ids"]):
+                continue
+            segment["live"][row] = False
+            item_id = segment["ids"][row]
+            location = self._locations.get(item_id)
+            if location is not None and location[0] is segment and location[1] == row:
+                del self._locations[item_id]
+
+    def _catch_up(self):
+        """
+        Bring the in-memory view up to date before a write (file lock held).
+
+        Costs only the bytes other writers added since the last call unless
+        the manifest generation changed, which needs a full refresh().
+        """
+        if self._read_manifest().get("generation", 0) != self._generation:
+            self.refresh()
+            return
+        segment = self._segments[-1]
+        ids, segment["ids_end"] = self._read_ids(segment["seq"], segment["ids_end"])
+        if ids:
+            self._extend(segment, ids, self._locations)
+        self._apply_tombstones()
+
+    # ---------- writes ----------
+
+    def put(self, item_id, vector):
+        self.put_many([item_id], [vector])
+
+    def put_many(self, item_ids, vectors):
+        """Append vectors; ids already present are superseded"""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dims)
+        if len(item_ids) != len(vectors):
+            raise ValueError("item_ids and vectors must have the same length")
+        for item_id in item_ids:
+            if "\n" in str(item_id):
+                raise ValueError("Item ids may not contain newlines")
+        if self.normalize_vectors:
+            vectors = normalize(vectors)
+
+        with self._lock, self._file_lock():
+            self._catch_up()
+            start = 0
+            while start < len(item_ids):
+                segment = self._segments[-1]
+                room = self.segment_rows - len(segment["ids"])
+                if room <= 0:
+                    self._discard(segment["seq"] + 1)
+                    self._write_manifest([s["seq"] for s in self._segments] + [segment["seq"] + 1])
+                    self.refresh()
+                    continue
+                chunk_ids = [str(i) for i in item_ids[start:start + room]]
+                self._append(segment, chunk_ids, vectors[start:start + room])
+                start += len(chunk_ids)
+
+    def _append(self, segment, item_ids, vectors):
+        """Append rows to a caught-up segment (file lock held) and load them"""
+        seq = segment["seq"]
+        vectors_path = self._segment_path(seq, "f32")
+        ids_path = self._segment_path(seq, "ids")
+        # Drop what a torn write left past the last complete id line: extra
+        # vector rows, or a partial id line
+        for path, size in ((vectors_path, len(segment["ids"]) * self.dims * 4),
+                           (ids_path, segment["ids_end"])):
+            if os.path.exists(path) and os.path.getsize(path) != size:
+                os.truncate(path, size)
+        segment["ids_end"] += self._write_rows(seq, item_ids, vectors)
+        self._extend(segment, item_ids, self._locations)
+
+    def _write_rows(self, seq, item_ids, vectors):
+        """Append vectors, then their id lines; returns the id bytes written"""
+        with open(self._segment_path(seq, "f32"), "ab") as f:
+            f.write(vectors.astype("<f4").tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        data = "".join(item_id + "\n" for item_id in item_ids).encode("utf-8")
+        with open(self._segment_path(seq, "ids"), "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        return len(data)
+
+    def delete(self, item_id):
+        """Tombstone an item (e.g. claimed or deleted); False if absent"""
+        return self.delete_many([item_id]) > 0
+
+    def delete_many(self, item_ids):
+        with self._lock, self._file_lock():
+            self._catch_up()
+            lines = []
+            for item_id in item_ids:
+                location = self._locations.get(str(item_id))
+                if location is not None:
+                    lines.append(f"{location[0]['seq']} {location[1]}\n")
+            if lines:
+                path = os.path.join(self.path, TOMBSTONES)
+                if os.path.exists(path) and os.path.getsize(path) != self._tombstones_end:
+                    os.truncate(path, self._tombstones_end)
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write("".join(lines))
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._apply_tombstones()
+            return len(lines)
+
+    # ---------- reads ----------
+
+    def __len__(self):
+        return len(self._locations)
+
+    def __contains__(self, item_id):
+        return str(item_id) in self._locations
+
+    def get(self, item_id):
+        segment, row = self._locations[str(item_id)]
+        return np.array(segment["vectors"][row])
+
+    def iter_segments(self):
+        """
+        Yield (ids, vectors, live) per segment, where vectors is a
+        read-only memmap and live is a boolean row mask.
+        """
+        for segment in self._segments:
+            if len(segment["ids"]):
+                yield segment["ids"], segment["vectors"], segment["live"]
+
+    def search(self, query, k=10, exclude=None, chunk_rows=65536):
+        """
+        Top-k cosine search scanning the mapped segments in chunks.
+
+        Returns:
+            List of (item_id, similarity), best first
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(self.dims)
+        if k <= 0:
+            return []
+        if self.normalize_vectors:
+            query = normalize(query)
+        # Excluded rows are masked like tombstones, before the per-chunk
+        # top-k, so excluding an item never costs a result slot
+        excluded = {}
+        for item_id in exclude or ():
+            location = self._locations.get(str(item_id))
+            if location is not None:
+                excluded.setdefault(location[0]["seq"], []).append(location[1])
+
+        best_ids = []
+        best_scores = np.empty(0, dtype=np.float32)
+        for segment in self._segments:
+            ids, vectors, live = segment["ids"], segment["vectors"], segment["live"]
+            # A concurrent put may have grown one of these already
+            rows = min(len(vectors), len(live))
+            dead = ~live[:rows]
+            if segment["seq"] in excluded:
+                dead[[row for row in excluded[segment["seq"]] if row < rows]] = True
+            for start in range(0, rows, chunk_rows):
+                stop = min(start + chunk_rows, rows)
+                scores = vectors[start:stop] @ query
+                scores[dead[start:stop]] = -np.inf
+                take = min(k, len(scores))
+                top = np.argpartition(-scores, take - 1)[:take]
+                top = top[np.isfinite(scores[top])]
+                best_ids.extend(ids[start + i] for i in top)
+                best_scores = np.concatenate([best_scores, scores[top]])
+
+        order = np.argsort(-best_scores, kind="stable")[:k]
+        return [(best_ids[i], float(best_scores[i])) for i in order]
+
+    def stats(self):
+        rows = sum(len(segment["ids"]) for segment in self._segments)
+        return {
+            "dims": self.dims,
+            "segments": len(self._segments),
+            "rows": rows,
+            "live": len(self._locations),
+            "dead": rows - len(self._locations),
+            "bytes": rows * self.dims * 4
+        }
+
+    # ---------- compaction ----------
+
+    def compact(self, chunk_rows=65536):
+        """
+        Rewrite all live rows into a new segment and drop the old ones.
+
+        Returns:
+            Number of dead rows reclaimed
+        """
+        with self._lock, self._file_lock():
+            self.refresh()
+            before = self.stats()
+            if before["dead"] == 0:
+                return 0
+
+            next_seq = self._segments[-1]["seq"] + 1
+            self._discard(next_seq)
+            for ids, vectors, live in self.iter_segments():
+                for start in range(0, len(ids), chunk_rows):
+                    mask = live[start:start + chunk_rows]
+                    if not mask.any():
+                        continue
+                    chunk_ids = [i for i, alive in zip(ids[start:start + chunk_rows], mask) if alive]
+                    self._write_rows(next_seq, chunk_ids, np.asarray(vectors[start:start + chunk_rows][mask]))
+
+            old = [segment["seq"] for segment in self._segments]
+            self._write_manifest([next_seq])
+            # Tombstones only ever refer to the segments just retired
+            open(os.path.join(self.path, TOMBSTONES), "w").close()
+            for seq in old:
+                self._discard(seq)
+            self.refresh()
+            print(f"[STORE] Compacted {before['rows']} rows into {len(self)} live rows", file=sys.stderr)
+            return before["dead"]
+
+    def start_compactor(self, interval=60.0, min_dead_ratio=0.2):
+        """Compact in a background thread whenever dead rows exceed min_dead_ratio"""
+        if self._compactor is not None:
+            return
+        self._compactor_stop.clear()
+
+        def run():
+            while not self._compactor_stop.wait(interval):
+                try:
+                    self.refresh()
+                    stats = self.stats()
+                    if stats["rows"] and stats["dead"] / stats["rows"] >= min_dead_ratio:
+                        self.compact()
+                except Exception as e:
+                    print(f"[STORE] Background compaction failed: {e}", file=sys.stderr)
+
+        self._compactor = threading.Thread(target=run, name="store-compactor", daemon=True)
+        self._compactor.start()
+
+    def stop_compactor(self):
+        if self._compactor is None:
+            return
+        self._compactor_stop.set()
+        self._compactor.join()
+        self._compactor = None
+
+    def close(self):
+        self.stop_compactor()
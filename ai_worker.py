@@ -0,0 +1,334 @@
+"""
+Persistent embedding worker for FinderAI
+Loads a processor once and serves newline-delimited JSON requests
+over stdin/stdout or a Unix domain socket
+"""
+
+import sys
+import os
+import json
+import time
+import queue
+import signal
+import threading
+import base64
+import binascii
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+from ai_codec import pack_result
+from ai_metrics import SlowRequestProfiler, Trace, stage
+
+
+class EmbeddingWorker:
+    """
+    Long-lived request loop around an already-loaded processor.
+
+    Each request is one JSON object per line:
+        {"id": 1, "op": "embed", "image": "/path/to/image.jpg"}
+        {"id": 1, "op": "embed", "image": "/path/to/image.jpg", "format": "b64-f16"}
+        {"id": 1, "op": "embed", "image_b64": "<base64 encoded image file>"}
+        {"id": 2, "op": "health"}
+        {"id": 3, "op": "shutdown"}
+
+    Each reply is one JSON object per line carrying the same "id". Embed
+    replies have the same fields as the one-shot CLI output, unless a
+    "b64-f32"/"b64-f16" format is requested, in which case the vector is
+    sent as base64 framed bytes in "data" (see ai_codec). Embed replies
+    also carry "timings", the request's stages (see ai_metrics), which are
+    sent to the $FINDERAI_METRICS sink as well.
+
+    With a ``batcher`` (see ai_batching.MicroBatcher), images are decoded
+    on the request threads and concurrent forward passes are merged into
+    batches; stdio requests are then handled concurrently and replies may
+    arrive out of order, matched by "id".
+
+    With ``dedup`` (an ai_phash.NearDuplicateFilter), the perceptual hash
+    of each preprocessed image is checked first and a near-identical
+    earlier upload's vector is reused without a forward pass; such
+    replies carry "near_duplicate": {"of": <its item_id or path>,
+    "distance": <bits>}, and every embed reply carries the "hashes"
+    (cache hits are decoded and hashed too). Near-identical images
+    arriving together run the model once: later ones wait for the first
+    and are marked as its near duplicates.
+    """
+
+    def __init__(self, processor, build_result, model_name, batcher=None, dedup=None):
+        self.processor = processor
+        self.build_result = build_result
+        self.model_name = model_name
+        self.batcher = batcher
+        self.dedup = dedup
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._count_lock = threading.Lock()
+        self._server = None
+        self.profiler = SlowRequestProfiler()
+
+    def health(self):
+        status = {
+            "success": True,
+            "status": "stopping" if self.stopping.is_set() else "ready",
+            "model": self.model_name,
+            "pid": os.getpid(),
+            "uptime": round(time.time() - self.started, 3),
+            "requests": self.requests,
+            "errors": self.errors
+        }
+        if self.batcher is not None:
+            status["batching"] = self.batcher.stats()
+        cache = getattr(self.processor, "cache", None)
+        if cache is not None:
+            status["cache"] = cache.stats()
+        if self.dedup is not None:
+            status["dedup"] = self.dedup.stats()
+        return status
+
+    def embed(self, image, fmt="json", trace=None, ref=None):
+        info = {}
+        embedding = self.compute(image, trace, info, ref)
+        with stage(trace, "serialize"):
+            if fmt == "json":
+                return {**self.build_result(embedding), **info}
+            return {**pack_result(embedding, self.model_name, fmt), **info}
+
+    def compute(self, image, trace=None, info=None, ref=None):
+        """
+        Embedding for an image path or encoded image bytes.
+
+        ``info`` receives the perceptual hashes and any near-duplicate
+        match when dedup is on; ``ref`` is what later near-duplicates of
+        this image will be reported as.
+        """
+        if self.batcher is None and self.dedup is None:
+            # Serialise forward passes so concurrent socket clients do not
+            # oversubscribe the CPU with parallel intra-op thread pools
+            with stage(trace, "queue"):
+                self._lock.acquire()
+            try:
+                return self.processor.extract_embedding(image, trace)
+            finally:
+                self._lock.release()
+
+        key = cached = None
+        cache = getattr(self.processor, "cache", None)
+        if cache is not None:
+            with stage(trace, "cache"):
+                key, cached = cache.lookup(image, self.processor.cache_namespace)
+            if cached is not None and self.dedup is None:
+                return cached
+        # With dedup, cache hits are still decoded and hashed (no forward
+        # pass) so their replies carry hashes and they seed the filter
+        tensor = self.processor.preprocess(image, trace)
+
+        reserved = None
+        if self.dedup is not None:
+            from ai_phash import image_hashes, to_hex
+            with stage(trace, "hash"):
+                hashes = image_hashes(tensor)
+                # Waits (boundedly) if a near-identical upload is being
+                # embedded now; neither is set if that wait did not pay off
+                duplicate, reserved = self.dedup.reserve(hashes, ref)
+            if info is not None:
+                info["hashes"] = {kind: to_hex(value) for kind, value in hashes.items()}
+            if duplicate is not None:
+                duplicate_of, distance, embedding = duplicate
+                if info is not None:
+                    info["near_duplicate"] = {"of": duplicate_of, "distance": distance}
+                return cached if cached is not None else embedding
+        if cached is not None:
+            if reserved is not None:
+                self.dedup.fulfil(reserved, cached)
+            return cached
+
+        # The batcher time includes the wait for the batch to fill
+        try:
+            with stage(trace, "forward"):
+                if self.batcher is not None:
+                    embedding = self.batcher(tensor)
+                else:
+                    with self._lock:
+                        embedding = self.processor.embed_batch([tensor])[0]
+        except BaseException:
+            if reserved is not None:
+                self.dedup.fulfil(reserved, None)
+            raise
+        if reserved is not None:
+            self.dedup.fulfil(reserved, embedding)
+        if key is not None:
+            cache.put(key, embedding)
+        return embedding
+
+    def handle(self, request):
+        if not isinstance(request, dict):
+            return {"success": False, "error": "Request must be a JSON object"}
+
+        op = request.get("op", "embed")
+        if op == "health":
+            return self.health()
+        if op == "shutdown":
+            self.shutdown()
+            return {"success": True, "status": "stopping"}
+        if op != "embed":
+            return {"success": False, "error": f"Unknown op: {op}"}
+
+        image = request.get("image")
+        if request.get("image_b64"):
+            # In-memory upload: no temp file round trip
+            try:
+                image = base64.b64decode(request["image_b64"], validate=True)
+            except (binascii.Error, ValueError) as e:
+                return {"success": False, "error": f"Invalid image_b64: {e}"}
+        elif not image:
+            return {"success": False, "error": "Missing 'image' path"}
+        elif not os.path.exists(image):
+            return {"success": False, "error": f"Image file not found: {image}"}
+        fmt = request.get("format", "json")
+        if fmt != "json" and not fmt.startswith("b64-"):
+            return {"success": False, "error": f"Unsupported format over JSON lines: {fmt}"}
+        trace = Trace("worker", model=self.model_name, id=request.get("id"))
+        # Near-duplicates of this upload are reported by its item id or path
+        ref = request.get("item_id") or (image if isinstance(image, str) else None)
+        with self.profiler.profile(trace):
+            reply = self.embed(image, fmt, trace, ref)
+        trace.finish()
+        return {**reply, "timings": trace.as_dict()}
+
+    def handle_line(self, line):
+        """Handle one raw request line and return the serialised reply"""
+        request_id = None
+        try:
+            request = json.loads(line)
+            if isinstance(request, dict):
+                request_id = request.get("id")
+            reply = self.handle(request)
+        except json.JSONDecodeError as e:
+            reply = {"success": False, "error": f"Invalid JSON: {e}"}
+        except Exception as e:
+            print(f"[ERROR] Worker request failed: {e}", file=sys.stderr)
+            reply = {"success": False, "error": str(e)}
+
+        with self._count_lock:
+            self.requests += 1
+            if not reply.get("success"):
+                self.errors += 1
+        if request_id is not None:
+            reply = {"id": request_id, **reply}
+        return json.dumps(reply)
+
+    def shutdown(self):
+        if self.stopping.is_set():
+            return
+        self.stopping.set()
+        print("[WORKER] Shutdown requested", file=sys.stderr)
+        if self._server is not None:
+            # server.shutdown() blocks until serve_forever returns, so it
+            # must not run on the thread that is serving
+            threading.Thread(target=self._server.shutdown, daemon=True).start()
+
+    def install_signal_handlers(self):
+        def on_signal(signum, frame):
+            self.shutdown()
+
+        signal.signal(signal.SIGTERM, on_signal)
+        signal.signal(signal.SIGINT, on_signal)
+
+    def max_concurrency(self):
+        """Requests serve_stdio() handles at once"""
+        return self.batcher.max_batch_size if self.batcher is not None else 1
+
+    def serve_stdio(self, stdin=None, stdout=None):
+        """Serve requests from stdin until EOF or a shutdown request"""
+        stdin = stdin or sys.stdin
+        stdout = stdout or sys.stdout
+        write_lock = threading.Lock()
+
+        def respond(line):
+            reply = self.handle_line(line)
+            with write_lock:
+                stdout.write(reply + "\n")
+                stdout.flush()
+
+        # stdin is read on its own thread so a shutdown request or signal
+        # is noticed even while no further input arrives
+        lines = queue.Queue()
+
+        def read_lines():
+            for line in stdin:
+                lines.put(line)
+            lines.put(None)
+
+        threading.Thread(target=read_lines, name="worker-stdin", daemon=True).start()
+
+        # With a concurrency of 1 requests are answered in order on this
+        # thread; otherwise a pool keeps enough requests in flight to fill
+        # a batch (or every worker of an ai_pool supervisor)
+        pool = None
+        concurrency = self.max_concurrency()
+        if concurrency > 1:
+            pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="worker-request")
+
+        with write_lock:
+            stdout.write(json.dumps({"event": "ready", **self.health()}) + "\n")
+            stdout.flush()
+        print("[WORKER] Serving on stdin/stdout", file=sys.stderr)
+
+        try:
+            while not self.stopping.is_set():
+                try:
+                    line = lines.get(timeout=0.2)
+                except queue.Empty:
+                    continue
+                if line is None:
+                    break
+                line = line.strip()
+                if not line:
+                    continue
+                if pool is None:
+                    respond(line)
+                else:
+                    pool.submit(respond, line)
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True)
+            self.close()
+        print("[WORKER] Stopped", file=sys.stderr)
+
+    def close(self):
+        if self.batcher is not None:
+            self.batcher.close()
+
+    def serve_socket(self, socket_path):
+        """Serve requests on a Unix socket, one thread per connection"""
+        worker = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    reply = worker.handle_line(line.decode("utf-8"))
+                    self.wfile.write(reply.encode("utf-8") + b"\n")
+                    self.wfile.flush()
+                    if worker.stopping.is_set():
+                        break
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        self._server = Server(socket_path, Handler)
+        print(f"[WORKER] Listening on {socket_path}", file=sys.stderr)
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            self.close()
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            print("[WORKER] Stopped", file=sys.stderr)
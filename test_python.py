@@ -0,0 +1,993 @@
+"""
+Regression tests for the FinderAI Python processors and stores
+"""
+
+import os
+import io
+import glob
+import json
+import base64
+import subprocess
+import sys
+import asyncio
+import signal
+import types
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+import pytest
+from PIL import Image
+
+from ai_processor_enhanced_backup import cache_namespace, compute_advanced_features, extract_advanced_features
+from ai_backends import measure_drift, prepare_model, weights_fingerprint
+from ai_batching import MicroBatcher
+from ai_benchmark import bench_search, compare, summarize, write_images
+from ai_processor_enhanced import ViTProcessor, _load_state_dict, build_result, result_builder, save_snapshot
+from ai_bulk import ManifestError, collect_images, run_bulk
+from ai_cache import EmbeddingCache
+from ai_codec import decode_embeddings, encode_embeddings, pack_result
+from ai_index import MultiVectorIndex, VectorIndex, load_index
+from ai_preprocess import IMAGENET_MEAN, IMAGENET_STD, FastTransform, open_image, parse_views
+from ai_projection import Projection, fit_pca, fit_random
+from ai_rematch import description_bonus, rematch
+from ai_store import EmbeddingStore
+from ai_metrics import Trace, with_timings
+from ai_embedders import ClassicalEmbedder, Embedder, LoadAwareEmbedder, available_embedders, get_embedder
+from ai_worker import EmbeddingWorker
+from ai_service import EmbeddingService
+from ai_pool import PoolBusy, PoolSupervisor, WorkerPool
+from ai_phash import HashIndex, NearDuplicateFilter, hamming, image_hashes
+
+UPLOADS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads")
+
+
+def legacy_advanced_features(image):
+    """
+    The original loop-based extract_advanced_features body, kept verbatim
+    (minus logging) as the reference for the vectorised implementation.
+    """
+    img_array = np.array(image, dtype=np.float32)
+    
+    # OpenCV format (for advanced processing)
+    img_cv = cv2.cvtColor(img_array.astype(np.uint8), cv2.COLOR_RGB2BGR)
+    
+    features = []
+    
+    # ========== COLOR FEATURES (256 dimensions) ==========
+    
+    # 1. RGB Histograms (48 dims: 16 bins × 3 channels)
+    for channel in range(3):
+        hist, _ = np.histogram(img_array[:,:,channel], bins=16, range=(0, 256))
+        features.extend((hist / hist.sum()).tolist())
+    
+    # 2. HSV Histograms (48 dims: 16 bins × 3 channels)
+    img_hsv = cv2.cvtColor(img_cv, cv2.COLOR_BGR2HSV)
+    for channel in range(3):
+        hist, _ = np.histogram(img_hsv[:,:,channel], bins=16, range=(0, 256))
+        features.extend((hist / hist.sum()).tolist())
+    
+    # 3. LAB Color Space (48 dims: 16 bins × 3 channels)
+    img_lab = cv2.cvtColor(img_cv, cv2.COLOR_BGR2LAB)
+    for channel in range(3):
+        hist, _ = np.histogram(img_lab[:,:,channel], bins=16, range=(0, 256))
+        features.extend((hist / hist.sum()).tolist())
+    
+    # 4. Spatial Color Grid (64 dims: 8×8 grid, average RGB)
+    grid_size = 8
+    h_step = 224 // grid_size
+    w_step = 224 // grid_size
+    for i in range(grid_size):
+        for j in range(grid_size):
+            region = img_array[i*h_step:(i+1)*h_step, j*w_step:(j+1)*w_step, :]
+            avg_color = region.mean(axis=(0, 1)) / 255.0
+            # Only take the mean across channels for spatial compactness
+            features.append(float(avg_color.mean()))
+    
+    # 5. Color Moments (48 dims: mean, std, skew for RGB in 4×4 grid)
+    grid_size = 4
+    h_step = 224 // grid_size
+    w_step = 224 // grid_size
+    for i in range(grid_size):
+        for j in range(grid_size):
+            region = img_array[i*h_step:(i+1)*h_step, j*w_step:(j+1)*w_step, :]
+            # Mean, std, skewness for each RGB channel (flatten to get more info)
+            features.append(float(region.mean() / 255.0))
+            features.append(float(region.std() / 255.0))
+            # Skewness approximation
+            centered = (region - region.mean()) / (region.std() + 1e-5)
+            skew = float((centered ** 3).mean())
+            features.append(skew)
+    
+    
+    # ========== TEXTURE FEATURES (256 dimensions) ==========
+    
+    # Convert to grayscale for texture analysis
+    gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    
+    # 1. Local Binary Pattern (LBP) inspired features (64 dims)
+    # Compute differences with neighbors in 8×8 grid
+    grid_size = 8
+    h_step = 224 // grid_size
+    w_step = 224 // grid_size
+    for i in range(grid_size):
+        for j in range(grid_size):
+            region = gray[i*h_step:(i+1)*h_step, j*w_step:(j+1)*w_step]
+            # Local variance as texture measure
+            features.append(float(region.std() / 255.0))
+    
+    # 2. Gabor Filter-like responses (64 dims: 8 orientations × 8 regions)
+    for angle in range(0, 180, 22):  # 8 orientations
+        # Sobel at different angles (approximation of Gabor)
+        theta = np.radians(angle)
+        kx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+        ky = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+        
+        # Directional gradient
+        oriented_grad = kx * np.cos(theta) + ky * np.sin(theta)
+        
+        # Average response in each quadrant
+        h, w = oriented_grad.shape
+        regions = [
+            oriented_grad[:h//2, :w//2],
+            oriented_grad[:h//2, w//2:],
+            oriented_grad[h//2:, :w//2],
+            oriented_grad[h//2:, w//2:],
+            oriented_grad[:h//4, :],
+            oriented_grad[h//4:h//2, :],
+            oriented_grad[h//2:3*h//4, :],
+            oriented_grad[3*h//4:, :]
+        ]
+        for region in regions:
+            features.append(float(np.abs(region).mean() / 100.0))
+    
+    # 3. Multi-scale Gradient Magnitudes (64 dims: 4 scales × 16 regions)
+    for scale in [1, 2, 3, 4]:
+        # Gaussian blur at different scales
+        blurred = cv2.GaussianBlur(gray, (2*scale+1, 2*scale+1), scale)
+        gx = cv2.Sobel(blurred, cv2.CV_32F, 1, 0, ksize=3)
+        gy = cv2.Sobel(blurred, cv2.CV_32F, 0, 1, ksize=3)
+        magnitude = np.sqrt(gx**2 + gy**2)
+        
+        # Divide into 4×4 grid
+        grid_size = 4
+        h_step = 224 // grid_size
+        w_step = 224 // grid_size
+        for i in range(grid_size):
+            for j in range(grid_size):
+                region = magnitude[i*h_step:(i+1)*h_step, j*w_step:(j+1)*w_step]
+                features.append(float(region.mean() / 100.0))
+    
+    # 4. Edge Orientation Histogram (64 dims: 16 orientations × 4 quadrants)
+    gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+    gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+    orientation = np.arctan2(gy, gx) * 180 / np.pi  # -180 to 180
+    orientation = (orientation + 180) % 360  # 0 to 360
+    
+    h, w = orientation.shape
+    quadrants = [
+        orientation[:h//2, :w//2],
+        orientation[:h//2, w//2:],
+        orientation[h//2:, :w//2],
+        orientation[h//2:, w//2:]
+    ]
+    
+    for quad in quadrants:
+        hist, _ = np.histogram(quad.flatten(), bins=16, range=(0, 360))
+        features.extend((hist / (hist.sum() + 1e-5)).tolist())
+    
+    
+    # ========== SHAPE FEATURES (256 dimensions) ==========
+    
+    # 1. Canny Edge Maps at multiple thresholds (64 dims)
+    for thresh_low in [30, 50, 70, 100]:
+        edges = cv2.Canny(img_cv, thresh_low, thresh_low * 2)
+        
+        # Divide into 4×4 grid
+        grid_size = 4
+        h_step = 224 // grid_size
+        w_step = 224 // grid_size
+        for i in range(grid_size):
+            for j in range(grid_size):
+                region = edges[i*h_step:(i+1)*h_step, j*w_step:(j+1)*w_step]
+                # Percentage of edge pixels in region
+                features.append(float(region.mean() / 255.0))
+    
+    # 2. Corner Detection (Harris corners) (64 dims: 8×8 grid)
+    gray_uint8 = gray.astype(np.uint8)
+    corners = cv2.cornerHarris(gray_uint8, blockSize=2, ksize=3, k=0.04)
+    corners = cv2.dilate(corners, None)
+    
+    grid_size = 8
+    h_step = 224 // grid_size
+    w_step = 224 // grid_size
+    for i in range(grid_size):
+        for j in range(grid_size):
+            region = corners[i*h_step:(i+1)*h_step, j*w_step:(j+1)*w_step]
+            features.append(float(region.max() / (corners.max() + 1e-5)))
+    
+    # 3. Hough Lines (approximate - 64 dims)
+    edges_canny = cv2.Canny(img_cv, 50, 150)
+    
+    # Line detection in different orientations
+    for angle_bin in range(8):
+        # Detect lines around specific angles
+        lines = cv2.HoughLines(edges_canny, 1, np.pi / 180, threshold=50)
+        
+        # Count lines in 8 angular bins
+        if lines is not None:
+            angles = lines[:, 0, 1] * 180 / np.pi  # Convert to degrees
+            hist, _ = np.histogram(angles, bins=8, range=(0, 180))
+            features.extend((hist / (hist.sum() + 1e-5)).tolist())
+        else:
+            features.extend([0.0] * 8)
+    
+    # 4. Contour Features (64 dims)
+    # Find contours
+    _, binary = cv2.threshold(gray_uint8, 127, 255, cv2.THRESH_BINARY)
+    contours, _ = cv2.findContours(binary, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    
+    # Create contour density map in 8×8 grid
+    contour_map = np.zeros((224, 224), dtype=np.uint8)
+    cv2.drawContours(contour_map, contours, -1, (255), thickness=1)
+    
+    grid_size = 8
+    h_step = 224 // grid_size
+    w_step = 224 // grid_size
+    for i in range(grid_size):
+        for j in range(grid_size):
+            region = contour_map[i*h_step:(i+1)*h_step, j*w_step:(j+1)*w_step]
+            features.append(float(region.mean() / 255.0))
+    
+    # 5. HOG-inspired features (64 dims)
+    # Histogram of Oriented Gradients in 4×4 grid
+    gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+    gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+    magnitude = np.sqrt(gx**2 + gy**2)
+    orientation = np.arctan2(gy, gx) * 180 / np.pi
+    orientation = (orientation + 180) % 360
+    
+    grid_size = 4
+    h_step = 224 // grid_size
+    w_step = 224 // grid_size
+    for i in range(grid_size):
+        for j in range(grid_size):
+            region_orient = orientation[i*h_step:(i+1)*h_step, j*w_step:(j+1)*w_step]
+            region_mag = magnitude[i*h_step:(i+1)*h_step, j*w_step:(j+1)*w_step]
+            
+            # Weighted histogram
+            hist, _ = np.histogram(region_orient.flatten(), bins=4, range=(0, 360),
+                                  weights=region_mag.flatten())
+            features.extend((hist / (hist.sum() + 1e-5)).tolist())
+    
+    
+    # ========== FINAL PROCESSING ==========
+    # Ensure exactly 768 dimensions
+    current_dims = len(features)
+    if current_dims < 768:
+        # Pad with zeros if needed
+        features.extend([0.0] * (768 - current_dims))
+    elif current_dims > 768:
+        # Truncate if somehow we have more
+        features = features[:768]
+    
+    # Normalize the entire feature vector
+    features = np.array(features, dtype=np.float32)
+    norm = np.linalg.norm(features)
+    if norm > 0:
+        features = features / norm
+    return features
+
+
+def synthetic_images():
+    rng = np.random.default_rng(7)
+    noise = rng.integers(0, 256, (224, 224, 3), dtype=np.uint8)
+
+    ramp = np.linspace(0, 255, 224, dtype=np.float32)
+    gradient = np.stack([np.add.outer(ramp, ramp) / 2,
+                         np.tile(ramp, (224, 1)),
+                         np.tile(ramp[:, None], (1, 224))], axis=2).astype(np.uint8)
+
+    shapes = np.full((224, 224, 3), 30, dtype=np.uint8)
+    cv2.rectangle(shapes, (20, 30), (150, 120), (200, 40, 40), -1)
+    cv2.circle(shapes, (160, 160), 40, (40, 200, 90), -1)
+    for offset in range(0, 224, 28):
+        cv2.line(shapes, (offset, 0), (224 - offset, 223), (250, 250, 250), 2)
+
+    flat = np.full((224, 224, 3), 128, dtype=np.uint8)
+    return {"noise": noise, "gradient": gradient, "shapes": shapes, "flat": flat}
+
+
+def upload_images():
+    images = {}
+    for path in sorted(glob.glob(os.path.join(UPLOADS, "*")))[:6]:
+        try:
+            image = Image.open(path).convert("RGB").resize((224, 224))
+        except OSError:
+            continue
+        images[os.path.basename(path)] = np.asarray(image)
+    return images
+
+
+@pytest.mark.parametrize("name,image", list({**synthetic_images(), **upload_images()}.items()))
+def test_advanced_features_match_legacy(name, image):
+    expected = legacy_advanced_features(image)
+    actual = compute_advanced_features(image)
+
+    assert actual.dtype == np.float32
+    assert actual.shape == (768,)
+    # Block reductions may sum float32 cells in a different order than the
+    # per-cell loops did, so allow for float32 rounding
+    np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_extract_advanced_features_output(tmp_path):
+    path = tmp_path / "shapes.png"
+    Image.fromarray(synthetic_images()["shapes"]).save(path)
+
+    result = extract_advanced_features(str(path))
+
+    assert result["success"] is True
+    assert result["dimensions"] == 768
+    assert list(result) == ["embeddings", "success", "dimensions", "model"]
+    assert np.linalg.norm(result["embeddings"]) == pytest.approx(1.0, abs=1e-5)
+
+
+def test_extract_advanced_features_missing_file(tmp_path):
+    result = extract_advanced_features(str(tmp_path / "missing.jpg"))
+    assert result == {"error": "Image file not found", "success": False}
+
+
+def test_store_put_after_torn_write(tmp_path):
+    store = EmbeddingStore(str(tmp_path), dims=4)
+    store.put_many(["a", "b"], np.eye(4, dtype=np.float32)[:2])
+    # A writer died after its vector row but before (all of) its id line
+    with open(tmp_path / "seg-000001.f32", "ab") as f:
+        f.write(np.ones(4, dtype="<f4").tobytes())
+    with open(tmp_path / "seg-000001.ids", "a", encoding="utf-8") as f:
+        f.write("tor")
+
+    reopened = EmbeddingStore(str(tmp_path))
+    assert len(reopened) == 2
+    reopened.put("new", [0, 0, 1, 0])
+
+    for store in (reopened, EmbeddingStore(str(tmp_path))):
+        assert len(store) == 3
+        np.testing.assert_allclose(store.get("new"), [0, 0, 1, 0])
+        np.testing.assert_allclose(store.get("b"), [0, 1, 0, 0])
+
+
+def test_store_search_exclude_keeps_k(tmp_path):
+    vectors = np.eye(4, dtype=np.float32) + 0.1
+    store = EmbeddingStore(str(tmp_path), dims=4)
+    store.put_many([f"i{i}" for i in range(4)], vectors)
+
+    assert len(store.search(vectors[0], k=1, exclude=["i0"])) == 1
+    assert "i0" not in [i for i, _ in store.search(vectors[0], k=3, exclude=["i0"])]
+    assert len(store.search(vectors[0], k=3, exclude=["i0"])) == 3
+    assert store.search(vectors[0], k=0) == []
+
+
+def test_store_sees_other_writers(tmp_path):
+    first = EmbeddingStore(str(tmp_path), dims=4, segment_rows=2)
+    second = EmbeddingStore(str(tmp_path))
+    first.put_many(["a", "b", "c"], np.eye(4, dtype=np.float32)[:3])
+    second.delete("a")
+    second.put("b", [0, 0, 0, 1])
+    first.put("d", [1, 1, 0, 0])
+
+    assert len(first) == 3 and "a" not in first
+    np.testing.assert_allclose(first.get("b"), [0, 0, 0, 1])
+    assert first.compact() == 2
+    second.put("e", [0, 1, 1, 0])
+    reopened = EmbeddingStore(str(tmp_path))
+    assert len(reopened) == 4 and "e" in reopened and "a" not in reopened
+
+
+
+def test_worker_stdio_protocol(tmp_path):
+    path = tmp_path / "shapes.png"
+    Image.fromarray(synthetic_images()["shapes"]).save(path)
+    embedder = ClassicalEmbedder()
+    worker = EmbeddingWorker(embedder, embedder.build_result, embedder.model_id)
+    requests = [
+        {"id": 1, "op": "embed", "image": str(path)},
+        {"id": "b", "image_b64": base64.b64encode(path.read_bytes()).decode(), "format": "b64-f16"},
+        {"id": 3, "image": str(tmp_path / "missing.jpg")},
+        {"id": 4, "op": "resize"},
+        {"id": 5, "op": "health"},
+        {"id": 6, "op": "shutdown"},
+        {"id": 7, "op": "health"},
+    ]
+    stdin = io.StringIO("not json\n\n" + "\n".join(json.dumps(r) for r in requests) + "\n")
+    stdout = io.StringIO()
+    worker.serve_stdio(stdin, stdout)
+
+    ready, *replies = [json.loads(line) for line in stdout.getvalue().splitlines()]
+    assert ready["event"] == "ready" and ready["status"] == "ready"
+    # Answered in order, one reply per request, none after the shutdown
+    assert [reply.get("id") for reply in replies] == [None, 1, "b", 3, 4, 5, 6]
+    invalid, embedded, packed, missing, unknown, health, stopping = replies
+    assert invalid["success"] is False and invalid["error"].startswith("Invalid JSON")
+    assert embedded["success"] is True and len(embedded["embeddings"]) == 768
+    assert embedded["model_id"] == "enhanced-cv-768" and "timings" in embedded
+    assert packed["format"] == "b64-f16" and packed["dimensions"] == 768
+    assert missing == {"id": 3, "success": False, "error": f"Image file not found: {tmp_path / 'missing.jpg'}"}
+    assert unknown["error"] == "Unknown op: resize"
+    assert health["requests"] == 5 and health["errors"] == 3
+    assert stopping["status"] == "stopping" and worker.stopping.is_set()
+
+
+def test_micro_batcher_groups_and_orders():
+    batches = []
+
+    def run(items):
+        batches.append(len(items))
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(run, max_batch_size=4, max_wait_ms=200)
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(batcher, range(8)))
+    batcher.close()
+    assert results == [i * 2 for i in range(8)]
+    assert sum(batches) == 8 and max(batches) <= 4 and len(batches) < 8
+
+    failing = MicroBatcher(lambda items: 1 / 0, max_batch_size=2, max_wait_ms=1)
+    with pytest.raises(ZeroDivisionError):
+        failing(1)
+    failing.close()
+
+
+def test_bulk_manifest_and_resume(tmp_path):
+    images = synthetic_images()
+    for name in ("shapes", "gradient"):
+        Image.fromarray(images[name]).save(tmp_path / f"{name}.png")
+    manifest = tmp_path / "manifest.txt"
+    manifest.write_text("# uploads\nshapes.png\n{\"image\": \"gradient.png\"}\n{\"image\": \n"
+                        "missing.png\n")
+
+    paths = collect_images(manifest=str(manifest))
+    assert paths[:2] == [str(tmp_path / "shapes.png"), str(tmp_path / "gradient.png")]
+    assert isinstance(paths[2], ManifestError) and paths[2] == f"{manifest}:4"
+
+    embedder = ClassicalEmbedder()
+    checkpoint = str(tmp_path / "done.txt")
+    out = io.StringIO()
+    summary = run_bulk(embedder, embedder.build_result, paths, out, batch_size=1, checkpoint=checkpoint)
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [line["image"] for line in lines] == paths
+    assert [line["success"] for line in lines] == [True, True, False, False]
+    assert lines[2]["error"].startswith("Invalid manifest line")
+    assert summary["succeeded"] == 2 and summary["failed"] == 2 and summary["success"] is False
+
+    # The resumed run only retries the failures
+    out = io.StringIO()
+    summary = run_bulk(embedder, embedder.build_result, paths, out, checkpoint=checkpoint)
+    assert summary["skipped"] == 2 and summary["failed"] == 2
+    assert [json.loads(line)["image"] for line in out.getvalue().splitlines()] == paths[2:]
+
+
+def test_embedding_cache_round_trip_and_eviction(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = EmbeddingCache(path, max_bytes=10 * 8 * 4)
+    key, vector = cache.lookup(b"image bytes", "vit|fp32")
+    assert vector is None
+    assert key == EmbeddingCache.make_key(b"image bytes", "vit|fp32") != EmbeddingCache.make_key(b"image bytes", "resnet")
+
+    cache.put(key, np.arange(8, dtype=np.float16))
+    cached = cache.get(key)
+    assert cached.dtype == np.float16
+    np.testing.assert_array_equal(cached, np.arange(8))
+
+    for i in range(12):
+        cache.put(f"k{i}", np.full(8, i, dtype=np.float32))
+    stats = cache.stats()
+    assert stats["bytes"] <= 10 * 8 * 4 and stats["evictions"] >= 3
+    assert cache.get("k0") is None and cache.get("k11") is not None
+    cache.close()
+
+    stats = EmbeddingCache(path).stats()
+    assert stats["hits"] == 2 and stats["misses"] == 2
+    assert stats["bytes"] == stats["entries"] * 8 * 4
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float16"])
+def test_codec_round_trip(dtype):
+    vectors = np.random.default_rng(0).standard_normal((3, 10)).astype(np.float32)
+    blob = encode_embeddings(vectors, "ViT-Base", dtype)
+    decoded, header = decode_embeddings(blob)
+    assert header == {"model": "ViT-Base", "dtype": dtype, "count": 3, "dimensions": 10}
+    np.testing.assert_allclose(decoded, vectors, rtol=1e-3 if dtype == "float16" else 0)
+
+    packed = pack_result(vectors[0], "ViT-Base", "b64-f16" if dtype == "float16" else "b64-f32")
+    single, _ = decode_embeddings(packed["data"])
+    assert single.shape == (1, 10) and packed["dimensions"] == 10
+    with pytest.raises(ValueError):
+        decode_embeddings(b"XXXX" + blob[4:])
+
+
+def clustered_vectors(count=200, dims=32, seed=3):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((8, dims)).astype(np.float32)
+    return (centers[rng.integers(0, 8, count)] + 0.3 * rng.standard_normal((count, dims))).astype(np.float32)
+
+
+def brute_force(vectors, query, k):
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    scores = unit @ (query / np.linalg.norm(query))
+    return [f"i{i}" for i in np.argsort(-scores, kind="stable")[:k]]
+
+
+def test_vector_index_search_matches_brute_force(tmp_path):
+    vectors = clustered_vectors()
+    index = VectorIndex(32, capacity=4)
+    index.add_many([f"i{i}" for i in range(len(vectors))], vectors,
+                   [{"type": "lost" if i % 2 else "found"} for i in range(len(vectors))])
+
+    results = index.search(vectors[5], k=5)
+    assert [i for i, _, _ in results] == brute_force(vectors, vectors[5], 5)
+    assert results[0][1] == pytest.approx(1.0, abs=1e-5)
+    assert all(meta["type"] == "lost" for _, _, meta in index.search(vectors[5], k=10, filters={"type": "lost"}))
+    assert "i5" not in [i for i, _, _ in index.search(vectors[5], k=3, exclude=["i5"])]
+    assert [i for i, _, _ in index.search(vectors[5], k=5, include=["i1", "i2"])] in (["i1", "i2"], ["i2", "i1"])
+
+    assert index.remove("i5") and not index.remove("i5")
+    assert len(index) == len(vectors) - 1 and "i5" not in index
+    assert "i5" not in [i for i, _, _ in index.search(vectors[5], k=5)]
+
+    index.build_ivf(n_lists=8)
+    path = str(tmp_path / "index.npz")
+    index.save(path)
+    reloaded = load_index(path)
+    assert type(reloaded) is VectorIndex and len(reloaded) == len(index)
+    assert [i for i, _, _ in reloaded.search(vectors[7], k=5, nprobe=8)] == \
+        [i for i, _, _ in index.search(vectors[7], k=5)]
+
+
+def test_backends_cache_traced_modules_per_weights(tmp_path):
+    torch = pytest.importorskip("torch")
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(12, 32), torch.nn.ReLU(),
+                                torch.nn.Linear(32, 8)).eval()
+    batch = torch.randn(4, 3, 2, 2)
+    first = weights_fingerprint("snapshot", str(tmp_path / "missing.pt"))
+    assert first == weights_fingerprint("snapshot") != weights_fingerprint("hub")
+
+    assert prepare_model(model, "fp32", "tiny") is model
+    with pytest.raises(ValueError):
+        prepare_model(model, "fp8", "tiny")
+    scripted = prepare_model(model, "int8-torchscript", "tiny", batch[:1], str(tmp_path), first)
+    files = glob.glob(str(tmp_path / "*.pt"))
+    assert len(files) == 1 and files[0].endswith(f"-{first}.pt")
+    drift = measure_drift(model, scripted, batch, repeats=1)
+    assert drift["images"] == 4 and drift["cosine_min"] > 0.99
+
+    # The cached module is reused for the same weights and never for others
+    reloaded = prepare_model(model, "int8-torchscript", "tiny", batch[:1], str(tmp_path), first)
+    with torch.no_grad():
+        torch.testing.assert_close(reloaded(batch), scripted(batch))
+    prepare_model(model, "int8-torchscript", "tiny", batch[:1], str(tmp_path))
+    assert len(glob.glob(str(tmp_path / "*.pt"))) == 2
+
+
+def test_fast_decode_matches_torchvision(tmp_path, monkeypatch):
+    transforms = pytest.importorskip("torchvision.transforms")
+    photo = Image.fromarray(np.tile(synthetic_images()["gradient"], (4, 3, 1)))
+    path = tmp_path / "photo.jpg"
+    exif = Image.Exif()
+    exif[0x0112] = 6  # orientation: rotate 90 degrees clockwise
+    photo.save(path, quality=95, exif=exif)
+
+    # EXIF orientation is opt-in so stored vectors keep matching
+    monkeypatch.delenv("FINDERAI_EXIF_TRANSPOSE", raising=False)
+    assert open_image(str(path)).size == (672, 896)
+    namespace = cache_namespace(fast=False)
+    monkeypatch.setenv("FINDERAI_EXIF_TRANSPOSE", "1")
+    assert open_image(path.read_bytes()).size == (896, 672)
+    assert cache_namespace(fast=False) == namespace + "|exif"
+
+    # draft() decodes at a DCT scale that still covers the requested size
+    assert open_image(str(path), 224, exif=False).size == (336, 448)
+
+    compose = transforms.Compose([transforms.Resize(256), transforms.CenterCrop(224), transforms.ToTensor(),
+                                  transforms.Normalize(mean=list(IMAGENET_MEAN), std=list(IMAGENET_STD))])
+    fast = FastTransform(256, 224, IMAGENET_MEAN, IMAGENET_STD)
+    decoded = open_image(str(path), exif=False)
+    assert fast(decoded).shape == (3, 224, 224) and fast(decoded).dtype == np.float32
+    np.testing.assert_allclose(fast(decoded), compose(decoded).numpy(), atol=1e-5)
+
+
+@pytest.mark.parametrize("name", ["snapshot.pt", "snapshot.safetensors"])
+def test_snapshot_loads_onto_meta_model(tmp_path, name):
+    torch = pytest.importorskip("torch")
+    if name.endswith(".safetensors"):
+        pytest.importorskip("safetensors")
+
+    def build():
+        return torch.nn.Sequential(torch.nn.Linear(6, 4), torch.nn.LayerNorm(4)).eval()
+
+    torch.manual_seed(0)
+    model = build()
+    path = str(tmp_path / name)
+    save_snapshot(model, path)
+    assert os.listdir(tmp_path) == [name]
+
+    # No random init: parameters are created empty and the mapped tensors assigned in place
+    with torch.device("meta"):
+        restored = build()
+    restored.load_state_dict(_load_state_dict(path), assign=True)
+    inputs = torch.randn(3, 6)
+    with torch.no_grad():
+        torch.testing.assert_close(restored(inputs), model(inputs))
+
+
+def test_processor_import_defers_torch():
+    code = "import sys, ai_processor_enhanced, ai_embedders; print('torch' in sys.modules)"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    assert result.stdout.strip() == "False"
+
+
+class GatedEmbedder(Embedder):
+    """Constant-vector embedder whose forward pass waits for ``gate``"""
+
+    name = "gated"
+    model_id = "gated-4"
+    dims = 4
+
+    def __init__(self, fail_load=False):
+        super().__init__()
+        self.fail_load = fail_load
+        self.gate = threading.Event()
+        self.entered = threading.Semaphore(0)
+
+    def _load(self):
+        if self.fail_load:
+            raise RuntimeError("weights missing")
+        return "gated model"
+
+    def preprocess(self, image_path, trace=None):
+        return Image.open(io.BytesIO(image_path) if isinstance(image_path, bytes) else image_path)
+
+    def embed_batch(self, inputs):
+        self.entered.release()
+        self.gate.wait(5)
+        return [np.ones(4, dtype=np.float32) for _ in inputs]
+
+
+def test_registry_and_load_aware_routing(tmp_path):
+    assert available_embedders() == ["classical", "resnet", "vit"]
+    assert get_embedder("classical") is get_embedder("classical")
+    assert get_embedder("classical", fast_preprocess=True) is not get_embedder("classical")
+    with pytest.raises(KeyError):
+        get_embedder("clip")
+
+    images = synthetic_images()
+    path, other = tmp_path / "shapes.png", tmp_path / "gradient.png"
+    Image.fromarray(images["shapes"]).save(path)
+    Image.fromarray(images["gradient"]).save(other)
+    preferred, cheap = GatedEmbedder(), ClassicalEmbedder()
+    router = LoadAwareEmbedder(preferred, cheap, max_inflight=1)
+    service = EmbeddingService(preferred, router=router)
+
+    async def embed_both():
+        busy = asyncio.ensure_future(service.handle_embed({"image": str(path)}))
+        await asyncio.get_running_loop().run_in_executor(None, preferred.entered.acquire)
+        # The preferred embedder is at max_inflight: this one goes to the cheap path
+        overflow = await service.handle_embed({"image_b64": base64.b64encode(other.read_bytes()).decode()})
+        preferred.gate.set()
+        return await busy, overflow
+
+    first, second = asyncio.run(embed_both())
+    service.close()
+    assert first["embedder"] == "gated" and first["embeddings"] == [1.0] * 4
+    assert second["embedder"] == "classical" and len(second["embeddings"]) == 768
+    assert service.health()["routing"]["routed"] == {"gated": 1, "classical": 1}
+
+    # A model that cannot load falls back; a bad image is the caller's error
+    broken = LoadAwareEmbedder(GatedEmbedder(fail_load=True), cheap)
+    assert broken.build_result(str(path))["model_id"] == "enhanced-cv-768" and broken.fallbacks == 1
+    with pytest.raises(FileNotFoundError):
+        router.embed(str(tmp_path / "missing.png"))
+    assert router.routed == {"gated": 1, "classical": 1}
+
+
+def test_worker_pool_restarts_and_rejects(tmp_path):
+    path = tmp_path / "shapes.png"
+    Image.fromarray(synthetic_images()["shapes"]).save(path)
+    # Reading a FIFO with no writer blocks, which holds a worker mid-request
+    stuck = str(tmp_path / "stuck")
+    os.mkfifo(stuck)
+
+    pool = WorkerPool(workers=1, threads=1, max_queue=1, embedder="classical", start_timeout=120).start()
+    try:
+        held = pool.submit({"image": stuck})
+        queued = pool.submit({"id": 2, "image": str(path)})
+        with pytest.raises(PoolBusy):
+            pool.submit({"image": str(path)})
+        stats = pool.stats()
+        assert stats["queued"] == 1 and stats["rejected"] == 1 and stats["workers"][0]["busy"]
+
+        # Only the held request fails; the queued one runs on the replacement worker
+        os.kill(stats["workers"][0]["pid"], signal.SIGKILL)
+        assert held.result(60) == {"success": False, "error": f"Worker exited with code {-signal.SIGKILL}"}
+        reply = queued.result(120)
+        assert reply["success"] is True and reply["model_id"] == "enhanced-cv-768"
+        assert pool.restarts == 1 and pool.stats()["workers"][0]["handled"] == 1
+
+        supervisor = PoolSupervisor(pool, timeout=0.5)
+        assert supervisor.handle({"image": stuck}) == {"success": False, "error": "Timed out after 0.5s"}
+    finally:
+        pool.close(timeout=1)
+
+
+def test_service_http_framing_and_errors(tmp_path):
+    image = io.BytesIO()
+    Image.fromarray(synthetic_images()["shapes"]).save(image, "PNG")
+    image = base64.b64encode(image.getvalue()).decode()
+    index = MultiVectorIndex(768, max_views=2)
+    views = np.random.default_rng(4).standard_normal((3, 2, 768)).astype(np.float32)
+    index.add_many(["a", "b", "c"], views)
+    service = EmbeddingService(ClassicalEmbedder(), index=index)
+
+    def request(path, body=None, length=None, method="POST"):
+        payload = json.dumps(body).encode() if body is not None else b""
+        length = str(len(payload)) if length is None else length
+        return (f"{method} {path} HTTP/1.1\r\nContent-Length: {length}\r\n\r\n").encode("latin-1") + payload
+
+    async def exchange(*raw):
+        server = await asyncio.start_server(service.handle_connection, "127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+        replies = []
+        for data in raw:
+            writer.write(data)
+            status = await reader.readline()
+            if not status:
+                break
+            headers = {}
+            while (line := await reader.readline()) != b"\r\n":
+                name, _, value = line.decode().partition(":")
+                headers[name.lower()] = value.strip()
+            body = json.loads(await reader.readexactly(int(headers["content-length"])))
+            replies.append((int(status.split()[1]), headers["connection"], body))
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return replies
+
+    async def coalesce():
+        return await asyncio.gather(*(service.handle_embed({"image_b64": image}) for _ in range(3)))
+
+    # One keep-alive connection; an unparseable Content-Length ends it
+    replies = asyncio.run(exchange(
+        request("/health", method="GET"),
+        request("/search", {"embedding": views[1].tolist(), "k": 1}),
+        request("/search", {"embedding": views[2, 0].tolist(), "k": "all"}),
+        request("/embed", {"image_b64": base64.b64encode(b"not an image").decode()}),
+        request("/embed", {"image_b64": image}, length="\u00b2"),
+        request("/health", method="GET")))
+    assert [(status, connection) for status, connection, _ in replies] == \
+        [(200, "keep-alive"), (200, "keep-alive"), (400, "keep-alive"), (400, "keep-alive"), (400, "close")]
+    assert replies[0][2]["index"] == {"items": 3, "dims": 768, "max_views": 2}
+    assert [match["id"] for match in replies[1][2]["matches"]] == ["b"]
+    assert replies[2][2]["error"] == "'k' must be a number, got 'all'"
+    assert replies[3][2]["error"].startswith("Could not decode image")
+    assert replies[4][2]["error"] == "Invalid Content-Length: \u00b2"
+
+    # Identical concurrent uploads share one computation
+    results = asyncio.run(coalesce())
+    service.close()
+    assert results[0] == results[1] == results[2] and results[0]["success"] is True
+    assert service.counters["computed"] == 2 and service.counters["coalesced"] == 2
+
+
+def test_projection_preserves_neighbours(tmp_path):
+    vectors = clustered_vectors(300, 64)
+    pca = fit_pca(vectors, 16)
+    compact = pca.apply(vectors)
+    assert compact.shape == (300, 16) and compact.dtype == np.float16
+    np.testing.assert_allclose(np.linalg.norm(compact.astype(np.float32), axis=1), 1.0, atol=1e-2)
+    nearest = [int(np.argsort(-(compact.astype(np.float32) @ compact[i].astype(np.float32)))[1])
+               for i in range(20)]
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    same_cluster = [abs(unit[i] @ unit[j]) > 0.5 for i, j in zip(range(20), nearest)]
+    assert all(same_cluster)
+
+    path = str(tmp_path / "pca.npz")
+    pca.save(path)
+    reloaded = Projection.load(path)
+    assert reloaded.fingerprint == pca.fingerprint
+    np.testing.assert_array_equal(reloaded.apply(vectors[:3]), compact[:3])
+    assert fit_random(64, 16).fingerprint != pca.fingerprint
+    assert Projection(pca.matrix, dtype="float32").fingerprint != Projection(pca.matrix).fingerprint
+    with pytest.raises(ValueError):
+        pca.apply(np.ones(32))
+
+    # Projected one-shot results say which projection produced them
+    tagged = result_builder(types.SimpleNamespace(projection=pca))(compact[0])
+    assert tagged["projection"] == pca.fingerprint and tagged["dimensions"] == 16
+    assert result_builder(types.SimpleNamespace(projection=None)) is build_result
+
+
+def test_rematch_rules():
+    lost = {"_id": "L1", "type": "lost", "category": "bag", "studentId": "s1", "embeddings": [1.0, 0.0]}
+    found = [
+        {"_id": "F1", "type": "found", "category": "bag", "studentId": "s2", "embeddings": [1.0, 0.1]},
+        {"_id": "F2", "type": "found", "category": "phone", "studentId": "s2", "embeddings": [1.0, 0.0]},
+        {"_id": "F3", "type": "found", "category": "bag", "studentId": "s1", "embeddings": [1.0, 0.0]},
+        {"_id": "F4", "type": "found", "category": "bag", "studentId": "s3", "embeddings": [1.0, 0.0]},
+        {"_id": "F5", "type": "found", "category": "bag", "studentId": "s3", "embeddings": [0.0, 1.0]},
+        {"_id": "F6", "type": "found", "category": "bag", "studentId": "s4", "embeddings": [1.0, 0.0],
+         "status": "claimed"},
+        {"_id": "F7", "type": "found", "category": "bag", "studentId": "s4", "embeddings": [1.0, 0.0],
+         "claimed": True},
+    ]
+    results, stats = rematch([lost] + found, dismissed={"s1": {"F4"}}, use_descriptions=False)
+
+    assert stats["lost"] == 1 and stats["found"] == 5
+    candidates = results[0]["candidates"]
+    # Same student (F3), dismissed (F4), below threshold (F5) and claimed (F6, F7) are dropped
+    assert [c["foundItemId"] for c in candidates] == ["F1", "F2"]
+    assert candidates[0]["similarity"] == 100.0 and candidates[0]["categoryBonus"] == 15.0
+    assert candidates[1]["similarity"] == pytest.approx(100.0) and candidates[1]["categoryBonus"] == 0.0
+
+    lost["description"] = "Black leather backpack with laptop"
+    found[0]["description"] = "leather backpack found near library"
+    found[1]["description"] = "black phone"
+    results, _ = rematch([lost] + found, dismissed={"s1": {"F4"}})
+    # The sparse word-matrix bonus matches the per-pair route rule
+    bonuses = [c["descriptionBonus"] for c in results[0]["candidates"]]
+    assert bonuses == [pytest.approx(description_bonus(lost["description"], item["description"]))
+                       for item in found[:2]]
+    assert bonuses == [pytest.approx(2 / 5 * 10), pytest.approx(1 / 5 * 10)]
+
+
+def test_benchmark_summaries_and_regressions(tmp_path):
+    stats = summarize([0.001 * i for i in range(1, 101)])
+    assert stats["n"] == 100 and stats["min_ms"] == 1.0 and stats["max_ms"] == 100.0
+    assert stats["p50_ms"] == pytest.approx(50.5) and stats["p99_ms"] == pytest.approx(99.01)
+
+    paths = write_images(str(tmp_path), 2, (64, 48))
+    assert [Image.open(path).size for path in paths] == [(64, 48), (64, 48)]
+
+    report = {"results": bench_search([1000], 16, queries=5, k=3)}
+    entry = report["results"]["sizes"]["1000"]
+    assert entry["brute_force"]["n"] == entry["store"]["n"] == 5 and 0 <= entry["ivf"]["recall_at_3"] <= 1
+    assert compare(report, report, 0.15) == []
+
+    # Only p50/p90 slowdowns beyond the tolerance count
+    slower = json.loads(json.dumps(report))
+    store = slower["results"]["sizes"]["1000"]["store"]
+    store["p50_ms"], store["p99_ms"] = report["results"]["sizes"]["1000"]["store"]["p50_ms"] * 2 + 1, 1e9
+    assert [r["metric"] for r in compare(slower, report, 0.15)] == ["sizes.1000.store.p50_ms"]
+
+
+def test_timings_are_opt_in(tmp_path, monkeypatch):
+    trace = Trace("classical", image="shapes.png")
+    with trace.stage("decode"):
+        pass
+    with trace.stage("decode"):
+        pass
+    trace.record("forward", 0.25)
+    assert trace.as_dict()["stages_ms"]["forward"] == 250.0 and set(trace.seconds) == {"decode", "forward"}
+
+    monkeypatch.delenv("FINDERAI_METRICS", raising=False)
+    assert with_timings('{"success": true}', trace) == '{"success": true}'
+    sink = tmp_path / "metrics.jsonl"
+    monkeypatch.setenv("FINDERAI_METRICS", str(sink))
+    assert json.loads(with_timings('{"success": true}', trace))["timings"]["stages_ms"]["forward"] == 250.0
+    trace.finish()
+    record = json.loads(sink.read_text())
+    assert record["trace"] == "classical" and record["image"] == "shapes.png"
+
+    # The one-shot CLI keeps its original output unless metrics are on
+    path = tmp_path / "shapes.png"
+    Image.fromarray(synthetic_images()["shapes"]).save(path)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ai_processor_enhanced_backup.py")
+    env = {name: value for name, value in os.environ.items()
+           if name not in ("FINDERAI_METRICS", "FINDERAI_EMBEDDING_CACHE")}
+    for metrics, keys in ((None, ["embeddings", "success", "dimensions", "model"]),
+                          ("stderr", ["embeddings", "success", "dimensions", "model", "timings"])):
+        run_env = env if metrics is None else {**env, "FINDERAI_METRICS": metrics}
+        result = subprocess.run([sys.executable, script, str(path)], capture_output=True, text=True,
+                                env=run_env, check=True)
+        assert list(json.loads(result.stdout)) == keys
+
+
+def test_hash_index_matches_brute_force(tmp_path):
+    rng = np.random.default_rng(2)
+    base = [int(v) for v in rng.integers(0, 2 ** 63, 300, dtype=np.int64)]
+    # Near copies of a few hashes, a handful of bits apart
+    values = base + [base[i] ^ (1 << int(rng.integers(64))) ^ (1 << int(rng.integers(64))) for i in range(20)]
+    index = HashIndex()
+    for i, value in enumerate(values):
+        index.add(i, value)
+
+    for radius in (0, 3, 7, 12):
+        for query in values[:5] + values[-5:]:
+            expected = sorted((hamming(query, v), i) for i, v in enumerate(values) if hamming(query, v) <= radius)
+            assert sorted((d, i) for i, d in index.query(query, radius)) == expected
+
+    assert index.remove(0) and 0 not in index
+    index.save(str(tmp_path / "hashes.npz"))
+    reloaded = HashIndex.load(str(tmp_path / "hashes.npz"))
+    assert len(reloaded) == len(values) - 1 and reloaded.get(5) == values[5]
+
+
+def test_phash_survives_resizing():
+    image = Image.fromarray(synthetic_images()["shapes"])
+    small = image.resize((160, 160))
+    hashes, resized = image_hashes(image), image_hashes(small)
+    other = image_hashes(Image.fromarray(synthetic_images()["gradient"]))
+    assert hamming(hashes["phash"], resized["phash"]) <= 4
+    assert hamming(hashes["phash"], other["phash"]) > 10
+
+
+def test_near_duplicate_filter_reserve_and_wait():
+    dedup = NearDuplicateFilter(radius=4, wait=0.05)
+    hashes = image_hashes(Image.fromarray(synthetic_images()["shapes"]))
+    match, key = dedup.reserve(hashes, "first")
+    assert match is None and key is not None
+
+    # The source is still embedding: the wait expires and nothing is claimed
+    assert dedup.reserve(hashes, "second") == (None, None)
+    # A source that fails while waited on likewise leaves the caller to embed
+    dedup.wait = 5
+    failing = threading.Timer(0.05, dedup.fulfil, (key, None))
+    failing.start()
+    assert dedup.reserve(hashes, "second") == (None, None)
+    failing.join()
+
+    match, key = dedup.reserve(hashes, "third")
+    assert match is None
+    dedup.fulfil(key, np.ones(3, dtype=np.float32))
+    (ref, distance, vector), claimed = dedup.reserve(hashes)
+    assert (ref, distance, claimed) == ("third", 0, None) and vector.sum() == 3
+
+
+def test_multi_vector_index_max_sim(tmp_path):
+    rng = np.random.default_rng(1)
+    views = rng.standard_normal((30, 3, 16)).astype(np.float32)
+    index = MultiVectorIndex(16, max_views=3)
+    index.add_many([f"i{i}" for i in range(30)], [v[:1 + i % 3] for i, v in enumerate(views)])
+
+    query = rng.standard_normal(16).astype(np.float32)
+    unit = views / np.linalg.norm(views, axis=2, keepdims=True)
+    expected = [max(unit[i, :1 + i % 3] @ (query / np.linalg.norm(query))) for i in range(30)]
+    results = index.search(query, k=4)
+    assert [i for i, _, _ in results] == [f"i{i}" for i in np.argsort(expected)[::-1][:4]]
+
+    path = str(tmp_path / "multi.npz")
+    index.save(path)
+    reloaded = load_index(path)
+    assert isinstance(reloaded, MultiVectorIndex)
+    assert reloaded.item_views("i4").shape == (2, 16)
+    np.testing.assert_allclose(reloaded.vectors[:len(reloaded)], index.vectors[:len(index)], atol=1e-6)
+
+
+@pytest.mark.parametrize("views", ["center", "center,flip,top_left"])
+def test_tta_views_pool_normalised(views):
+    torch = pytest.importorskip("torch")
+    names = parse_views(views)
+    assert parse_views("") is None and parse_views(["flip", ""]) == ("flip",)
+    with pytest.raises(ValueError):
+        parse_views("center,sideways")
+
+    fast = FastTransform(256, 224, IMAGENET_MEAN, IMAGENET_STD)
+    image = Image.fromarray(synthetic_images()["shapes"])
+    cut = fast.views(image, names)
+    assert cut.shape == (len(names), 3, 224, 224)
+    np.testing.assert_array_equal(cut[0], fast(image))
+
+    # The pooling path of a ViT processor, over a tiny stand-in model
+    processor = ViTProcessor.__new__(ViTProcessor)
+    processor.tta, processor.projection = names, None
+    processor.model = lambda batch: batch.mean(dim=(2, 3)) * 10
+    tensors = [torch.from_numpy(cut), torch.from_numpy(cut[:1])]
+    pooled = processor.embed_batch(tensors)
+    assert [vector.shape for vector in pooled] == [(3,), (3,)]
+    # Even a single view comes back unit length, like multi-view pooling
+    np.testing.assert_allclose([np.linalg.norm(vector) for vector in pooled], 1, rtol=1e-5)
+    (first, per_view), _ = processor.embed_batch_views(tensors)
+    assert per_view.shape == (len(names), 3)
+    np.testing.assert_allclose(first, pooled[0], rtol=1e-6)